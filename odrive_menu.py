@@ -1,307 +1,3568 @@
-from __future__ import print_function
-from builtins import str
-from builtins import object
-from future import standard_library
-from gi.repository import Gtk
-from gi.repository import Nautilus, GObject, Gio
+import gi
+
+gi.require_version('Nautilus', '3.0')
+
+from gi.repository import Nautilus, GObject, Gio, GLib
+import bisect
+import collections
+import fnmatch
 import gettext
+import heapq
+import importlib
+import itertools
 import os
-import subprocess
-import gi
-import sys
 import re
-import types
+import signal
+import stat
+import sys
+import threading
+import time
+from urllib.parse import urlparse, unquote
+
+# Odrive nautilus integration 0.0.88
+# Copyright (C) 2022 Casimir Bonnet https://github.com/cazzoo
+#
+# Odrive nautilus integration is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Odrive nautilus integration is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Odrive nautilus integration; if not, see http://www.gnu.org/licenses
+# for more information.
+
+# i18n
+gettext.textdomain('odrive-integration-common')
+_ = gettext.gettext
+
+
+class _LazyModule(object):
+    """Stand-in for a module that is only imported on first attribute access.
+
+    `gi_version` is the version of a gi.repository namespace to require
+    before importing it, so that a missing one only fails when it is used.
+    Special attributes, which introspection tools probe, do not import it.
+
+    >>> lazy = _LazyModule("no_such_module")
+    >>> hasattr(lazy, "__wrapped__"), lazy._module
+    (False, None)
+    """
+
+    def __init__(self, name, gi_version=None):
+        self._name = name
+        self._gi_version = gi_version
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("__") and attribute.endswith("__"):
+            raise AttributeError(attribute)
+        if self._module is None:
+            if self._gi_version is not None:
+                gi.require_version(self._name.rpartition(".")[2], self._gi_version)
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+# Not needed to register the providers: loaded on first use to keep Nautilus startup fast
+Gtk = _LazyModule("gi.repository.Gtk", gi_version="3.0")
+concurrent_futures = _LazyModule("concurrent.futures")
+configparser = _LazyModule("configparser")
+json = _LazyModule("json")
+logging = _LazyModule("logging")
+socket = _LazyModule("socket")
+sqlite3 = _LazyModule("sqlite3")
+
+
+def which(file_name):
+    for path in os.environ["PATH"].split(os.pathsep):
+        full_path = os.path.join(path, file_name)
+        if os.path.exists(full_path) and os.access(full_path, os.X_OK):
+            return full_path
+    return None
+
+
+def get_odrive_client_path():
+    """Path of the odrive client, looked up in $PATH on first use"""
+    global _odrive_client_path
+    if _odrive_client_path is None:
+        _odrive_client_path = which("odrive") or ""
+    return _odrive_client_path
+
+
+def uri_to_path(uri):
+    parsed = urlparse(uri)
+    host = "{0}{0}{mnt}{0}".format(os.path.sep, mnt=parsed.netloc)
+    # urllib.request.url2pathname is a plain unquote on POSIX and importing it pulls in http/ssl
+    return os.path.normpath(
+        os.path.join(host, unquote(parsed.path))
+    )
+
+
+_odrive_client_path = None
+current_path = os.path.dirname(os.path.abspath(__file__))
+abs_exec_path = os.path.dirname(os.path.realpath(__file__))
+
+# Seconds a mount table fetched from the agent is served before being refreshed
+MOUNT_TABLE_TTL = 30
+
+# Emblem metadata writes running at the same time
+EMBLEM_MAX_IN_FLIGHT = 16
+
+# Seconds a sync state reported by odrive is trusted
+SYNC_STATE_TTL = 10
+
+# Most directories watched for placeholder changes, and how many are visited per idle call
+MAX_DIRECTORY_WATCHES = 2000
+WATCH_WALK_BATCH = 50
+# Milliseconds filesystem events are gathered before being applied
+WATCH_COALESCE_DELAY = 250
+
+# On-disk state cache: entries older than this many seconds are dropped, writes are batched for that many ms
+STATE_STORE_MAX_AGE = 30 * 24 * 3600
+STATE_STORE_FLUSH_DELAY = 2000
+
+# Directory entries scanned per idle call when walking a tree (recursive sync, free up space)
+WALK_SCAN_BATCH = 200
+
+# Free up space: files used less than this many days ago are kept, files are unsynced this many at a
+# time, and the proposed target brings the disk usage back to this ratio
+RECLAIM_MIN_IDLE_DAYS = 7
+RECLAIM_BATCH_SIZE = 20
+RECLAIM_TARGET_USAGE = 0.8
+# Name (or path relative to the folder) patterns never unsynced to free up space
+RECLAIM_EXCLUDES = (".git", ".hg", ".svn")
+# Files listed at most in the free up space report
+RECLAIM_REPORT_LINES = 500
+
+# Background download of small placeholders in opened folders (opt-in, see settings.ini): default size
+# threshold and bytes per session in MB, concurrent downloads, and folders remembered as already looked at
+PREFETCH_THRESHOLD_MB = 10
+PREFETCH_MAX_TOTAL_MB = 500
+PREFETCH_MAX_CONCURRENT = 2
+PREFETCH_SEEN_DIRECTORIES = 256
+
+# Auto-sync rules of folders: seconds between two checks of the folders they cover, and seconds a check
+# waits after a change was seen in one of them
+AUTOSYNC_INTERVAL = 300
+AUTOSYNC_EVENT_DELAY = 5
+# Deepest subfolder level covered by a rule expanding to subfolders
+AUTOSYNC_MAX_DEPTH = 32
+# Syncs started by rules running at the same time, and started per minute at most
+AUTOSYNC_MAX_CONCURRENT = 2
+AUTOSYNC_MAX_PER_MINUTE = 30
+
+# Context menus kept for reuse, keyed by selection summary
+MENU_CACHE_SIZE = 32
+
+# Number of sync/unsync jobs allowed to run at the same time
+ODRIVE_MAX_CONCURRENT_JOBS = 4
+
+# Talk to the odrive agent directly instead of launching the odrive client for every command
+AGENT_CLIENT_ENABLED = True
+AGENT_MAX_CONNECTIONS = 4
+# Connections kept apart for status/syncstate queries, so that they never wait behind long syncs
+AGENT_QUERY_CONNECTIONS = 2
+AGENT_CONNECT_TIMEOUT = 2
+# Seconds before trying the agent endpoint again after it could not be reached
+AGENT_RETRY_DELAY = 30
+# Agent protocol parameter names of the positional arguments of each supported command
+AGENT_COMMAND_PARAMETERS = {
+    "status": (),
+    "mount": ("localPath", "remotePath"),
+    "unmount": ("localPath",),
+    "sync": ("placeholderPath",),
+    "unsync": ("path",),
+    "syncstate": ("path",),
+}
+
+# Seconds an odrive command may run before it is killed, per odrive sub-command
+ODRIVE_DEFAULT_TIMEOUT = 60
+ODRIVE_COMMAND_TIMEOUTS = {
+    "status": 15,
+    "syncstate": 15,
+    "mount": 60,
+    "unmount": 60,
+    "unsync": 300,
+    "sync": 6 * 3600,
+}
+# Run odrive commands through a helper process shared by every Nautilus window of the session. It is started
+# on demand, gets HELPER_START_DELAY seconds to come up, and exits once idle for HELPER_IDLE_EXIT seconds
+# (checked every HELPER_IDLE_CHECK seconds)
+HELPER_ENABLED = True
+HELPER_START_DELAY = 2
+HELPER_IDLE_EXIT = 600
+HELPER_IDLE_CHECK = 30
+
+# Agent health: command probing the agent, its timeout, and seconds between probes while it answers. After
+# AGENT_BREAKER_THRESHOLD failures in a row odrive commands are refused, and the agent probed again after
+# AGENT_PROBE_RETRY seconds, doubled on every failure up to AGENT_PROBE_MAX_INTERVAL
+AGENT_PROBE_ARGS = ("status",)
+AGENT_PROBE_TIMEOUT = 5
+AGENT_PROBE_INTERVAL = 60
+AGENT_BREAKER_THRESHOLD = 3
+AGENT_PROBE_RETRY = 5
+AGENT_PROBE_MAX_INTERVAL = 300
+
+# odrive sub-commands that change nothing: their results are shared for a few seconds
+ODRIVE_READ_ONLY_COMMANDS = ("status", "syncstate")
+ODRIVE_QUERY_MEMO_TTL = 2
+# Seconds a cancelled odrive client is given to exit after SIGTERM before it is killed
+ODRIVE_TERMINATE_GRACE = 5
+
+# Output lines kept per streamed odrive command, whatever its length
+ODRIVE_OUTPUT_TAIL_LINES = 50
+# Seconds odrive jobs must keep running before the progress window shows up, and its refresh interval in ms
+PROGRESS_WINDOW_DELAY = 2
+PROGRESS_WINDOW_REFRESH = 500
+
+# Logging level used when neither $ODRIVE_NAUTILUS_LOG nor the settings set one: off, error, warning, info or debug
+LOG_LEVEL = "off"
+# Seconds between two writes of the metrics file, when one is set ($ODRIVE_NAUTILUS_METRICS or the settings)
+METRICS_EXPORT_INTERVAL = 60
+# Interval in ms of the timer measuring the main loop lag while a dialog is up
+MAIN_LOOP_PROBE_INTERVAL = 100
+# Upper bounds in milliseconds of the buckets of timing histograms
+METRICS_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class OdriveHistogram(object):
+    """Distribution of timings, in milliseconds, over METRICS_BUCKETS_MS buckets"""
+
+    def __init__(self, bounds=METRICS_BUCKETS_MS):
+        self.bounds = bounds
+        # One more bucket for what is over the last bound
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the `percent` percentile
+
+        >>> histogram = OdriveHistogram()
+        >>> for value in (0.5, 3, 3, 40, 700):
+        ...     histogram.add(value)
+        >>> histogram.percentile(50), histogram.percentile(99)
+        (5, 1000)
+        """
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return 0
+
+    def to_dict(self):
+        buckets = dict(("le_{}".format(bound), count) for bound, count in zip(self.bounds, self.buckets))
+        buckets["inf"] = self.buckets[-1]
+        return {"count": self.count, "sum_ms": self.total, "max_ms": self.max,
+                "p50_ms": self.percentile(50), "p99_ms": self.percentile(99), "buckets": buckets}
+
+
+class _OdriveSpan(object):
+    """Context manager timing its block into a histogram of OdriveInstrumentation"""
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        if self.instrumentation.enabled:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        if self.started is not None:
+            elapsed = (time.perf_counter() - self.started) * 1000
+            self.instrumentation.observe(self.name, elapsed)
+            self.instrumentation.debug("{}: {:.2f} ms", self.name, elapsed)
+        return False
+
+
+class OdriveInstrumentation(object):
+    """Levelled logging and metrics of the extension, both off by default.
+
+    Messages are `str.format` templates, only formatted when their level is
+    enabled. Metrics are counters, timing histograms fed by spans and the
+    duration of every odrive command; they are only recorded once logging or
+    the metrics file is on. The file gets them as JSON every
+    METRICS_EXPORT_INTERVAL seconds, along with the stats of the sources
+    registered; `{pid}` in its name is replaced by the process id, which
+    keeps Nautilus processes and the session helper apart."""
+
+    LEVELS = {"off": 100, "error": 40, "warning": 30, "info": 20, "debug": 10}
+
+    def __init__(self):
+        self.level = self.LEVELS["off"]
+        self.metrics_path = None
+        self.enabled = False
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.sources = {}
+        self._logger = None
+        self._export_source = 0
+        self._changed = False
+        self._loop_watchers = 0
+        self._loop_source = 0
+        self._loop_expected = 0.0
+
+    def configure(self, level=None, metrics_path=None):
+        self.level = self.LEVELS.get((level or LOG_LEVEL).strip().lower(), self.LEVELS["off"])
+        self.metrics_path = metrics_path.replace("{pid}", str(os.getpid())) if metrics_path else None
+        self.enabled = self.level < self.LEVELS["off"] or self.metrics_path is not None
+        if self.level < self.LEVELS["off"] and self._logger is None:
+            # A logger of our own: the root logger belongs to the host process
+            self._logger = logging.getLogger("odrive-nautilus")
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("odrive-nautilus %(levelname)s: %(message)s"))
+            self._logger.addHandler(handler)
+            self._logger.propagate = False
+        if self._logger is not None:
+            self._logger.setLevel(self.level)
+        if self._export_source:
+            GLib.source_remove(self._export_source)
+            self._export_source = 0
+        if self.metrics_path is not None:
+            self._export_source = GLib.timeout_add_seconds(METRICS_EXPORT_INTERVAL, self._on_export_timeout)
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self._logger.log(level, message.format(*args) if args else message)
+
+    def debug(self, message, *args):
+        self.log(self.LEVELS["debug"], message, *args)
+
+    def info(self, message, *args):
+        self.log(self.LEVELS["info"], message, *args)
+
+    def warning(self, message, *args):
+        self.log(self.LEVELS["warning"], message, *args)
+
+    def error(self, message, *args):
+        self.log(self.LEVELS["error"], message, *args)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+            self._changed = True
+
+    def observe(self, name, milliseconds):
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = OdriveHistogram()
+            histogram.add(milliseconds)
+            self._changed = True
+
+    def span(self, name):
+        """Context manager timing its block into the `name` histogram"""
+        return _OdriveSpan(self, name)
+
+    def command(self, result, duration):
+        """Account for an odrive command over after `duration` seconds"""
+        if not self.enabled:
+            return
+        name = "odrive." + (result.args[0] if result.args else "")
+        output_bytes = len(result.stdout.encode("utf-8")) + len(result.stderr.encode("utf-8"))
+        status = "timeout" if result.timed_out else "cancelled" if result.cancelled else result.exit_code
+        self.observe(name, duration * 1000)
+        self.count("{}.exit.{}".format(name, status))
+        self.count("odrive.output_bytes", output_bytes)
+        self.debug("odrive {}: {:.1f} ms, exit {}, {} bytes of output", " ".join(result.args), duration * 1000,
+                   status, output_bytes)
+
+    def watch_main_loop(self):
+        """Measure how late the main loop runs a timer, in the "main_loop.lag" histogram, until unwatched"""
+        self._loop_watchers += 1
+        if self.enabled and not self._loop_source:
+            self._loop_expected = time.monotonic() + MAIN_LOOP_PROBE_INTERVAL / 1000.0
+            self._loop_source = GLib.timeout_add(MAIN_LOOP_PROBE_INTERVAL, self._on_loop_probe)
+
+    def unwatch_main_loop(self):
+        self._loop_watchers = max(0, self._loop_watchers - 1)
+        if not self._loop_watchers and self._loop_source:
+            GLib.source_remove(self._loop_source)
+            self._loop_source = 0
+
+    def _on_loop_probe(self):
+        now = time.monotonic()
+        self.observe("main_loop.lag", max(0.0, now - self._loop_expected) * 1000)
+        self._loop_expected = now + MAIN_LOOP_PROBE_INTERVAL / 1000.0
+        return True
+
+    def register(self, name, stats):
+        """Export the dictionary returned by `stats()` with the metrics"""
+        self.sources[name] = stats
+
+    def snapshot(self):
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "counters": dict(self.counters),
+            "histograms": dict((name, histogram.to_dict()) for name, histogram in self.histograms.items()),
+            "sources": dict((name, stats()) for name, stats in self.sources.items()),
+        }
+
+    def export(self):
+        """Write the metrics file now"""
+        if self.metrics_path is None:
+            return
+        self._changed = False
+        temporary_path = self.metrics_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.metrics_path)), exist_ok=True)
+            with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+                json.dump(self.snapshot(), metrics_file, indent=1, sort_keys=True)
+            os.replace(temporary_path, self.metrics_path)
+        except OSError as error:
+            self.warning("Unable to write {}: {}", self.metrics_path, error)
+
+    def _on_export_timeout(self):
+        if self._changed:
+            self.export()
+        return True
+
+
+instrumentation = OdriveInstrumentation()
+
+
+ProgressWindow = None
+
+
+def _load_windows():
+    """Define the window classes, which needs Gtk: only done the first time a window is shown"""
+    global ProgressWindow
+    if ProgressWindow is not None:
+        return
+    from gi.repository import Pango
+
+    class _ProgressWindow(Gtk.Window):
+        def __init__(self, on_cancel):
+            super(_ProgressWindow, self).__init__(title=_("odrive"))
+
+            self.set_default_size(400, 100)
+            self.set_resizable(False)
+
+            vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6, border_width=12)
+            self.add(vbox)
+
+            self.label = Gtk.Label(xalign=0)
+            vbox.pack_start(self.label, True, True, 0)
+
+            self.progress_bar = Gtk.ProgressBar(show_text=True)
+            vbox.pack_start(self.progress_bar, True, True, 0)
+
+            self.label_path = Gtk.Label(xalign=0, ellipsize=Pango.EllipsizeMode.MIDDLE)
+            vbox.pack_start(self.label_path, True, True, 0)
+
+            hbox_btn = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+            vbox.pack_end(hbox_btn, True, True, 0)
+
+            self.btn_cancel = Gtk.Button(label=_("Cancel"))
+            self.btn_cancel.connect("clicked", lambda button: on_cancel())
+            hbox_btn.pack_end(self.btn_cancel, False, False, 0)
+
+        def update(self, title, fraction, details, current_path):
+            self.label.set_text(title)
+            if fraction is None:
+                self.progress_bar.pulse()
+            else:
+                self.progress_bar.set_fraction(fraction)
+            self.progress_bar.set_text(details)
+            self.label_path.set_text(current_path or "")
+
+    ProgressWindow = _ProgressWindow
+
+
+class OdriveDialog(object):
+    """Non-modal dialog built from a .glade template the first time it is shown, then reused.
+
+    The `on_btn_confirm_released` and `on_btn_cancel_released` signal
+    handlers of the template answer it, closing the window cancels it.
+    `show()` returns at once; `on_confirm(builder)` is called from the main
+    loop once the user confirms, to read the widgets and queue the work.
+    Showing the dialog while it is up hands it over to the new caller.
+
+    With instrumentation on, the time from `show()` to the window being
+    mapped goes to the "dialog.<name>.open" histogram, and the main loop lag
+    is measured while the dialog is up."""
+
+    def __init__(self, template, handlers=None, window_id="main_window"):
+        self.template = template
+        self.name = os.path.splitext(template)[0]
+        self.handlers = dict(handlers or {})
+        self.window_id = window_id
+        self.builder = None
+        self.window = None
+        self._on_confirm = None
+        self._shown_at = None
+
+    def show(self, on_confirm, prepare=None):
+        """Show the dialog, `prepare(builder)` resetting its widgets first"""
+        if self.window is None:
+            with instrumentation.span("dialog.{}.build".format(self.name)):
+                self._build()
+        if self._on_confirm is None:
+            instrumentation.watch_main_loop()
+        else:
+            instrumentation.debug("{} dialog reused before being answered", self.name)
+        if not self.window.get_visible():
+            self._shown_at = time.perf_counter()
+        self._on_confirm = on_confirm
+        if prepare is not None:
+            prepare(self.builder)
+        self.window.show()
+        self.window.present()
+
+    def _build(self):
+        self.builder = Gtk.Builder()
+        self.builder.set_translation_domain('odrive-integration-common')
+        self.builder.add_from_file(os.path.join(abs_exec_path, self.template))
+        handlers = {
+            'on_btn_confirm_released': lambda _button: self._answer(True),
+            'on_btn_cancel_released': lambda _button: self._answer(False),
+        }
+        handlers.update(self.handlers)
+        self.builder.connect_signals(handlers)
+        self.window = self.builder.get_object(self.window_id)
+        self.window.connect("delete-event", self._on_delete)
+        self.window.connect("map-event", self._on_mapped)
+
+    def close(self):
+        """Hide the dialog as if it was cancelled, for handlers acting on their own"""
+        self._answer(False)
+
+    def _on_delete(self, _window, _event):
+        self._answer(False)
+        # Only hidden, to be shown again
+        return True
+
+    def _on_mapped(self, _window, _event):
+        if self._shown_at is not None:
+            instrumentation.observe("dialog.{}.open".format(self.name), (time.perf_counter() - self._shown_at) * 1000)
+            self._shown_at = None
+        return False
+
+    def _answer(self, confirmed):
+        on_confirm, self._on_confirm = self._on_confirm, None
+        self.window.hide()
+        if on_confirm is None:
+            return
+        instrumentation.unwatch_main_loop()
+        if confirmed:
+            on_confirm(self.builder)
+        else:
+            instrumentation.debug("{} dialog cancelled", self.name)
+
+
+class OdriveStatus(object):
+    """Odrive Status Class"""
+
+    def __init__(self):
+        # Emblems
+        self.EMBLEMS = [
+            'emblem-important',
+            'emblem-urgent',
+            'emblem-favorite',
+            'emblem-default',
+            'emblem-new'
+        ]
+        self.I18N_EMBLEMS = {
+            'emblem-important': _("Important"),
+            'emblem-urgent': _("In Progress"),
+            'emblem-favorite': _("Favorite"),
+            'emblem-default': _("Finished"),
+            'emblem-new': _("New")
+        }
+        # Emblems shown by the info provider for each sync state
+        self.STATE_EMBLEMS = {
+            OdriveSyncState.SYNCED: 'emblem-default',
+            OdriveSyncState.SYNCING: 'emblem-urgent'
+        }
+        self.written = 0
+        self.skipped = 0
+        self._pending_emblems = collections.OrderedDict()
+        self._emblems_in_flight = 0
+        self._emblem_source = 0
+
+    def get_icon(self, icon_name):
+        """Get icon name and filename (used for check if exists an icon)"""
+        icon_theme = Gtk.IconTheme.get_default()
+        icon = icon_theme.lookup_icon(icon_name, 48, 0)
+        if icon is not None:
+            return {'name': os.path.splitext(os.path.basename(icon.get_filename()))[0],
+                    'filename': icon.get_filename()}
+        else:
+            return {'name': '', 'filename': ''}
+
+    def set_emblem(self, item_path, emblem_name=''):
+        """Set emblem"""
+        self.set_emblems([(item_path, emblem_name)])
+
+    def restore_emblem(self, item_path):
+        """Restore emblem to default"""
+        self.set_emblems([(item_path, '')])
+
+    def set_emblems(self, changes):
+        """Set emblems of many files at once, from (path, emblem) pairs ('' restores the default).
+
+        Changes are coalesced per path and applied asynchronously at low
+        priority: each file gets one metadata query, a single write only if its
+        emblem actually changes, and one refresh."""
+        for item_path, emblem_name in changes:
+            self._pending_emblems.pop(item_path, None)
+            self._pending_emblems[item_path] = emblem_name or ''
+        self._schedule_emblems()
+
+    def _schedule_emblems(self):
+        if self._pending_emblems and not self._emblem_source:
+            self._emblem_source = GLib.idle_add(self._apply_emblems, priority=GLib.PRIORITY_LOW)
+
+    def _apply_emblems(self):
+        self._emblem_source = 0
+        while self._pending_emblems and self._emblems_in_flight < EMBLEM_MAX_IN_FLIGHT:
+            item_path, emblem_name = self._pending_emblems.popitem(last=False)
+            self._emblems_in_flight += 1
+            item = Gio.File.new_for_path(item_path)
+            item.query_info_async('metadata::emblems', Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_LOW, None,
+                                  self._on_emblem_queried, emblem_name)
+        return False
+
+    def _on_emblem_queried(self, item, task, emblem_name):
+        try:
+            info = item.query_info_finish(task)
+        except GLib.Error as error:
+            instrumentation.warning("Unable to read emblems of {}: {}", item.get_path(), error.message)
+            self._emblem_done()
+            return
+
+        current = [emblem for emblem in (info.get_attribute_stringv('metadata::emblems') or []) if emblem]
+        if current == ([emblem_name] if emblem_name else []):
+            self.skipped += 1
+            self._emblem_done()
+            return
+
+        if emblem_name:
+            emblems = [emblem_name]
+            emblems.append(None)  # Needs
+            info.set_attribute_stringv('metadata::emblems', emblems)
+        else:
+            info.set_attribute('metadata::emblems', Gio.FileAttributeType.INVALID, 0)
+        item.set_attributes_async(info, Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_LOW, None,
+                                  self._on_emblem_written)
+
+    def _on_emblem_written(self, item, task):
+        try:
+            item.set_attributes_finish(task)
+            self.written += 1
+            self._refresh(item.get_path())
+        except (GLib.Error, OSError) as error:
+            instrumentation.warning("Unable to set emblem of {}: {}", item.get_path(), error)
+        self._emblem_done()
+
+    def _emblem_done(self):
+        self._emblems_in_flight -= 1
+        self._schedule_emblems()
+
+    def _refresh(self, item_path):
+        """Reload the current file/directory icon"""
+        os.utime(item_path, None)
+
+
+class OdriveCommandResult(object):
+    """Outcome of an odrive client invocation"""
+
+    def __init__(self, args, exit_code, stdout="", stderr="", timed_out=False, cancelled=False):
+        self.args = args
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0 and not self.timed_out and not self.cancelled
+
+
+_PROGRESS_PATH = re.compile(r"'([^']+)'|\"([^\"]+)\"|(/\S+)")
+_PROGRESS_BYTES = re.compile(r"(\d+(?:\.\d+)?)\s*(B|KB|MB|GB|TB|KiB|MiB|GiB|TiB)\b")
+_PROGRESS_DONE = re.compile(r"\b(synced|downloaded|complete|completed|unsynced)\b", re.IGNORECASE)
+_BYTE_UNITS = {"B": 1, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4,
+               "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+
+
+def _parse_odrive_progress_line(line):
+    """Read (path, bytes, item_done) from one line of odrive output; unknown parts are None/0/False"""
+    path = None
+    match = _PROGRESS_PATH.search(line)
+    if match:
+        path = next(group for group in match.groups() if group)
+    size = 0
+    match = _PROGRESS_BYTES.search(line)
+    if match:
+        size = int(float(match.group(1)) * _BYTE_UNITS[match.group(2)])
+    return path, size, bool(_PROGRESS_DONE.search(line))
+
+
+class OdriveProgress(object):
+    """Progress of one odrive command, fed line by line as its output arrives.
+
+    Only counters, the path being worked on and the last few output lines are
+    kept, so memory stays bounded however long the command runs."""
+
+    def __init__(self, max_lines=ODRIVE_OUTPUT_TAIL_LINES):
+        self.items_done = 0
+        self.bytes_done = 0
+        self.current_path = None
+        self.stdout = collections.deque(maxlen=max_lines)
+        self.stderr = collections.deque(maxlen=max_lines)
+
+    def feed(self, line, error=False):
+        line = line.rstrip("\r\n")
+        if not line:
+            return
+        if error:
+            self.stderr.append(line)
+            return
+        self.stdout.append(line)
+        path, size, done = _parse_odrive_progress_line(line)
+        if path:
+            self.current_path = path
+        self.bytes_done += size
+        if done:
+            self.items_done += 1
+
+
+class OdriveCommand(object):
+    """Handle on an odrive client process running through Gio.Subprocess.
+
+    It behaves like a small future: callbacks registered with
+    `add_done_callback` are invoked on the GLib main loop with the
+    OdriveCommandResult once the process exits, times out or is cancelled.
+
+    With a `progress` model, output is read line by line as it is produced
+    and fed to it instead of being collected until the process exits; the
+    result then only holds the last lines."""
+
+    def __init__(self, args, timeout=None, progress=None):
+        self.args = list(args)
+        self.timeout = timeout
+        self.progress = progress
+        self.result = None
+        self._callbacks = []
+        self._process = None
+        self._timeout_id = 0
+        self._kill_id = 0
+        self._started = False
+        self._started_at = None
+        self._timed_out = False
+        self._open_streams = 0
+        self._cancellable = Gio.Cancellable()
+
+    def start(self):
+        if self._cancellable.is_cancelled():
+            # Cancelled before its turn came, already reported
+            return self
+        self._started = True
+        self._started_at = time.monotonic()
+        self._spawn()
+        return self
+
+    def _arm_timeout(self):
+        """Start counting `timeout`, once the command is actually handed to odrive"""
+        if self.timeout and not self._timeout_id and self.result is None:
+            self._timeout_id = GLib.timeout_add_seconds(self.timeout, self._on_timeout)
+        return False
+
+    def _spawn(self):
+        self._arm_timeout()
+        flags = Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_PIPE
+        try:
+            self._process = Gio.Subprocess.new([get_odrive_client_path()] + self.args, flags)
+        except GLib.Error as error:
+            # Report asynchronously as well, callers never get a result synchronously
+            GLib.idle_add(self._finish, OdriveCommandResult(self.args, -1, stderr=error.message))
+            return
+        if self.progress is None:
+            # Not cancellable: a cancelled command is terminated and reported once it has exited
+            self._process.communicate_utf8_async(None, None, self._on_communicated)
+            return
+        # Both pipes and the process exit
+        self._open_streams = 3
+        self._read_line(Gio.DataInputStream.new(self._process.get_stdout_pipe()), False)
+        self._read_line(Gio.DataInputStream.new(self._process.get_stderr_pipe()), True)
+        self._process.wait_async(None, self._on_stream_closed)
+
+    def done(self):
+        return self.result is not None
+
+    def add_done_callback(self, callback):
+        """Call `callback(result)` when the command is over (immediately if it already is)"""
+        if self.result is not None:
+            callback(self.result)
+        else:
+            self._callbacks.append(callback)
+
+    def cancel(self):
+        """Stop the command, terminating the odrive client if it is still running.
+
+        The client gets SIGTERM first and is only killed if it is still there
+        ODRIVE_TERMINATE_GRACE seconds later."""
+        if self.result is not None or self._cancellable.is_cancelled():
+            return
+        self._cancellable.cancel()
+        if not self._started:
+            # Still waiting for its turn
+            GLib.idle_add(self._finish, OdriveCommandResult(self.args, -1, cancelled=True))
+        elif self._process is not None:
+            self._process.send_signal(signal.SIGTERM)
+            self._kill_id = GLib.timeout_add_seconds(ODRIVE_TERMINATE_GRACE, self._on_kill_timeout)
+
+    def _on_kill_timeout(self):
+        self._kill_id = 0
+        if self.result is None:
+            self._process.force_exit()
+        return False
+
+    def _on_timeout(self):
+        self._timeout_id = 0
+        self._timed_out = True
+        instrumentation.warning("odrive command timed out after {}s: {}", self.timeout, ",".join(self.args))
+        self.cancel()
+        return False
+
+    def _read_line(self, stream, error):
+        stream.read_line_async(GLib.PRIORITY_DEFAULT, None, self._on_line, error)
+
+    def _on_line(self, stream, task, error):
+        try:
+            line, _length = stream.read_line_finish_utf8(task)
+        except GLib.Error as read_error:
+            self.progress.feed(read_error.message, error=True)
+            line = None
+        if line is None:
+            stream.close(None)
+            self._on_stream_closed()
+            return
+        self.progress.feed(line, error)
+        self._read_line(stream, error)
+
+    def _on_stream_closed(self, *_args):
+        self._open_streams -= 1
+        if self._open_streams or self.result is not None:
+            return
+        process = self._process
+        exit_code = process.get_exit_status() if process.get_if_exited() else -1
+        self._finish(OdriveCommandResult(self.args, exit_code, "\n".join(self.progress.stdout),
+                                         "\n".join(self.progress.stderr), timed_out=self._timed_out,
+                                         cancelled=self._cancellable.is_cancelled() and not self._timed_out))
+
+    def _on_communicated(self, process, task):
+        stdout, stderr = "", ""
+        try:
+            _success, stdout, stderr = process.communicate_utf8_finish(task)
+        except GLib.Error as error:
+            stderr = error.message
+        exit_code = process.get_exit_status() if process.get_if_exited() else -1
+        self._finish(OdriveCommandResult(self.args, exit_code, stdout or "", stderr or "",
+                                         timed_out=self._timed_out,
+                                         cancelled=self._cancellable.is_cancelled() and not self._timed_out))
+
+    def _finish(self, result):
+        if self._timeout_id:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = 0
+        if self._kill_id:
+            GLib.source_remove(self._kill_id)
+            self._kill_id = 0
+        self.result = result
+        if self._started_at is not None:
+            instrumentation.command(result, time.monotonic() - self._started_at)
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as error:
+                instrumentation.error("odrive command callback failed: {}", error)
+        return False
+
+
+class _OdriveAgentConnection(object):
+    """One socket to the odrive agent, speaking the JSON protocol of the odrive CLI.
+
+    A request is a JSON object `{"command": ..., "parameters": {...}}` on a
+    single line. The agent answers with one JSON message per line
+    (`{"messageType": "Status"|"Error", "message": ...}`) and either closes the
+    connection or, when it keeps it open, ends the reply with a "Done"
+    message, in which case the connection goes back to the pool."""
+
+    def __init__(self, address, timeout):
+        if isinstance(address, str):
+            # Path of a Unix socket (the session helper)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            try:
+                self.sock.connect(address)
+            except OSError:
+                self.sock.close()
+                raise
+        else:
+            self.sock = socket.create_connection(("127.0.0.1", address), timeout)
+        self.reader = self.sock.makefile("rb")
+        self.served = 0
+
+    def request(self, payload, timeout, on_line=None, max_lines=None):
+        """Send one request, return (exit_code, stdout, stderr, reusable).
+
+        Messages are also passed to `on_line(text, error)` as they arrive; with
+        `max_lines`, only that many last lines are returned. A reused
+        connection closed before answering anything raises ConnectionError:
+        the other end went away while it was idle, nothing was done."""
+        self.sock.settimeout(timeout)
+        self.sock.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+        stdout, stderr = collections.deque(maxlen=max_lines), collections.deque(maxlen=max_lines)
+        answered = False
+        while True:
+            line = self.reader.readline()
+            if not line:
+                if self.served and not answered:
+                    raise ConnectionResetError("connection closed before any reply")
+                return (1 if stderr else 0), "\n".join(stdout), "\n".join(stderr), False
+            answered = True
+            message = json.loads(line.decode("utf-8"))
+            message_type = message.get("messageType")
+            if message_type == "Done":
+                self.served += 1
+                return message.get("exitCode", 1 if stderr else 0), "\n".join(stdout), "\n".join(stderr), True
+            text = str(message.get("message", ""))
+            if message_type == "Error":
+                stderr.append(text)
+            else:
+                stdout.append(text)
+            if on_line is not None:
+                on_line(text, message_type == "Error")
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+
+def _find_odrive_agent_port():
+    """Port of the agent protocol server, from $ODRIVE_AGENT_PORT or the agent registry file"""
+    if os.environ.get("ODRIVE_AGENT_PORT"):
+        return int(os.environ["ODRIVE_AGENT_PORT"])
+    try:
+        with open(os.path.join(os.path.expanduser("~"), ".odrive-agent", ".oreg"), encoding="utf-8") as oreg:
+            registry = json.load(oreg)
+    except (IOError, ValueError):
+        return None
+    for entry in registry.values():
+        if isinstance(entry, dict) and "current" in entry:
+            port = entry["current"].get("protocol")
+            if port:
+                return int(port)
+    return None
+
+
+def _agent_request(args):
+    """Translate odrive CLI arguments into an agent protocol request"""
+    command = args[0]
+    parameters = {}
+    positional = [arg for arg in args[1:] if not arg.startswith("--")]
+    for name, value in zip(AGENT_COMMAND_PARAMETERS[command], positional):
+        parameters[name] = value
+    for flag in args[1:]:
+        if flag.startswith("--"):
+            parameters[flag[2:]] = True
+    return {"command": command, "parameters": parameters}
+
+
+class OdriveAgentClient(object):
+    """In-process client of the running odriveagent.
+
+    Requests are served by a small pool of worker threads, each reusing a
+    persistent connection to the agent when it allows it, so bulk operations
+    cost a socket round-trip instead of an odrive process launch. Queries
+    have workers of their own (`max_queries`), so that they are answered
+    while every other worker waits on a long sync. When the
+    agent endpoint cannot be reached, commands fall back to the CLI and the
+    agent is not tried again for AGENT_RETRY_DELAY seconds."""
+
+    def __init__(self, port=None, max_connections=AGENT_MAX_CONNECTIONS, max_queries=AGENT_QUERY_CONNECTIONS):
+        self.port = port
+        self.max_connections = max_connections
+        self.max_queries = max_queries
+        self.requests = 0
+        self.fallbacks = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._retry_at = 0.0
+        # Query lane (True) and the other commands (False) -> thread pool
+        self._executors = {}
+
+    def supports(self, args):
+        return bool(args) and args[0] in AGENT_COMMAND_PARAMETERS
+
+    def available(self):
+        if time.monotonic() < self._retry_at:
+            return False
+        if self.port is None:
+            self.port = _find_odrive_agent_port()
+            if self.port is None:
+                self._retry_at = time.monotonic() + AGENT_RETRY_DELAY
+                return False
+        return True
+
+    def command(self, args, timeout=None, progress=None):
+        return OdriveAgentCommand(self, args, timeout, progress)
+
+    def submit(self, command):
+        query = self._is_query(command)
+        executor = self._executors.get(query)
+        if executor is None:
+            executor = self._executors[query] = concurrent_futures.ThreadPoolExecutor(
+                self.max_queries if query else self.max_connections,
+                thread_name_prefix="odrive-agent-query" if query else "odrive-agent")
+        executor.submit(self._serve, command)
+
+    def _is_query(self, command):
+        return command.args[0] in ODRIVE_READ_ONLY_COMMANDS
+
+    def _payload(self, command):
+        return _agent_request(command.args)
+
+    def _on_unreachable(self):
+        """Called on the main loop when no connection could be made"""
+        return False
+
+    def _serve(self, command):
+        """Worker thread: run one request, reporting back on the main loop"""
+        if command._cancellable.is_cancelled():
+            GLib.idle_add(command._on_agent_reply, -1, "", "")
+            return
+        payload = self._payload(command)
+        timeout = command.timeout or None
+        on_line, max_lines = None, None
+        if command.progress is not None:
+            # The progress model lives on the main loop
+            on_line = lambda text, error: GLib.idle_add(command.progress.feed, text, error)
+            max_lines = command.progress.stdout.maxlen
+        for attempt in range(2):
+            try:
+                connection, pooled = self._acquire(fresh=attempt > 0)
+            except OSError:
+                with self._lock:
+                    self.fallbacks += 1
+                    self._retry_at = time.monotonic() + AGENT_RETRY_DELAY
+                GLib.idle_add(self._on_unreachable)
+                GLib.idle_add(command._fallback)
+                return
+            command._connection = connection
+            # Waiting for a free worker is not the agent being slow: the time-out starts now
+            GLib.idle_add(command._arm_timeout)
+            try:
+                exit_code, stdout, stderr, reusable = connection.request(payload, timeout, on_line, max_lines)
+            except (OSError, ValueError) as error:
+                connection.close()
+                # A pooled connection may have been closed by the agent meanwhile, retry once
+                if pooled and attempt == 0 and not command._cancellable.is_cancelled():
+                    continue
+                GLib.idle_add(command._on_agent_reply, -1, "", str(error))
+                return
+            finally:
+                command._connection = None
+            if reusable and not command._cancellable.is_cancelled():
+                self._release(connection)
+            else:
+                connection.close()
+            with self._lock:
+                self.requests += 1
+            GLib.idle_add(command._on_agent_reply, exit_code, stdout, stderr)
+            return
+
+    def _acquire(self, fresh=False):
+        with self._lock:
+            if self._idle and not fresh:
+                return self._idle.pop(), True
+        return _OdriveAgentConnection(self.port, AGENT_CONNECT_TIMEOUT), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_connections + self.max_queries:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+        executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+
+class OdriveAgentCommand(OdriveCommand):
+    """OdriveCommand served by the odrive agent, running the CLI only if the agent is unreachable.
+
+    Its time-out only starts once a worker sends the request, so time spent
+    waiting for a free connection never counts as the agent failing."""
+
+    def __init__(self, client, args, timeout=None, progress=None):
+        super(OdriveAgentCommand, self).__init__(args, timeout, progress)
+        self.client = client
+        self._connection = None
+
+    def _spawn(self):
+        self.client.submit(self)
+
+    def cancel(self):
+        if self.result is not None or self._cancellable.is_cancelled():
+            return
+        super(OdriveAgentCommand, self).cancel()
+        connection = self._connection
+        if connection is not None:
+            # Unblocks the worker thread waiting on the agent reply
+            connection.close()
+
+    def _fallback(self):
+        if self.result is None:
+            if self._cancellable.is_cancelled():
+                self._finish(OdriveCommandResult(self.args, -1, timed_out=self._timed_out,
+                                                 cancelled=not self._timed_out))
+            else:
+                OdriveCommand._spawn(self)
+        return False
+
+    def _on_agent_reply(self, exit_code, stdout, stderr):
+        if self.result is None:
+            cancelled = self._cancellable.is_cancelled()
+            self._finish(OdriveCommandResult(self.args, exit_code, stdout, stderr,
+                                             timed_out=self._timed_out,
+                                             cancelled=cancelled and not self._timed_out))
+        return False
+
+
+def _helper_socket_path():
+    """Unix socket of the session helper, from $ODRIVE_HELPER_SOCKET or the user runtime directory"""
+    if os.environ.get("ODRIVE_HELPER_SOCKET"):
+        return os.environ["ODRIVE_HELPER_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "odrive-nautilus", "helper.sock")
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), "odrive-nautilus-{}".format(os.getuid()), "helper.sock")
+
+
+def _is_private_directory(path):
+    """Whether `path` is a directory of the current user, with mode 0700.
+
+    The helper socket is only used in such a directory: in a shared one such as
+    /tmp, another user could have created it first, and then listen in place of
+    the helper or connect to it.
+
+    >>> import tempfile
+    >>> _is_private_directory(tempfile.mkdtemp()), _is_private_directory("/")
+    (True, False)
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and stat.S_IMODE(info.st_mode) == 0o700
+
+
+def _helper_command_line(path):
+    # Inside Nautilus sys.executable is not always a Python interpreter
+    python = sys.executable if os.path.basename(sys.executable or "").startswith("python") else which("python3")
+    return [python or sys.executable, os.path.realpath(__file__), "--helper", "--socket", path]
+
+
+class OdriveHelperClient(OdriveAgentClient):
+    """Client of the session helper, which runs the odrive commands of every Nautilus process.
+
+    It speaks the agent protocol over the helper's Unix socket, with the
+    command line as parameters. Identical requests from different windows
+    then share one execution and the helper's memoized queries, and a job
+    keeps running when the window that started it goes away. The helper is
+    started the first time it cannot be reached; until it answers, commands
+    run in-process."""
+
+    def __init__(self, path=None, max_connections=AGENT_MAX_CONNECTIONS, max_queries=AGENT_QUERY_CONNECTIONS):
+        super(OdriveHelperClient, self).__init__(path or _helper_socket_path(), max_connections, max_queries)
+        self._helper = None
+
+    def supports(self, args):
+        return bool(args)
+
+    def available(self):
+        if time.monotonic() < self._retry_at:
+            return False
+        if not os.path.exists(self.port):
+            self._on_unreachable()
+            return False
+        if not _is_private_directory(os.path.dirname(self.port)):
+            instrumentation.warning("Not using odrive helper socket {}: its folder is not private", self.port)
+            self._retry_at = time.monotonic() + AGENT_RETRY_DELAY
+            return False
+        return True
+
+    def command(self, args, timeout=None, progress=None):
+        return OdriveHelperCommand(self, args, timeout, progress)
+
+    def cancel(self, args):
+        """Ask the helper to stop `odrive <args>`, whoever started it"""
+        command = OdriveHelperCommand(self, args)
+        command.request = {"command": "cancel", "parameters": {"args": list(args)}}
+        self.submit(command)
+
+    def _is_query(self, command):
+        # Cancellations are answered at once, as queries are
+        return command.request is not None or super(OdriveHelperClient, self)._is_query(command)
+
+    def _payload(self, command):
+        return getattr(command, "request", None) or {
+            "command": "run", "parameters": {"args": command.args, "timeout": command.timeout}}
+
+    def _on_unreachable(self):
+        if self._helper is not None and self._helper.get_identifier() is not None:
+            # Started already, still getting ready
+            self._retry_at = time.monotonic() + HELPER_START_DELAY
+            return False
+        instrumentation.info("Starting odrive helper on {}", self.port)
+        self._retry_at = time.monotonic() + HELPER_START_DELAY
+        try:
+            self._helper = Gio.Subprocess.new(_helper_command_line(self.port), Gio.SubprocessFlags.NONE)
+        except (GLib.Error, TypeError) as error:
+            # TypeError: no Python interpreter to run it with. Commands keep running in-process meanwhile
+            instrumentation.warning("Unable to start odrive helper: {}", getattr(error, "message", error))
+            self._retry_at = time.monotonic() + AGENT_RETRY_DELAY
+        return False
+
+
+class OdriveHelperCommand(OdriveAgentCommand):
+    """OdriveCommand run by the session helper"""
+
+    def __init__(self, client, args, timeout=None, progress=None):
+        super(OdriveHelperCommand, self).__init__(client, args, timeout, progress)
+        # Protocol request other than running the command, never run locally
+        self.request = None
+
+    def cancel(self):
+        if self.result is not None or self._cancellable.is_cancelled():
+            return
+        super(OdriveHelperCommand, self).cancel()
+        if self._started and self._process is None and self.request is None and not self._timed_out:
+            # Closing our connection leaves the command running in the helper, for the other windows. On a
+            # time-out there is nothing to ask: the helper enforces the time-out it was given
+            self.client.cancel(self.args)
+
+    def _fallback(self):
+        if self.request is not None:
+            self._finish(OdriveCommandResult(self.args, -1, stderr="odrive helper unreachable"))
+            return False
+        return super(OdriveHelperCommand, self)._fallback()
+
+
+class OdriveCommandEngine(object):
+    """Runs odrive client commands asynchronously on the GLib main loop.
+
+    Requests are coalesced before anything is spawned:
+    - a command identical to one in flight shares its execution and result
+      (so cancelling it cancels it for every caller);
+    - the successful result of a read-only query is reused for
+      ODRIVE_QUERY_MEMO_TTL seconds, until a mutating command completes;
+    - mutating commands on the same path run one after the other, in order;
+    - while `health` (an OdriveAgentHealth) has its breaker open, commands
+      fail at once with exit code -1.
+    `spawns`, `coalesced`, `memoized`, `serialized` and `refused` count what
+    happened."""
+
+    def __init__(self, timeouts=None, agent_client=None):
+        self.timeouts = dict(ODRIVE_COMMAND_TIMEOUTS if timeouts is None else timeouts)
+        self.agent_client = agent_client
+        self.health = None
+        self.running = set()
+        self.spawns = 0
+        self.refused = 0
+        self.coalesced = 0
+        self.memoized = 0
+        self.serialized = 0
+        self._in_flight = {}
+        self._memo = {}
+        # Path -> deque of mutating commands, the first one running
+        self._path_queues = {}
+
+    def run(self, args, callback=None, timeout=None, progress=None):
+        """Start `odrive <args>` and return its OdriveCommand handle.
+
+        `timeout` defaults to the per-command value of `self.timeouts`. Output
+        is streamed into `progress`, an OdriveProgress, when one is given."""
+        key = tuple(args)
+        if self.health is not None and not self.health.allows(args):
+            # Fail at once rather than wait for a time-out
+            self.refused += 1
+            command = OdriveCommand(args)
+            GLib.idle_add(command._finish, OdriveCommandResult(args, -1, stderr=_("odrive agent not responding")))
+            if callback is not None:
+                command.add_done_callback(callback)
+            return command
+        command = self._in_flight.get(key)
+        if command is not None and self._path_queues.get(self._mutated_path(args), [command])[-1] is not command:
+            # Another command on the same path comes after it: this one must run again
+            command = None
+        if command is not None:
+            self.coalesced += 1
+        else:
+            command = self._memoized(key) or self._spawn(args, timeout, progress)
+        if callback is not None:
+            command.add_done_callback(callback)
+        return command
+
+    def stats(self):
+        return {"spawns": self.spawns, "coalesced": self.coalesced, "memoized": self.memoized,
+                "serialized": self.serialized, "refused": self.refused, "running": len(self.running)}
+
+    def _memoized(self, key):
+        memo = self._memo.get(key)
+        if memo is None:
+            return None
+        result, expires = memo
+        if time.monotonic() >= expires:
+            del self._memo[key]
+            return None
+        self.memoized += 1
+        command = OdriveCommand(key)
+        # Callers never get a result synchronously
+        GLib.idle_add(command._finish, result)
+        return command
+
+    def _spawn(self, args, timeout, progress):
+        key = tuple(args)
+        if timeout is None:
+            timeout = self.timeouts.get(args[0], ODRIVE_DEFAULT_TIMEOUT)
+        if self.agent_client is not None and self.agent_client.supports(args) and self.agent_client.available():
+            command = self.agent_client.command(args, timeout, progress)
+        else:
+            command = OdriveCommand(args, timeout, progress)
+        self._in_flight[key] = command
+        self.running.add(command)
+        command.add_done_callback(lambda result: self._on_done(command, result))
+
+        path = self._mutated_path(args)
+        if path is None:
+            self._start(command)
+            return command
+        queue = self._path_queues.setdefault(path, collections.deque())
+        queue.append(command)
+        if len(queue) == 1:
+            self._start(command)
+        else:
+            self.serialized += 1
+        return command
+
+    def _start(self, command):
+        self.spawns += 1
+        command.start()
+
+    @staticmethod
+    def _mutated_path(args):
+        if args[0] in ODRIVE_READ_ONLY_COMMANDS or len(args) < 2:
+            return None
+        # A placeholder and the item it stands for are the same thing to odrive
+        path = os.path.normpath(args[1])
+        for extension in (".cloudf", ".cloud"):
+            if path.endswith(extension):
+                return path[:-len(extension)]
+        return path
+
+    def _on_done(self, command, result):
+        key = tuple(command.args)
+        if self._in_flight.get(key) is command:
+            del self._in_flight[key]
+        self.running.discard(command)
+        if key == AGENT_PROBE_ARGS:
+            # Probes report to the health monitor themselves, and must never be answered from memory
+            return
+        if self.health is not None:
+            self.health.record(result)
+        if command.args[0] in ODRIVE_READ_ONLY_COMMANDS:
+            if result.succeeded:
+                self._memo[key] = (result, time.monotonic() + ODRIVE_QUERY_MEMO_TTL)
+            return
+        # Whatever was read before may have changed
+        self._memo.clear()
+        path = self._mutated_path(command.args)
+        queue = self._path_queues.get(path)
+        if queue and queue[0] is command:
+            queue.popleft()
+            # Skip the commands cancelled while they were waiting
+            while queue and queue[0].done():
+                queue.popleft()
+            if queue:
+                self._start(queue[0])
+            else:
+                del self._path_queues[path]
+
+    def cancel(self, args):
+        """Cancel `odrive <args>` if it is in flight"""
+        command = self._in_flight.get(tuple(args))
+        if command is not None:
+            command.cancel()
+
+    def forget(self, path):
+        """Drop the memoized queries about `path` and its folder, which changed on disk"""
+        paths = (path, os.path.dirname(path))
+        for key in [key for key in self._memo if len(key) > 1 and os.path.normpath(key[1]) in paths]:
+            del self._memo[key]
+
+    def cancel_all(self):
+        for command in list(self.running):
+            command.cancel()
+        if self.agent_client is not None:
+            self.agent_client.close()
+
+
+_AGENT_DOWN = re.compile(r"agent\b.*\b(not running|unable to connect|could not connect|not responding|refused)",
+                         re.IGNORECASE)
+
+
+class OdriveAgentHealth(object):
+    """Periodic probe of the odrive agent, with a circuit breaker.
+
+    The agent is probed with `odrive status` every AGENT_PROBE_INTERVAL
+    seconds; results of every other command count as well. After
+    AGENT_BREAKER_THRESHOLD failures in a row (time-outs, unreachable agent)
+    the breaker opens: the engine fails commands at once instead of running
+    them, and probes are spaced exponentially up to AGENT_PROBE_MAX_INTERVAL.
+    The first successful probe closes it again. `on_change()` is called when
+    the state or the activation of the agent changes."""
+
+    UNKNOWN = "unknown"
+    HEALTHY = "healthy"
+    OPEN = "open"
+
+    def __init__(self, engine, on_change=None):
+        self.engine = engine
+        self.on_change = on_change
+        self.state = OdriveAgentHealth.UNKNOWN
+        self.activated = None
+        self.failures = 0
+        self.probes = 0
+        self._probing = False
+        self._probe_source = 0
+        engine.health = self
+
+    def allows(self, args):
+        """Whether `odrive <args>` may run now; probes always may"""
+        return self.state != OdriveAgentHealth.OPEN or tuple(args) == AGENT_PROBE_ARGS
+
+    def start(self):
+        self.probe()
+
+    def stop(self):
+        if self._probe_source:
+            GLib.source_remove(self._probe_source)
+            self._probe_source = 0
+
+    def probe(self):
+        if self._probing:
+            return False
+        self._probe_source = 0
+        self._probing = True
+        self.probes += 1
+        self.engine.run(list(AGENT_PROBE_ARGS), self._on_probed, timeout=AGENT_PROBE_TIMEOUT)
+        return False
+
+    def record(self, result):
+        """Account for the result of any odrive command"""
+        if result.cancelled:
+            return
+        if result.timed_out or result.exit_code < 0 or _AGENT_DOWN.search(result.stderr or result.stdout or ""):
+            self._failed()
+        elif self.state != OdriveAgentHealth.OPEN:
+            # Only a probe closes an open breaker
+            self.failures = 0
+            self._set_state(OdriveAgentHealth.HEALTHY)
+
+    def _on_probed(self, result):
+        self._probing = False
+        if result.succeeded and not _AGENT_DOWN.search(result.stderr or result.stdout):
+            self.failures = 0
+            activated = None
+            match = re.search(r"isActivated:\s*(\w+)", result.stdout)
+            if match:
+                activated = match.group(1).lower() == "true"
+            changed = activated != self.activated
+            self.activated = activated
+            self._set_state(OdriveAgentHealth.HEALTHY, changed)
+        elif not result.cancelled:
+            self._failed()
+        interval = AGENT_PROBE_INTERVAL
+        if self.state == OdriveAgentHealth.OPEN:
+            interval = min(AGENT_PROBE_MAX_INTERVAL,
+                           AGENT_PROBE_RETRY * 2 ** max(0, self.failures - AGENT_BREAKER_THRESHOLD))
+        self.stop()
+        self._probe_source = GLib.timeout_add_seconds(interval, self.probe)
+
+    def _failed(self):
+        self.failures += 1
+        if self.failures >= AGENT_BREAKER_THRESHOLD and self.state != OdriveAgentHealth.OPEN:
+            instrumentation.warning("odrive agent not responding after {} failures", self.failures)
+            self._set_state(OdriveAgentHealth.OPEN)
+
+    def _set_state(self, state, changed=False):
+        if state != self.state:
+            self.state = state
+            changed = True
+        if changed and self.on_change is not None:
+            self.on_change()
+
+
+class _HelperProgress(OdriveProgress):
+    """Progress of a command run by the helper, forwarding each line to the client that asked for it"""
+
+    def __init__(self, send):
+        super(_HelperProgress, self).__init__()
+        self.send = send
+
+    def feed(self, line, error=False):
+        super(_HelperProgress, self).feed(line, error)
+        line = line.rstrip("\r\n")
+        if line:
+            self.send("Error" if error else "Status", line)
+
+
+class OdriveHelper(object):
+    """Session helper serving the odrive commands of every Nautilus process over a Unix socket.
+
+    Requests follow the agent protocol, one JSON object per line:
+    `{"command": "run", "parameters": {"args": [...], "timeout": ...}}`,
+    `{"command": "cancel", "parameters": {"args": [...]}}` or
+    `{"command": "stats"}`. They are answered by "Status"/"Error" messages and
+    a "Done" message carrying the exit code. Every request goes through one
+    OdriveCommandEngine, so requests from all windows are coalesced, and a
+    command keeps running when the client that started it disconnects. The
+    helper stops once it has served no request and run no command for
+    `idle_exit` seconds, even with clients connected: they keep idle
+    connections open, and start a new helper when they need one again."""
+
+    def __init__(self, path, engine, idle_exit=HELPER_IDLE_EXIT, on_exit=None):
+        self.path = path
+        self.engine = engine
+        self.idle_exit = idle_exit
+        self.on_exit = on_exit
+        self.clients = 0
+        self.requests = 0
+        self._serving = 0
+        self._service = None
+        self._idle_since = time.monotonic()
+        self._idle_source = 0
+
+    def start(self):
+        """Listen on `path`; returns False when another helper already does, or when its folder is not private"""
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        except OSError as error:
+            instrumentation.error("Unable to create {}: {}", directory, error)
+            return False
+        if not _is_private_directory(directory):
+            instrumentation.error("Not listening on {}: {} is not a private folder of this user", self.path, directory)
+            return False
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                return False
+            except OSError:
+                # Left behind by a helper that did not exit cleanly
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        self._service = Gio.SocketService()
+        try:
+            self._service.add_address(Gio.UnixSocketAddress.new(self.path), Gio.SocketType.STREAM,
+                                      Gio.SocketProtocol.DEFAULT, None)
+        except GLib.Error as error:
+            instrumentation.error("Unable to listen on {}: {}", self.path, error.message)
+            return False
+        os.chmod(self.path, 0o600)
+        self._service.connect("incoming", self._on_incoming)
+        self._service.start()
+        self._idle_source = GLib.timeout_add_seconds(max(1, min(HELPER_IDLE_CHECK, self.idle_exit)),
+                                                     self._check_idle)
+        return True
+
+    def stop(self):
+        if self._idle_source:
+            GLib.source_remove(self._idle_source)
+            self._idle_source = 0
+        if self._service is not None:
+            self._service.stop()
+            self._service.close()
+            self._service = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _on_incoming(self, _service, connection, _source_object):
+        self.clients += 1
+        self._read_request(connection, Gio.DataInputStream.new(connection.get_input_stream()))
+        return True
+
+    def _read_request(self, connection, reader):
+        reader.read_line_async(GLib.PRIORITY_DEFAULT, None, self._on_request, connection)
+
+    def _on_request(self, reader, task, connection):
+        try:
+            line, _length = reader.read_line_finish_utf8(task)
+        except GLib.Error:
+            line = None
+        if line is None:
+            self.clients -= 1
+            connection.close(None)
+            return
+
+        def next_request():
+            self._read_request(connection, reader)
+
+        try:
+            request = json.loads(line)
+            handler = {"run": self._run, "cancel": self._cancel, "stats": self._stats}[request["command"]]
+        except (ValueError, KeyError, TypeError) as error:
+            self._send(connection, "Error", "Invalid request: {}".format(error))
+            self._send(connection, "Done", "", exitCode=1)
+            next_request()
+            return
+        self.requests += 1
+        self._serving += 1
+
+        def on_served():
+            self._serving -= 1
+            self._idle_since = time.monotonic()
+            next_request()
+
+        handler(connection, request.get("parameters") or {}, on_served)
+
+    def _run(self, connection, parameters, next_request):
+        args = [str(arg) for arg in parameters.get("args") or ()]
+        if not args:
+            self._send(connection, "Error", "No command")
+            self._send(connection, "Done", "", exitCode=1)
+            next_request()
+            return
+        progress = None
+        if args[0] not in ODRIVE_READ_ONLY_COMMANDS:
+            # Long commands: output goes to the client as it comes
+            progress = _HelperProgress(lambda message_type, text: self._send(connection, message_type, text))
+        command = self.engine.run(args, timeout=parameters.get("timeout"), progress=progress)
+
+        def on_done(result):
+            if command.progress is not progress or progress is None:
+                # Shared with another request, or not streamed
+                for line in result.stdout.splitlines():
+                    self._send(connection, "Status", line)
+                for line in result.stderr.splitlines():
+                    self._send(connection, "Error", line)
+            self._send(connection, "Done", "", exitCode=result.exit_code)
+            next_request()
+
+        command.add_done_callback(on_done)
+
+    def _cancel(self, connection, parameters, next_request):
+        self.engine.cancel(parameters.get("args") or ())
+        self._send(connection, "Done", "", exitCode=0)
+        next_request()
+
+    def _stats(self, connection, _parameters, next_request):
+        stats = dict(self.engine.stats(), clients=self.clients, requests=self.requests)
+        self._send(connection, "Status", json.dumps(stats))
+        self._send(connection, "Done", "", exitCode=0)
+        next_request()
+
+    @staticmethod
+    def _send(connection, message_type, message, **extra):
+        payload = dict(extra, messageType=message_type, message=message)
+        try:
+            connection.get_output_stream().write_all((json.dumps(payload) + "\n").encode("utf-8"), None)
+        except GLib.Error:
+            # The client went away, the command goes on
+            pass
+
+    def _check_idle(self):
+        if self._serving or self.engine.running:
+            self._idle_since = time.monotonic()
+        elif time.monotonic() - self._idle_since >= self.idle_exit:
+            self._idle_source = 0
+            if self.on_exit is not None:
+                self.on_exit()
+            return False
+        return True
+
+
+class OdriveJob(object):
+    """A queued odrive command, tracked by OdriveJobQueue"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, args, size=0, batch=0, depth=0):
+        self.args = list(args)
+        self.key = tuple(args)
+        self.size = size
+        self.batch = batch
+        self.depth = depth
+        self.state = OdriveJob.QUEUED
+        self.result = None
+        self.command = None
+        self.progress = OdriveProgress()
+        self.callbacks = []
+
+    def sort_key(self):
+        # Newest selection first, then shallowest and smallest items first
+        return -self.batch, self.depth, self.size
+
+
+class OdriveJobQueue(object):
+    """Runs odrive jobs concurrently, at most `max_concurrent` at a time.
+
+    Jobs are prioritised by selection (the most recent `submit` call wins)
+    and then by depth in the tree and size. Submitting a job identical to one
+    already queued or running returns the existing job instead of scheduling it
+    twice. A failed job does not stop the others."""
+
+    def __init__(self, engine, max_concurrent=ODRIVE_MAX_CONCURRENT_JOBS, on_change=None):
+        self.engine = engine
+        self.max_concurrent = max_concurrent
+        self.on_change = on_change
+        self.jobs = {}
+        self._heap = []
+        self._running = set()
+        self._batches = itertools.count(1)
+        self._sequence = itertools.count()
+
+    def new_batch(self):
+        """Reserve a batch number, for work submitted over time that must keep one priority"""
+        return next(self._batches)
+
+    def submit(self, jobs, callback=None, batch=None, depth=0):
+        """Queue a selection of `(args, size)` pairs as one batch; returns the jobs"""
+        if batch is None:
+            batch = self.new_batch()
+        submitted = []
+        for args, size in jobs:
+            job = self.jobs.get(tuple(args))
+            if job is None or job.state not in (OdriveJob.QUEUED, OdriveJob.RUNNING):
+                job = OdriveJob(args, size, batch, depth)
+                self.jobs[job.key] = job
+                heapq.heappush(self._heap, (job.sort_key(), next(self._sequence), job))
+            elif job.state == OdriveJob.QUEUED and batch > job.batch:
+                # Re-selected by the user: bump it to the front of the queue
+                job.batch = batch
+                heapq.heappush(self._heap, (job.sort_key(), next(self._sequence), job))
+            if callback is not None:
+                job.callbacks.append(callback)
+            submitted.append(job)
+        self._schedule()
+        return submitted
+
+    def cancel(self, job):
+        if job.state == OdriveJob.QUEUED:
+            job.state = OdriveJob.CANCELLED
+            self._run_callbacks(job)
+            self._notify()
+        elif job.state == OdriveJob.RUNNING:
+            job.command.cancel()
+
+    def cancel_all(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job)
+
+    def get_state(self, args):
+        job = self.jobs.get(tuple(args))
+        return job.state if job is not None else None
+
+    def counts(self):
+        """Number of jobs per state"""
+        counts = dict.fromkeys((OdriveJob.QUEUED, OdriveJob.RUNNING, OdriveJob.DONE,
+                                OdriveJob.FAILED, OdriveJob.CANCELLED), 0)
+        for job in self.jobs.values():
+            counts[job.state] += 1
+        return counts
+
+    def is_busy(self):
+        return bool(self._running) or any(job.state == OdriveJob.QUEUED for job in self.jobs.values())
+
+    def _schedule(self):
+        while self._heap and len(self._running) < self.max_concurrent:
+            sort_key, _sequence, job = heapq.heappop(self._heap)
+            # Skip cancelled jobs and outdated entries left by a priority bump
+            if job.state != OdriveJob.QUEUED or sort_key != job.sort_key():
+                continue
+            job.state = OdriveJob.RUNNING
+            self._running.add(job)
+            job.command = self.engine.run(job.args, lambda result, job=job: self._on_job_done(job, result),
+                                          progress=job.progress)
+        self._notify()
+
+    def _on_job_done(self, job, result):
+        self._running.discard(job)
+        job.result = result
+        if result.cancelled:
+            job.state = OdriveJob.CANCELLED
+        elif result.succeeded:
+            job.state = OdriveJob.DONE
+        else:
+            job.state = OdriveJob.FAILED
+        self._run_callbacks(job)
+        self._forget_finished()
+        self._schedule()
+
+    def _run_callbacks(self, job):
+        callbacks, job.callbacks = job.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception as error:
+                instrumentation.error("odrive job callback failed: {}", error)
+
+    def _forget_finished(self):
+        # Keep the table bounded once the queue drains
+        if not self._running and not self._heap:
+            self.jobs = {}
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change()
+
+
+class OdriveTreeWalk(object):
+    """Walks directory trees with os.scandir, a few entries per idle call.
+
+    `on_entry(entry, depth)` is called for every entry and returns True to
+    walk into it (a directory); `on_done()` is called once every directory
+    added has been walked. Only the open directory and the ones still to visit
+    are held in memory."""
+
+    def __init__(self, on_entry, on_done=None, batch=WALK_SCAN_BATCH):
+        self.on_entry = on_entry
+        self.on_done = on_done
+        self.batch = batch
+        self._queue = collections.deque()
+        self._current = None
+        self._source = 0
+
+    def add(self, directory, depth=0):
+        self._queue.append((directory, depth))
+        if not self._source:
+            self._source = GLib.idle_add(self._step, priority=GLib.PRIORITY_LOW)
+
+    def is_running(self):
+        return bool(self._source)
+
+    def stop(self):
+        self._queue.clear()
+        self._close()
+        if self._source:
+            GLib.source_remove(self._source)
+            self._source = 0
+
+    def _step(self):
+        for _ in range(self.batch):
+            if self._current is None:
+                if not self._queue:
+                    self._source = 0
+                    if self.on_done is not None:
+                        self.on_done()
+                    return False
+                directory, depth = self._queue.popleft()
+                try:
+                    self._current = (os.scandir(directory), depth)
+                except OSError as error:
+                    instrumentation.warning("Unable to scan {}: {}", directory, error)
+                    continue
+
+            iterator, depth = self._current
+            try:
+                entry = next(iterator)
+            except StopIteration:
+                self._close()
+                continue
+            except OSError as error:
+                instrumentation.warning("Unable to scan: {}", error)
+                self._close()
+                continue
+
+            if self.on_entry(entry, depth + 1):
+                self._queue.append((entry.path, depth + 1))
+        return True
+
+    def _close(self):
+        if self._current is not None:
+            self._current[0].close()
+            self._current = None
+
+
+class OdriveSyncPlan(object):
+    """Recursive sync of a folder, planned locally instead of one `odrive sync --recursive`.
+
+    The tree is walked with os.scandir in small idle-time slices, without ever
+    holding it in memory. `.cloudf` folders are expanded (synced) level by
+    level, then scanned in turn; `.cloud` files are downloaded unless
+    `no_download` is set. Every odrive call goes through the job queue, so
+    downloads run in parallel, shallowest and smallest first by the remote
+    sizes of `remote_sizes(directory, callback)` (see
+    OdriveSyncStateResolver.remote_sizes).
+
+    Progress lives in the filesystem itself: placeholders left are the work
+    left, so a plan interrupted by a Nautilus restart resumes by walking the
+    same root again."""
+
+    def __init__(self, root, no_download, job_queue, remote_sizes=None, on_progress=None, on_finished=None):
+        self.root = root
+        self.no_download = no_download
+        self.job_queue = job_queue
+        self.remote_sizes = remote_sizes
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.batch = job_queue.new_batch()
+        self.discovered = 0
+        self.done = 0
+        self.failed = 0
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self._outstanding = 0
+        # Remote sizes of the folder being walked, and the files of folders waiting for theirs
+        self._sizes = {}
+        self._waiting_sizes = {}
+        self._walk = OdriveTreeWalk(self._on_entry, self._on_walked)
+
+    @property
+    def directory(self):
+        """The folder the plan walks, once its placeholder (if any) is expanded"""
+        if self.root.endswith(".cloudf"):
+            return self.root[:-len(".cloudf")]
+        return self.root
+
+    def start(self):
+        if self.root.endswith(".cloudf") and os.path.exists(self.root):
+            self._sync(self.root, 0, expand=True)
+        elif os.path.isdir(self.directory):
+            self._walk.add(self.directory, 0)
+        self._check_finished()
+        return self
+
+    def cancel(self):
+        """Stop walking and cancel the jobs of the plan; it finishes once the running ones are over
+
+        >>> import tempfile
+        >>> finished = []
+        >>> plan = OdriveSyncPlan(tempfile.mkdtemp(), False, OdriveJobQueue(None), on_finished=finished.append).start()
+        >>> plan.is_finished(), finished
+        (False, [])
+        >>> plan.cancel()
+        >>> finished == [plan]
+        True
+        """
+        self.cancelled = True
+        self._walk.stop()
+        # Files waiting for the sizes of their folder are dropped, not synced
+        self._outstanding -= sum(len(waiting) for waiting in self._waiting_sizes.values())
+        self._waiting_sizes.clear()
+        for job in list(self.job_queue.jobs.values()):
+            if job.batch == self.batch:
+                self.job_queue.cancel(job)
+        # The walk never reports once stopped
+        self._check_finished()
+
+    def remaining(self):
+        return self.discovered - self.done - self.failed
+
+    def rate(self):
+        """Items synced per second since the plan started"""
+        elapsed = time.monotonic() - self.started_at
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def is_finished(self):
+        return not self._outstanding and not self._walk.is_running()
+
+    def _sync(self, path, depth, expand=False, size=0):
+        self.discovered += 1
+        self._outstanding += 1
+        self.job_queue.submit([(["sync", path], size)],
+                              lambda job: self._on_synced(job, path, depth, expand),
+                              batch=self.batch, depth=depth)
+
+    def _on_synced(self, job, path, depth, expand):
+        self._outstanding -= 1
+        if job.state == OdriveJob.DONE:
+            self.done += 1
+            if expand and not self.cancelled:
+                self._walk.add(path[:-len(".cloudf")], depth)
+        else:
+            self.failed += 1
+        self._report()
+        self._check_finished()
+
+    def _on_entry(self, entry, depth):
+        if entry.name.endswith(".cloudf"):
+            self._sync(entry.path, depth, expand=True)
+        elif entry.name.endswith(".cloud"):
+            if not self.no_download:
+                self._sync_file(entry.path, depth)
+        else:
+            # Already synced folders may still hold placeholders
+            return entry.is_dir(follow_symlinks=False)
+        return False
+
+    def _sync_file(self, path, depth):
+        directory = os.path.dirname(path)
+        if self.remote_sizes is None or directory in self._sizes:
+            self._sync(path, depth, size=_job_size(path, self._sizes.get(directory, {}).get(path)))
+            return
+        waiting = self._waiting_sizes.setdefault(directory, [])
+        waiting.append((path, depth))
+        self._outstanding += 1
+        if len(waiting) == 1:
+            self.remote_sizes(directory, lambda sizes: self._on_sizes(directory, sizes))
+
+    def _on_sizes(self, directory, sizes):
+        # The walk is done with the folders before it
+        self._sizes = {directory: sizes}
+        for path, depth in self._waiting_sizes.pop(directory, []):
+            self._outstanding -= 1
+            if not self.cancelled:
+                self._sync(path, depth, size=_job_size(path, sizes.get(path)))
+        self._check_finished()
+
+    def _on_walked(self):
+        self._report()
+        self._check_finished()
+
+    def _report(self):
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def _check_finished(self):
+        if self.is_finished() and self.on_finished is not None:
+            on_finished, self.on_finished = self.on_finished, None
+            on_finished(self)
+
+
+class OdriveReclaimPlan(object):
+    """Frees up at least `target` bytes under `root` by unsyncing its coldest files.
+
+    The folder is walked with OdriveTreeWalk and every synced file not
+    accessed for RECLAIM_MIN_IDLE_DAYS days, nor matching one of the
+    `excludes` patterns, is a candidate. Candidates are ranked by how long
+    they have been idle (in power-of-two buckets of days) and then by size,
+    largest first, so the target is reached with as few files as possible;
+    files not needed to reach it are dropped again.
+
+    `on_planned(plan)` is called once `selected` holds the files to unsync: it
+    is a dry run until `execute` is called. Access times are only as accurate
+    as the mount options (relatime) allow."""
+
+    def __init__(self, root, target, excludes=RECLAIM_EXCLUDES, on_planned=None):
+        self.root = root
+        self.target = target
+        self.excludes = list(excludes)
+        self.on_planned = on_planned
+        self.candidates = []
+        self.selected = []
+        self.freed = 0
+        self.unsynced = 0
+        self.failed = 0
+        self._walk = OdriveTreeWalk(self._on_entry, self._on_walked)
+
+    @property
+    def selected_size(self):
+        return sum(size for _path, size, _atime in self.selected)
+
+    def start(self):
+        self._walk.add(self.root, 0)
+        return self
+
+    def cancel(self):
+        self._walk.stop()
+
+    def is_excluded(self, path):
+        name = os.path.basename(path)
+        relative = os.path.relpath(path, self.root)
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative, pattern)
+                   for pattern in self.excludes)
+
+    def execute(self, job_queue, callback=None, on_finished=None):
+        """Unsync the selected files, RECLAIM_BATCH_SIZE jobs at a time.
+
+        `callback(job)` is called for each job, `on_finished(plan)` at the end."""
+        pending = collections.deque(self.selected)
+        batch = job_queue.new_batch()
+
+        def on_job_done(job, size, chunk):
+            if job.state == OdriveJob.DONE:
+                self.unsynced += 1
+                self.freed += size
+            else:
+                self.failed += 1
+                if job.state == OdriveJob.CANCELLED:
+                    pending.clear()
+            if callback is not None:
+                callback(job)
+            chunk.discard(job.key)
+            if not chunk:
+                submit_chunk()
+
+        def submit_chunk():
+            jobs = []
+            while pending and len(jobs) < RECLAIM_BATCH_SIZE:
+                path, size, atime = pending.popleft()
+                try:
+                    # Opened since the dry run: it is not cold any more
+                    if os.stat(path).st_atime > atime:
+                        continue
+                except OSError:
+                    continue
+                jobs.append((path, size))
+            if not jobs:
+                if on_finished is not None:
+                    on_finished(self)
+                return
+            chunk = set(("unsync", path) for path, _size in jobs)
+            for path, size in jobs:
+                job_queue.submit([(["unsync", path], size)],
+                                 lambda job, size=size: on_job_done(job, size, chunk), batch=batch)
+
+        submit_chunk()
+
+    def _on_entry(self, entry, depth):
+        if entry.name.endswith((".cloud", ".cloudf")) or self.is_excluded(entry.path):
+            return False
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                return True
+            if not entry.is_file(follow_symlinks=False):
+                return False
+            entry_stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            return False
+        # Blocks actually used on disk, sparse files free less than their size
+        self.candidates.append((entry.path, entry_stat.st_blocks * 512, entry_stat.st_atime))
+        return False
+
+    def _on_walked(self):
+        self.selected = self._select(time.time())
+        self.candidates = []
+        if self.on_planned is not None:
+            self.on_planned(self)
+
+    def _select(self, now):
+        min_idle = RECLAIM_MIN_IDLE_DAYS * 24 * 3600
+
+        def rank(candidate):
+            _path, size, atime = candidate
+            idle_days = int((now - atime) // (24 * 3600))
+            return -idle_days.bit_length(), -size
+
+        selected = []
+        total = 0
+        for candidate in sorted((candidate for candidate in self.candidates if now - candidate[2] >= min_idle),
+                                key=rank):
+            if total >= self.target:
+                break
+            selected.append(candidate)
+            total += candidate[1]
+        # Drop the files the target can do without, least cold and smallest first
+        for index in range(len(selected) - 1, -1, -1):
+            if total - selected[index][1] >= self.target:
+                total -= selected[index][1]
+                del selected[index]
+        return selected
+
+
+_SIZE_TEXT = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(?:([kmgt])(i)?)?b?\s*$", re.IGNORECASE)
+
+
+def _parse_size(text):
+    """Bytes in a size such as "500 MB", "1.5G" or "2 GiB", None if it cannot be read"""
+    match = _SIZE_TEXT.match(text)
+    if match is None:
+        return None
+    number, prefix, binary = match.groups()
+    power = "kmgt".index(prefix.lower()) + 1 if prefix else 0
+    return int(float(number) * (1024 if binary else 1000) ** power)
+
+
+class OdriveSettings(object):
+    """User settings, read from $XDG_CONFIG_HOME/odrive-nautilus/settings.ini on first use"""
+
+    DEFAULTS = {
+        "prefetch": {
+            "enabled": "false",
+            "threshold_mb": str(PREFETCH_THRESHOLD_MB),
+            "max_total_mb": str(PREFETCH_MAX_TOTAL_MB),
+            "max_concurrent": str(PREFETCH_MAX_CONCURRENT),
+        },
+        "log": {
+            "level": LOG_LEVEL,
+            "metrics_file": "",
+        },
+    }
+
+    def __init__(self, path=None):
+        if path is None:
+            config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+            path = os.path.join(config_home, "odrive-nautilus", "settings.ini")
+        self.path = path
+        self._parser = None
+
+    def _load(self):
+        if self._parser is None:
+            self._parser = configparser.ConfigParser()
+            self._parser.read_dict(self.DEFAULTS)
+            try:
+                self._parser.read(self.path)
+            except configparser.Error as error:
+                instrumentation.warning("Unable to read {}: {}", self.path, error)
+        return self._parser
+
+    def get(self, section, option):
+        return self._load().get(section, option)
+
+    def get_boolean(self, section, option):
+        try:
+            return self._load().getboolean(section, option)
+        except ValueError:
+            return self.DEFAULTS[section][option] == "true"
+
+    def get_int(self, section, option):
+        try:
+            return self._load().getint(section, option)
+        except ValueError:
+            return int(self.DEFAULTS[section][option])
+
+    def set(self, section, option, value):
+        parser = self._load()
+        parser.set(section, option, str(value).lower() if isinstance(value, bool) else str(value))
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as settings_file:
+                parser.write(settings_file)
+        except OSError as error:
+            instrumentation.warning("Unable to write {}: {}", self.path, error)
+
+
+def _configure_instrumentation(settings, level=None, metrics_path=None):
+    """Set logging and metrics up from the arguments, else the environment, else the settings"""
+    instrumentation.configure(level or os.environ.get("ODRIVE_NAUTILUS_LOG") or settings.get("log", "level"),
+                              metrics_path or os.environ.get("ODRIVE_NAUTILUS_METRICS")
+                              or settings.get("log", "metrics_file"))
+
+
+class OdriveResourceMonitor(object):
+    """Tells whether background downloads are welcome: not on battery, nor on a metered or missing network.
+
+    The network side comes from Gio.NetworkMonitor, the battery side from
+    UPower's OnBattery property on the system bus. Both can be swapped for
+    stand-ins with the same interface, and `on_change()` is called whenever
+    the answer may have changed."""
+
+    def __init__(self, network_monitor=None, upower=True, on_change=None):
+        self.network_monitor = network_monitor or Gio.NetworkMonitor.get_default()
+        self.on_change = on_change
+        self.on_battery = False
+        self._upower = None
+        self.network_monitor.connect("network-changed", lambda monitor, available: self._changed())
+        self.network_monitor.connect("notify::network-metered", lambda monitor, pspec: self._changed())
+        if upower:
+            Gio.DBusProxy.new_for_bus(Gio.BusType.SYSTEM, Gio.DBusProxyFlags.DO_NOT_AUTO_START, None,
+                                      "org.freedesktop.UPower", "/org/freedesktop/UPower", "org.freedesktop.UPower",
+                                      None, self._on_upower_proxy)
+
+    def allows_background_work(self):
+        return (self.network_monitor.get_network_available() and not self.network_monitor.get_network_metered()
+                and not self.on_battery)
+
+    def _on_upower_proxy(self, _source, task):
+        try:
+            self._upower = Gio.DBusProxy.new_for_bus_finish(task)
+        except GLib.Error as error:
+            instrumentation.info("UPower unavailable, battery state unknown: {}", error.message)
+            return
+        self._upower.connect("g-properties-changed", lambda proxy, changed, invalidated: self._read_battery())
+        self._read_battery()
+
+    def _read_battery(self):
+        on_battery = self._upower.get_cached_property("OnBattery")
+        self.on_battery = bool(on_battery is not None and on_battery.unpack())
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+
+class OdrivePrefetcher(object):
+    """Downloads the small placeholders of the folders the user opens, in background.
+
+    Placeholders up to `threshold` bytes are queued as the lowest priority
+    jobs of the job queue (any user action goes first), at most
+    `max_concurrent` at a time and `max_total` bytes per session. Sizes are
+    the remote ones, from `remote_sizes(directory, callback)` (see
+    OdriveSyncStateResolver.remote_sizes); placeholders of unknown size are
+    skipped. Nothing new is started while `monitor` does not allow
+    background work; it resumes when it does again."""
+
+    def __init__(self, job_queue, monitor, remote_sizes, threshold, max_total, max_concurrent, callback=None):
+        self.job_queue = job_queue
+        self.monitor = monitor
+        self.remote_sizes = remote_sizes
+        self.threshold = threshold
+        self.max_total = max_total
+        self.max_concurrent = max_concurrent
+        self.callback = callback
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self._seen = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._in_flight = 0
+        self._reserved_bytes = 0
+
+    def directory_opened(self, directory):
+        """Called for every file Nautilus shows: cheap once the directory was seen"""
+        if directory in self._seen:
+            return
+        self._seen[directory] = True
+        while len(self._seen) > PREFETCH_SEEN_DIRECTORIES:
+            self._seen.popitem(last=False)
+        self.remote_sizes(directory, lambda sizes: self._on_sizes(directory, sizes))
+
+    def resume(self):
+        """Start what was held back, once background work is allowed again"""
+        self._pump()
+
+    def stop(self):
+        self._pending.clear()
+        self._seen.clear()
+
+    def _on_sizes(self, directory, sizes):
+        if directory not in self._seen:
+            # Stopped meanwhile
+            return
+        # Smallest first, the most files for the budget
+        self._pending.extend(sorted(((path, size) for path, size in sizes.items()
+                                     if path.endswith(".cloud") and size <= self.threshold), key=lambda item: item[1]))
+        self._pump()
+
+    def _pump(self):
+        while (self._pending and self._in_flight < self.max_concurrent
+               and self.monitor.allows_background_work()):
+            path, size = self._pending.popleft()
+            if self.fetched_bytes + self._reserved_bytes + size > self.max_total:
+                self._pending.clear()
+                instrumentation.info("Prefetch budget of {} reached", GLib.format_size(self.max_total))
+                return
+            if not os.path.exists(path):
+                continue
+            self._in_flight += 1
+            self._reserved_bytes += size
+            # Batch 0 comes after every selection made by the user
+            self.job_queue.submit([(["sync", path], size)],
+                                  lambda job, path=path, size=size: self._on_job_done(job, path, size), batch=0)
+
+    def _on_job_done(self, job, path, size):
+        self._in_flight -= 1
+        self._reserved_bytes -= size
+        if job.state == OdriveJob.DONE:
+            self.fetched += 1
+            # Count what was actually downloaded, the remote size may be rounded
+            try:
+                size = os.stat(path[:-len(".cloud")]).st_size
+            except OSError:
+                pass
+            self.fetched_bytes += size
+        if self.callback is not None:
+            self.callback(job)
+        self._pump()
+
+
+class OdriveSyncRule(collections.namedtuple("OdriveSyncRule", ["root", "threshold", "expand"])):
+    """Auto-sync rule of a folder.
+
+    Placeholder files of `root` up to `threshold` bytes in the cloud (of any
+    size when None) are synced; files of unknown remote size only match
+    rules without threshold. With `expand`, so are those of its subfolders,
+    down to AUTOSYNC_MAX_DEPTH levels, and placeholder folders are synced to
+    reach their content.
+
+    >>> rule = OdriveSyncRule("/odrive/Photos", 10 ** 6, False)
+    >>> rule.matches("a.jpg.cloud", 2000, 0), rule.matches("b.raw.cloud", 10 ** 7, 0), rule.matches("c.cloudf", 0, 0)
+    (True, False, False)
+    >>> everything = OdriveSyncRule("/odrive/Photos", None, True)
+    >>> rule.matches("d.jpg.cloud", None, 0), everything.matches("d.jpg.cloud", None, 0)
+    (False, True)
+    >>> everything.matches("c.cloudf", None, 0)
+    True
+    """
+
+    __slots__ = ()
+
+    @property
+    def max_depth(self):
+        return AUTOSYNC_MAX_DEPTH if self.expand else 0
+
+    def matches(self, name, size, depth):
+        """Whether placeholder `name`, `depth` folders below the root and of remote `size`, is to be synced"""
+        if name.endswith(".cloudf"):
+            return depth < self.max_depth
+        return name.endswith(".cloud") and (self.threshold is None or size is not None and size <= self.threshold)
+
+
+class OdriveAutoSync(object):
+    """Applies the auto-sync rules of folders in background, incrementally.
+
+    Every folder covered by a rule is known with the mtime it had when it
+    was last listed; adding or removing a placeholder changes the mtime of
+    its folder. A pass stats the known folders, which does not read them,
+    and only lists those whose mtime changed or that the filesystem monitor
+    reported. The first pass after a rule is set, or after a restart, lists
+    every folder once. Passes run every `interval` seconds, a few folders
+    per idle call, and AUTOSYNC_EVENT_DELAY seconds after a reported change.
+    Placeholder files are matched on their remote size, from
+    `remote_sizes(folder, callback)` (see
+    OdriveSyncStateResolver.remote_sizes).
+
+    Matching placeholders are synced as background jobs of the job queue
+    (batch 0, after anything the user asked for), at most `max_concurrent`
+    at a time and `max_per_minute` started per minute."""
+
+    def __init__(self, job_queue, store, remote_sizes, interval=AUTOSYNC_INTERVAL,
+                 max_concurrent=AUTOSYNC_MAX_CONCURRENT, max_per_minute=AUTOSYNC_MAX_PER_MINUTE, callback=None):
+        self.job_queue = job_queue
+        self.store = store
+        self.remote_sizes = remote_sizes
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.max_per_minute = max_per_minute
+        self.callback = callback
+        self.rules = {}
+        self.passes = 0
+        self.listed = 0
+        self.synced = 0
+        self.failed = 0
+        self.unknown_size = 0
+        # Folder -> (rule root, depth below it, mtime in ns when last listed or None)
+        self._folders = {}
+        self._dirty = set()
+        self._pass = None
+        self._pass_started = 0.0
+        self._step_source = 0
+        self._interval_source = 0
+        self._event_source = 0
+        # (placeholder, rule root, depth, size) waiting for a free slot
+        self._pending = collections.deque()
+        self._queued = set()
+        self._in_flight = 0
+        self._started_at = collections.deque()
+        self._pump_source = 0
+
+    def start(self):
+        for rule in self.store.load_rules():
+            self._add(rule)
+        if self._dirty:
+            self._schedule_pass()
+        self._interval_source = GLib.timeout_add_seconds(self.interval, self._on_interval)
+
+    def stop(self):
+        for source in (self._step_source, self._interval_source, self._event_source, self._pump_source):
+            if source:
+                GLib.source_remove(source)
+        self._step_source = self._interval_source = self._event_source = self._pump_source = 0
+        self._pass = None
+        self._pending.clear()
+
+    def set_rule(self, rule):
+        """Add or replace the rule of `rule.root`, applied right away"""
+        self.store.save_rule(rule)
+        self._drop(rule.root)
+        self._add(rule)
+        self._schedule_pass()
+
+    def remove_rule(self, root):
+        self.store.remove_rule(root)
+        self._drop(root)
+
+    def directories_changed(self, directories):
+        """Called with the folders the filesystem monitor saw changing"""
+        changed = [directory for directory in directories if directory in self._folders]
+        if changed:
+            self._dirty.update(changed)
+            self._schedule_pass()
+
+    def stats(self):
+        return {"rules": len(self.rules), "folders": len(self._folders), "passes": self.passes,
+                "listed": self.listed, "pending": len(self._pending), "synced": self.synced, "failed": self.failed,
+                "unknown_size": self.unknown_size}
+
+    def _add(self, rule):
+        self.rules[rule.root] = rule
+        self._folders[rule.root] = (rule.root, 0, None)
+        self._dirty.add(rule.root)
+
+    def _drop(self, root):
+        if self.rules.pop(root, None) is None:
+            return
+        self._folders = dict((folder, known) for folder, known in self._folders.items() if known[0] != root)
+        self._dirty.intersection_update(self._folders)
+        self._pending = collections.deque(entry for entry in self._pending if entry[1] != root)
+
+    def _schedule_pass(self):
+        if not self._event_source:
+            self._event_source = GLib.timeout_add_seconds(AUTOSYNC_EVENT_DELAY, self._on_event_delay)
+
+    def _on_event_delay(self):
+        self._event_source = 0
+        self._start_pass(list(self._dirty))
+        return False
+
+    def _on_interval(self):
+        self._start_pass(list(self._folders))
+        return True
+
+    def _start_pass(self, folders):
+        if self._pass is not None:
+            # Running already: what it has not checked yet is checked, the rest waits for the next pass
+            return
+        self._pass = collections.deque(folders)
+        self._pass_started = time.monotonic()
+        self._step_source = GLib.idle_add(self._step, priority=GLib.PRIORITY_LOW)
+
+    def _step(self):
+        for _ in range(WALK_SCAN_BATCH):
+            if not self._pass:
+                self._finish_pass()
+                return False
+            folder = self._pass.popleft()
+            known = self._folders.get(folder)
+            if known is None:
+                continue
+            root, depth, mtime = known
+            try:
+                current = os.stat(folder).st_mtime_ns
+            except OSError:
+                # Gone, or unsynced; its subfolders go the same way when they are checked
+                del self._folders[folder]
+                self._dirty.discard(folder)
+                continue
+            if current == mtime and folder not in self._dirty:
+                continue
+            self._dirty.discard(folder)
+            # Recorded before listing: whatever changes meanwhile is seen by the next pass
+            self._folders[folder] = (root, depth, current)
+            self._list(folder, self.rules[root], depth)
+        return True
+
+    def _finish_pass(self):
+        self._step_source = 0
+        self._pass = None
+        self.passes += 1
+        instrumentation.observe("autosync.pass", (time.monotonic() - self._pass_started) * 1000)
+        if self._dirty:
+            self._schedule_pass()
+
+    def _list(self, folder, rule, depth):
+        self.listed += 1
+        files = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".cloud"):
+                        files.append(entry.path)
+                    elif entry.name.endswith(".cloudf"):
+                        if rule.matches(entry.name, None, depth):
+                            self._queue(entry.path, rule.root, depth, sys.maxsize)
+                    elif (depth < rule.max_depth and entry.is_dir(follow_symlinks=False)
+                          and entry.path not in self._folders and entry.path not in self.rules):
+                        # Listed in this same pass
+                        self._folders[entry.path] = (rule.root, depth + 1, None)
+                        self._pass.append(entry.path)
+        except OSError as error:
+            instrumentation.warning("Unable to scan {}: {}", folder, error)
+        if files:
+            # The placeholders are empty files, odrive gives the size of what they stand for
+            self.remote_sizes(folder, lambda sizes: self._on_sizes(rule, depth, files, sizes))
+
+    def _on_sizes(self, rule, depth, files, sizes):
+        if self.rules.get(rule.root) is not rule:
+            # Removed or replaced meanwhile
+            return
+        for path in files:
+            size = sizes.get(path)
+            if rule.matches(os.path.basename(path), size, depth):
+                self._queue(path, rule.root, depth, sys.maxsize if size is None else size)
+            elif size is None:
+                self.unknown_size += 1
+                instrumentation.debug("Not auto-syncing {}: remote size unknown", path)
+
+    def _queue(self, path, root, depth, size):
+        if path in self._queued:
+            return
+        self._queued.add(path)
+        self._pending.append((path, root, depth, size))
+        self._pump()
+
+    def _pump(self):
+        self._pump_source = 0
+        now = time.monotonic()
+        while self._started_at and now - self._started_at[0] >= 60:
+            self._started_at.popleft()
+        while self._pending and self._in_flight < self.max_concurrent:
+            if len(self._started_at) >= self.max_per_minute:
+                # Goes on once the oldest start is a minute old
+                if not self._pump_source:
+                    self._pump_source = GLib.timeout_add_seconds(int(60 - (now - self._started_at[0])) + 1,
+                                                                 self._pump)
+                return False
+            path, root, depth, size = self._pending.popleft()
+            if root not in self.rules or not os.path.exists(path):
+                self._queued.discard(path)
+                continue
+            self._in_flight += 1
+            self._started_at.append(now)
+            self.job_queue.submit(
+                [(["sync", path], size)],
+                lambda job, path=path, root=root, depth=depth: self._on_job_done(job, path, root, depth), batch=0)
+        return False
+
+    def _on_job_done(self, job, path, root, depth):
+        self._in_flight -= 1
+        self._queued.discard(path)
+        if job.state == OdriveJob.DONE:
+            self.synced += 1
+            instrumentation.count("autosync.synced")
+            folder = path[:-len(".cloudf")]
+            if path.endswith(".cloudf") and root in self.rules and os.path.isdir(folder):
+                # Expanded: its content is looked at in a moment
+                self._folders[folder] = (root, depth + 1, None)
+                self.directories_changed([folder])
+        elif job.state == OdriveJob.FAILED:
+            self.failed += 1
+        if self.callback is not None:
+            self.callback(job)
+        self._pump()
+
+
+def _job_size(item_path, remote_size=None):
+    """Size used to order jobs: files by their size, folders after every file.
+
+    Placeholders are empty files: a `.cloud` one weighs `remote_size`, the
+    size odrive reports for the file it stands for, and comes after the
+    files of known size when that is unknown."""
+    if item_path.endswith(".cloudf"):
+        return sys.maxsize
+    if item_path.endswith(".cloud"):
+        return sys.maxsize - 1 if remote_size is None else remote_size
+    try:
+        info = os.lstat(item_path)
+    except OSError:
+        return sys.maxsize
+    if stat.S_ISDIR(info.st_mode):
+        return sys.maxsize
+    return info.st_size
+
+
+# `<local path>  <remote path>  <status>`: the local path ends at the first column gap before a remote path
+_MOUNT_LINE = re.compile(r"^\s*(?P<local>/.*?)(?:\s{2,}/.*)?\s*$")
+
+
+def _parse_odrive_mounts(output):
+    """Extract mount paths from `odrive status --mounts` output
+
+    >>> _parse_odrive_mounts("/home/me/odrive  /  Active\\n/tmp/x/m1  /Dropbox/Work  Active\\n/media/My Disk/od")
+    ['/home/me/odrive', '/tmp/x/m1', '/media/My Disk/od']
+    """
+    mounts = []
+    for line in output.splitlines():
+        result = _MOUNT_LINE.match(line)
+        if result is not None:
+            mounts.append(result.group("local").rstrip())
+    return mounts
+
+
+class OdriveMountIndex(object):
+    """Path-component trie of the odrive mounts.
+
+    Finding the mount owning a path walks the path components once, whatever
+    the number of mounts, and only matches whole components (`/data/odrive`
+    does not own `/data/odrive-backup`)."""
+
+    def __init__(self, mounts=()):
+        self._root = {}
+        self.mounts = []
+        for mount in mounts:
+            self.add(mount)
+
+    @staticmethod
+    def _components(path):
+        return [component for component in os.path.normpath(path).split(os.sep) if component]
+
+    def add(self, mount):
+        node = self._root
+        for component in self._components(mount):
+            node = node.setdefault(component, {})
+        # None can never be a path component, it marks the end of a mount path
+        node[None] = mount
+        self.mounts.append(mount)
+
+    def owning_mount(self, path):
+        """Deepest mount containing `path` (or being `path`), None if there is none"""
+        node = self._root
+        owner = node.get(None)
+        for component in self._components(path):
+            node = node.get(component)
+            if node is None:
+                break
+            owner = node.get(None, owner)
+        return owner
+
+    def is_mount(self, path):
+        node = self._root
+        for component in self._components(path):
+            node = node.get(component)
+            if node is None:
+                return False
+        return None in node
+
+    def classify(self, paths):
+        """Split paths in one pass: returns ({mount: [paths]}, [paths outside any mount])"""
+        by_mount = {}
+        outside = []
+        for path in paths:
+            mount = self.owning_mount(path)
+            if mount is None:
+                outside.append(path)
+            else:
+                by_mount.setdefault(mount, []).append(path)
+        return by_mount, outside
+
+
+class OdriveMountTable(object):
+    """In-process cache of the odrive mount table.
+
+    Mounts are served from memory for `ttl` seconds. Once stale, the cached
+    table is still returned while a fresh one is fetched in the background.
+    A cold table (first lookup, or right after an invalidation) returns None
+    and triggers a fetch; `on_change` is called when the content changes so
+    that callers can rebuild whatever they derived from it."""
+
+    def __init__(self, engine, ttl=MOUNT_TABLE_TTL, on_change=None):
+        self.engine = engine
+        self.ttl = ttl
+        self.on_change = on_change
+        self.hits = 0
+        self.misses = 0
+        self.spawns = 0
+        # Bumped every time the table content changes, usable as a cache key
+        self.version = 0
+        self._mounts = None
+        self._index = None
+        self._fetched_at = 0.0
+        self._refreshing = None
+
+    def get_mounts(self):
+        """Return the mount paths, or None while they are being fetched"""
+        if self._mounts is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        mounts = self._current()
+        return None if mounts is None else list(mounts)
+
+    def _current(self):
+        # The cached list itself, fetching it when missing or stale
+        if self._mounts is None or time.monotonic() - self._fetched_at >= self.ttl:
+            self.refresh_async()
+        return self._mounts
+
+    def seed(self, mounts):
+        """Serve `mounts` (e.g. from a previous session) until the agent has been asked"""
+        if self._mounts is None and mounts:
+            self._mounts = list(mounts)
+            self._index = None
+            # Stale right away: the first lookup triggers a refresh
+            self._fetched_at = -self.ttl
+            self.version += 1
+
+    def get_index(self):
+        """OdriveMountIndex of the current mounts, or None while they are being fetched.
+
+        Called for every file Nautilus shows: neither copies the mounts nor
+        counts as a cache lookup."""
+        mounts = self._current()
+        if mounts is None:
+            return None
+        if self._index is None:
+            self._index = OdriveMountIndex(mounts)
+        return self._index
+
+    def refresh_async(self):
+        """Fetch the mount table from odrive, unless a fetch is already running"""
+        if self._refreshing is not None:
+            return self._refreshing
+        self.spawns += 1
+        self._refreshing = self.engine.run(["status", "--mounts"], self._on_refreshed)
+        return self._refreshing
+
+    def _on_refreshed(self, result):
+        self._refreshing = None
+        if not result.succeeded:
+            instrumentation.warning("Unable to fetch odrive mounts: {}", result.stderr)
+            if self._mounts is None:
+                return
+            mounts = self._mounts
+        else:
+            mounts = _parse_odrive_mounts(result.stdout)
+        self._fetched_at = time.monotonic()
+        if mounts != self._mounts:
+            self._mounts = mounts
+            self._index = None
+            self.version += 1
+            if self.on_change is not None:
+                self.on_change()
+
+    def invalidate(self):
+        """Drop the cached table (e.g. after a mount/unmount) and fetch a new one in background"""
+        self._mounts = None
+        self._index = None
+        self.version += 1
+        self.refresh_async()
+
+    def stats(self):
+        """Cache counters, to check how many odrive spawns are avoided"""
+        return {"hits": self.hits, "misses": self.misses, "spawns": self.spawns}
+
+
+class OdriveSyncState(object):
+    """Normalised odrive sync states"""
+
+    SYNCED = "synced"
+    NOT_SYNCED = "not synced"
+    SYNCING = "syncing"
+    UNKNOWN = "unknown"
+
+    LABELS = {
+        SYNCED: _("Synced"),
+        NOT_SYNCED: _("Not synced"),
+        SYNCING: _("Syncing"),
+        UNKNOWN: _("Unknown"),
+    }
+
+    @staticmethod
+    def from_text(text):
+        """Map a state as printed by `odrive syncstate --textonly`"""
+        text = text.strip().lower()
+        if "not synced" in text or "unsynced" in text or "placeholder" in text:
+            return OdriveSyncState.NOT_SYNCED
+        if "synced" in text:
+            return OdriveSyncState.SYNCED
+        if any(word in text for word in ("active", "syncing", "progress", "uploading", "downloading")):
+            return OdriveSyncState.SYNCING
+        return OdriveSyncState.UNKNOWN
+
+    @staticmethod
+    def from_path(path):
+        """State that can be told from the file name alone, None otherwise"""
+        if path.endswith(".cloud") or path.endswith(".cloudf"):
+            return OdriveSyncState.NOT_SYNCED
+        return None
+
+
+# Names may contain ": " or double spaces, states never do: the state follows the last separator
+_SYNCSTATE_LINE = re.compile(r"^(?P<name>.+)(?::\s+|\t+|\s{2,})(?P<state>\S.*?)\s*$")
+_SYNCSTATE_SIZE = re.compile(r"(?:\s+\(|\t+|\s{2,})(?P<size>\d+(?:\.\d+)?)\s*(?P<unit>[KMGT]i?B|B|bytes)?\)?$")
+
+OdriveSyncstateEntry = collections.namedtuple("OdriveSyncstateEntry", ["name", "state", "size"])
+
+
+def _parse_odrive_syncstate_entries(output):
+    """Entries of `odrive syncstate <path> --textonly` output, the path itself first.
+
+    Every line is `<name>: <state>` (tab or column separated lines are
+    accepted as well), optionally followed by the remote size, in bytes in a
+    column of its own or with a unit between parentheses. The name of the
+    first line, the path itself, is None; sizes are None when not given.
+    Names are taken up to the last separator, so they may contain one.
+
+    >>> entries = _parse_odrive_syncstate_entries(
+    ...     "Synced\\nreport.pdf: Synced (1.5 MB)\\nphotos.cloudf\\tNot synced\\nnotes.txt.cloud  Not synced  2048")
+    >>> [tuple(entry) for entry in entries]  # doctest: +NORMALIZE_WHITESPACE
+    [(None, 'synced', None), ('report.pdf', 'synced', 1500000), ('photos.cloudf', 'not synced', None),
+     ('notes.txt.cloud', 'not synced', 2048)]
+    >>> [entry.name for entry in _parse_odrive_syncstate_entries(
+    ...     "Active\\nMeeting: notes.txt: Synced\\nMy  file.txt  Synced\\nQ3: plan.xlsx.cloud: Not synced (2 KB)")]
+    [None, 'Meeting: notes.txt', 'My  file.txt', 'Q3: plan.xlsx.cloud']
+    >>> [tuple(entry) for entry in _parse_odrive_syncstate_entries(
+    ...     "Été 2023: Synced\\r\\nrésumé.pdf: Synced (12 KB)\\r\\n写真.jpg.cloud: Not synced\\r\\n")]
+    [(None, 'synced', None), ('résumé.pdf', 'synced', 12000), ('写真.jpg.cloud', 'not synced', None)]
+    """
+    entries = []
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    for index, line in enumerate(lines):
+        size = None
+        match = _SYNCSTATE_SIZE.search(line)
+        if match is not None and (match.group("unit") or "\t" in line or "  " in line):
+            unit = match.group("unit") or "B"
+            size = int(float(match.group("size")) * _BYTE_UNITS.get(unit, 1))
+            line = line[:match.start()]
+        if index == 0:
+            result = _SYNCSTATE_LINE.match(line)
+            entries.append(OdriveSyncstateEntry(None, OdriveSyncState.from_text(
+                result.group("state") if result else line), size))
+            continue
+        result = _SYNCSTATE_LINE.match(line)
+        if result is not None:
+            entries.append(OdriveSyncstateEntry(result.group("name").strip(),
+                                                OdriveSyncState.from_text(result.group("state")), size))
+    return entries
+
+
+class OdriveStateStore(object):
+    """On-disk cache of the mounts and last known sync states (SQLite, WAL mode).
+
+    It lets a freshly started Nautilus answer its first right-click and folder
+    view without asking odrive. A stored state is only trusted while the file
+    mtime matches the one recorded with it. The database is opened on first
+    use and writes are batched in a single transaction every
+    STATE_STORE_FLUSH_DELAY milliseconds."""
+
+    # Only stable states are worth keeping across sessions
+    PERSISTED_STATES = (OdriveSyncState.SYNCED, OdriveSyncState.NOT_SYNCED)
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+            path = os.path.join(cache_home, "odrive-nautilus", "state.sqlite")
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._pending = {}
+        self._flush_source = 0
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS mounts (path TEXT PRIMARY KEY)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS states "
+                             "(path TEXT PRIMARY KEY, state TEXT NOT NULL, mtime INTEGER NOT NULL, "
+                             "updated REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sync_plans "
+                             "(root TEXT PRIMARY KEY, nodownload INTEGER NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sync_rules "
+                             "(root TEXT PRIMARY KEY, threshold INTEGER, expand INTEGER NOT NULL)")
+            self._db.execute("DELETE FROM states WHERE updated < ?", (time.time() - STATE_STORE_MAX_AGE,))
+            self._db.commit()
+        return self._db
+
+    def load_mounts(self):
+        """Mounts saved by the previous session, None if there are none"""
+        try:
+            rows = self._connect().execute("SELECT path FROM mounts ORDER BY path").fetchall()
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to read odrive state cache: {}", error)
+            return None
+        return [row[0] for row in rows] or None
 
-standard_library.install_aliases()
-gi.require_version('Nautilus', '3.0')
-gi.require_version("Gtk", "3.0")
+    def save_mounts(self, mounts):
+        try:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM mounts")
+                db.executemany("INSERT INTO mounts (path) VALUES (?)", [(mount,) for mount in mounts])
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
 
-# Odrive nautilus integration 0.0.88
-# Copyright (C) 2022 Casimir Bonnet https://github.com/cazzoo
-#
-# Odrive nautilus integration is free software; you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation; either version 3 of the License, or
-# (at your option) any later version.
-#
-# Odrive nautilus integration is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with Odrive nautilus integration; if not, see http://www.gnu.org/licenses
-# for more information.
+    def load_plans(self):
+        """Recursive syncs left unfinished by the previous session, as (root, no_download) pairs"""
+        try:
+            rows = self._connect().execute("SELECT root, nodownload FROM sync_plans").fetchall()
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to read odrive state cache: {}", error)
+            return []
+        return [(root, bool(no_download)) for root, no_download in rows]
 
-try:
-    from urllib.parse import urlparse, unquote
-    from urllib.request import url2pathname
-except ImportError:
-    # backwards compatibility
-    from urllib.parse import urlparse
-    from urllib.parse import unquote
-    from urllib.request import url2pathname
-
-# Python 2 or 3
-try:
-    from urllib.parse import unquote
-except ImportError:
-    from urllib.parse import unquote
-
-try:
-    from subprocess import CompletedProcess
-except ImportError:
-    # Python 2
-    class CompletedProcess(object):
-
-        def __init__(self, args, return_code, stdout=None, stderr=None):
-            self.args = args
-            self.return_code = return_code
-            self.stdout = stdout
-            self.stderr = stderr
-
-        def check_return_code(self):
-            if self.return_code != 0:
-                err = subprocess.CalledProcessError(self.return_code, self.args, output=self.stdout)
-                raise err
-            return self.return_code
-
-
-    def sp_run(*popenargs, **kwargs):
-        command_input = kwargs.pop("input", None)
-        capture_output = kwargs.pop("capture_output", False)
-        check = kwargs.pop("handle", False)
-        if command_input is not None:
-            if 'stdin' in kwargs:
-                raise ValueError('stdin and input command_arguments may not both be used.')
-            kwargs['stdin'] = subprocess.PIPE
-
-        if capture_output:
-            if kwargs.get('stdout') is not None or kwargs.get('stderr') is not None:
-                raise ValueError('stdout and stderr command_arguments may not be used '
-                                 'with capture_output.')
-            kwargs['stdout'] = subprocess.PIPE
-            kwargs['stderr'] = subprocess.PIPE
-
-        process = subprocess.Popen(*popenargs, **kwargs)
+    def save_plan(self, root, no_download):
         try:
-            outs, errs = process.communicate(command_input)
-        except:
-            process.kill()
-            process.wait()
-            raise
-        return_code = process.poll()
-        if check and return_code:
-            raise subprocess.CalledProcessError(return_code, popenargs, output=outs)
-        return CompletedProcess(popenargs, return_code, stdout=outs, stderr=errs)
+            db = self._connect()
+            with db:
+                db.execute("INSERT OR REPLACE INTO sync_plans (root, nodownload) VALUES (?, ?)",
+                           (root, int(no_download)))
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
 
+    def remove_plan(self, root):
+        try:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM sync_plans WHERE root = ?", (root,))
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
 
-    subprocess.run = sp_run
-    # ^ This monkey patch allows it work on Python 2 or 3 the same way
+    def load_rules(self):
+        """Auto-sync rules of folders, as OdriveSyncRule"""
+        try:
+            rows = self._connect().execute("SELECT root, threshold, expand FROM sync_rules").fetchall()
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to read odrive state cache: {}", error)
+            return []
+        return [OdriveSyncRule(root, threshold, bool(expand)) for root, threshold, expand in rows]
 
-# i18n
-gettext.textdomain('odrive-integration-common')
-_ = gettext.gettext
+    def save_rule(self, rule):
+        try:
+            db = self._connect()
+            with db:
+                db.execute("INSERT OR REPLACE INTO sync_rules (root, threshold, expand) VALUES (?, ?, ?)",
+                           (rule.root, rule.threshold, int(rule.expand)))
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
 
+    def remove_rule(self, root):
+        try:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM sync_rules WHERE root = ?", (root,))
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
 
-def which(file_name):
-    for path in os.environ["PATH"].split(os.pathsep):
-        full_path = os.path.join(path, file_name)
-        if os.path.exists(full_path) and os.access(full_path, os.X_OK):
-            return full_path
-    return None
+    def lookup_directory(self, directory):
+        """Stored states of the children of `directory`, as `{path: state}`, files changed since left out.
 
+        A single query serves every file of a folder Nautilus opens.
 
-def uri_to_path(uri):
-    parsed = urlparse(uri)
-    host = "{0}{0}{mnt}{0}".format(os.path.sep, mnt=parsed.netloc)
-    return os.path.normpath(
-        os.path.join(host, url2pathname(unquote(parsed.path)))
-    )
+        >>> import tempfile
+        >>> store = OdriveStateStore(os.path.join(tempfile.mkdtemp(), "state.sqlite"))
+        >>> directory = tempfile.mkdtemp()
+        >>> for name in ("a.txt", "b.txt"):
+        ...     open(os.path.join(directory, name), "w").close()
+        >>> os.mkdir(os.path.join(directory, "sub"))
+        >>> open(os.path.join(directory, "sub", "c.txt"), "w").close()
+        >>> store.save(dict((os.path.join(directory, name), OdriveSyncState.SYNCED)
+        ...                 for name in ("a.txt", "b.txt", "sub", os.path.join("sub", "c.txt"))))
+        >>> store.close()
+        >>> os.utime(os.path.join(directory, "b.txt"), ns=(0, 0))
+        >>> sorted(os.path.basename(path) for path in store.lookup_directory(directory))
+        ['a.txt', 'sub']
+        >>> store.close()
+        """
+        prefix = os.path.join(directory, "")
+        try:
+            # Paths under the folder sort between "<folder>/" and "<folder>0", those with no further "/" are children
+            rows = self._connect().execute(
+                "SELECT path, state, mtime FROM states WHERE path > ? AND path < ? AND instr(substr(path, ?), '/') = 0",
+                (prefix, prefix[:-1] + "0", len(prefix) + 1)).fetchall()
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to read odrive state cache: {}", error)
+            rows = []
+        states = {}
+        for path, state, mtime in rows:
+            try:
+                if os.stat(path).st_mtime_ns == mtime:
+                    states[path] = state
+            except OSError:
+                pass
+        for path, state in self._pending.items():
+            if os.path.dirname(path) == directory:
+                if state is None:
+                    states.pop(path, None)
+                else:
+                    states[path] = state
+        self.hits += len(states)
+        self.misses += len(rows) - len(states)
+        return states
 
+    def save(self, states):
+        """Queue `{path: state}` for writing, a None state removes the entry"""
+        for path, state in states.items():
+            self._pending[path] = state if state in self.PERSISTED_STATES else None
+        if self._pending and not self._flush_source:
+            self._flush_source = GLib.timeout_add(STATE_STORE_FLUSH_DELAY, self.flush)
 
-odriveClientPath = which("odrive")
-current_path = os.path.dirname(os.path.abspath(__file__))
-abs_exec_path = os.path.dirname(os.path.realpath(__file__))
+    def flush(self):
+        self._flush_source = 0
+        pending, self._pending = self._pending, {}
+        rows = []
+        deleted = []
+        now = time.time()
+        for path, state in pending.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns if state is not None else None
+            except OSError:
+                mtime = None
+            if mtime is None:
+                deleted.append((path,))
+            else:
+                rows.append((path, state, mtime, now))
+        try:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO states (path, state, mtime, updated) VALUES (?, ?, ?, ?)",
+                               rows)
+                db.executemany("DELETE FROM states WHERE path = ?", deleted)
+        except (sqlite3.Error, OSError) as error:
+            instrumentation.warning("Unable to write odrive state cache: {}", error)
+        return False
 
+    def close(self):
+        if self._flush_source:
+            GLib.source_remove(self._flush_source)
+            self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
-class MountPathWindow(Gtk.Window):
-    def __init__(self, caller):
-        super(MountPathWindow, self).__init__(title="Mount remote location")
 
-        self.set_default_size(150, 100)
+class OdriveStateCache(object):
+    """Sync state of paths, each entry being trusted for `ttl` seconds.
 
-        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
-        self.add(vbox)
+    With a `store`, entries are also written to disk, and the first miss in a
+    directory loads what the store has for all of its files, which is what
+    serves the first views after a restart."""
 
-        label_local_path = Gtk.Label(label="Selected local path:\n{}".format(caller.localPath))
-        vbox.pack_start(label_local_path, True, True, 0)
-        self.label = Gtk.Label(
-            label="Please enter remote path for the mount point.\n ex: /Google Drive/Pictures or just / for odrive root")
-        vbox.pack_start(self.label, True, True, 0)
+    def __init__(self, ttl=SYNC_STATE_TTL, store=None):
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        # Directories whose stored states were loaded
+        self._loaded = set()
 
-        self.entry = Gtk.Entry()
-        self.entry.set_text("")
-        vbox.pack_start(self.entry, True, True, 0)
+    def get(self, path):
+        entry = self._entries.get(path)
+        if entry is not None:
+            state, stored_at = entry
+            if time.monotonic() - stored_at < self.ttl:
+                self.hits += 1
+                return state
+            del self._entries[path]
+        elif self.store is not None and os.path.dirname(path) not in self._loaded:
+            directory = os.path.dirname(path)
+            self._loaded.add(directory)
+            now = time.monotonic()
+            for child, state in self.store.lookup_directory(directory).items():
+                self._entries.setdefault(child, (state, now))
+            entry = self._entries.get(path)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        return None
 
-        hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
-        vbox.pack_end(hbox, True, True, 0)
+    def set(self, path, state):
+        self._entries[path] = (state, time.monotonic())
+        if self.store is not None:
+            self.store.save({path: state})
 
-        button1 = Gtk.Button(label="Cancel")
-        button1.connect("clicked", self.on_cancel_clicked, caller)
-        hbox.pack_start(button1, True, True, 0)
+    def set_many(self, states):
+        now = time.monotonic()
+        for path, state in states.items():
+            self._entries[path] = (state, now)
+        if self.store is not None:
+            self.store.save(states)
 
-        button2 = Gtk.Button(label="Ok")
-        button2.connect("clicked", self.on_confirm_clicked, caller)
-        hbox.pack_start(button2, True, True, 0)
+    def invalidate(self, path):
+        self._entries.pop(path, None)
+        if self.store is not None:
+            self.store.save({path: None})
 
-    def on_cancel_clicked(self, widget, caller):
-        caller.windowReturnObject.action = "Cancel"
-        self.destroy()
+    def clear(self):
+        self._entries.clear()
+        self._loaded.clear()
 
-    def on_confirm_clicked(self, widget, caller):
-        print("value from field: " + self.entry.get_text())
-        caller.windowReturnObject.action = "Confirm"
-        caller.windowReturnObject.value = self.entry.get_text()
-        self.destroy()
 
+class OdriveSyncStateResolver(object):
+    """Resolves sync states with a single `odrive syncstate` call per directory.
 
-class FolderSyncOptionsWindow(Gtk.Window):
-    def __init__(self, caller):
-        super(FolderSyncOptionsWindow, self).__init__(title="Folder sync options")
+    Lookups are answered from the file name for placeholders, then from the
+    cache. Anything else is queued per parent directory and resolved on the
+    next main loop iteration, so that every file Nautilus asks about while
+    listing a folder, or every item of a selection, is served by the same
+    odrive call. Directory listings are memoised as long as the states.
 
-        self.set_default_size(300, 200)
+    With `mount_index`, a callable returning the OdriveMountIndex (or None
+    while mounts are unknown), the state of a mount root is read from its own
+    listing, its folder being outside odrive."""
 
-        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
-        self.add(vbox)
+    def __init__(self, engine, cache, mount_index=None):
+        self.engine = engine
+        self.cache = cache
+        self.mount_index = mount_index
+        self.listings = OdriveStateCache(cache.ttl)
+        # Remote sizes, when odrive gives them, per path and per listed directory
+        self.sizes = OdriveStateCache(cache.ttl)
+        self.directory_sizes = OdriveStateCache(cache.ttl)
+        self._waiting = {}
+        self._running = {}
 
-        hbox_recursive = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
-        lbl_recursive = Gtk.Label.new(_("Sync all sub-folders."))
-        self.chk_recursiveSync = Gtk.CheckButton.new_with_mnemonic(_("Recursive"))
-        self.chk_recursiveSync.connect("toggled", self.on_chk_recursive_toggled)
-        hbox_recursive.pack_start(lbl_recursive, True, True, 0)
-        hbox_recursive.pack_start(self.chk_recursiveSync, True, True, 0)
-        vbox.pack_start(hbox_recursive, True, True, 0)
+    def peek(self, path):
+        """State known without asking odrive, or None"""
+        state = OdriveSyncState.from_path(path)
+        if state is not None:
+            return state
+        return self.cache.get(path)
 
-        hbox_nodownload = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
-        lbl_nodownload = Gtk.Label.new(
-            _("Do not download files, just placeholders. (to use in conjunction with \"Recursive\""))
-        self.chk_nodownloadSync = Gtk.CheckButton.new_with_mnemonic(_("No download"))
-        self.chk_nodownloadSync.set_sensitive(False)
-        hbox_nodownload.pack_start(lbl_nodownload, True, True, 0)
-        hbox_nodownload.pack_start(self.chk_nodownloadSync, True, True, 0)
-        vbox.pack_start(hbox_nodownload, True, True, 0)
+    def lookup(self, path, callback):
+        """Call `callback(path, state)` once the state of `path` is known"""
+        state = self.peek(path)
+        if state is not None:
+            callback(path, state)
+            return
 
-        hbox_btn = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
-        vbox.pack_end(hbox_btn, True, True, 0)
+        def on_listing(states, result):
+            state = states.get(path)
+            if state is None:
+                state = OdriveSyncState.UNKNOWN
+                if result.succeeded:
+                    # Not listed by odrive: remember it so it is not asked for again right away
+                    self.cache.set(path, state)
+            callback(path, state)
 
-        btn_cancel = Gtk.Button(label=_("Cancel"))
-        btn_cancel.connect("clicked", self.on_cancel_clicked, caller)
-        hbox_btn.pack_start(btn_cancel, True, True, 0)
+        self._wait_for(self.listed_in(path), on_listing)
 
-        btn_confirm = Gtk.Button(label=_("Confirm"))
-        btn_confirm.connect("clicked", self.on_confirm_clicked, caller)
-        hbox_btn.pack_start(btn_confirm, True, True, 0)
+    def listed_in(self, path):
+        """Directory whose listing gives the state of `path`: its folder, or `path` itself for a mount root"""
+        parent = os.path.dirname(path)
+        index = self.mount_index() if self.mount_index is not None else None
+        if index is not None and index.owning_mount(parent) is None:
+            return path
+        return parent
 
-    def on_chk_recursive_toggled(self, widget):
-        self.chk_nodownloadSync.set_sensitive(self.chk_recursiveSync.get_active())
+    def lookup_many(self, paths, callback):
+        """Call `callback({path: state})` once the states of every path are known"""
+        paths = list(paths)
+        states = {}
+        if not paths:
+            callback(states)
+            return
 
-    def on_cancel_clicked(self, widget, caller):
-        caller.windowReturnObject.action = "Cancel"
-        self.destroy()
+        def on_state(path, state):
+            states[path] = state
+            if len(states) == len(paths):
+                callback(states)
 
-    def on_confirm_clicked(self, widget, caller):
-        caller.windowReturnObject.action = "Confirm"
-        caller.windowReturnObject.value = {
-            "recursive": str(self.chk_recursiveSync.get_active()),
-            "nodownload": str(self.chk_nodownloadSync.get_active())
-        }
-        self.destroy()
+        for path in paths:
+            self.lookup(path, on_state)
 
+    def children(self, directory, callback):
+        """Call `callback({child path: state})` with the states of the children of `directory`"""
+        listing = self.listings.get(directory)
+        if listing is not None:
+            callback(listing)
+            return
+        self._wait_for(directory, lambda states, _result: callback(
+            dict((path, state) for path, state in states.items() if path != directory)))
 
-class OdriveStatus(object):
-    """Odrive Status Class"""
+    def remote_sizes(self, directory, callback):
+        """Call `callback({child path: size})` with the remote sizes of the children of `directory`.
 
-    def __init__(self):
-        # Emblems
-        self.EMBLEMS = [
-            'emblem-important',
-            'emblem-urgent',
-            'emblem-favorite',
-            'emblem-default',
-            'emblem-new'
-        ]
-        self.I18N_EMBLEMS = {
-            'emblem-important': _("Important"),
-            'emblem-urgent': _("In Progress"),
-            'emblem-favorite': _("Favorite"),
-            'emblem-default': _("Finished"),
-            'emblem-new': _("New")
-        }
+        Placeholders are empty files: only odrive knows the size of what they
+        stand for. Children it gives no size for are left out."""
+        sizes = self.directory_sizes.get(directory)
+        if sizes is not None:
+            callback(dict(sizes))
+            return
+        self._wait_for(directory, lambda _states, _result: callback(dict(self.directory_sizes.get(directory) or {})))
 
-    def get_icon(self, icon_name):
-        """Get icon name and filename (used for check if exists an icon)"""
-        icon_theme = Gtk.IconTheme.get_default()
-        icon = icon_theme.lookup_icon(icon_name, 48, 0)
-        if icon is not None:
-            return {'name': os.path.splitext(os.path.basename(icon.get_filename()))[0],
-                    'filename': icon.get_filename()}
+    def listing(self, directory, callback):
+        """Call `callback({path: state}, error)` with the states of `directory` and of its children.
+
+        `error` is the message of odrive when it failed, None otherwise."""
+        listing = self.listings.get(directory)
+        state = self.cache.get(directory)
+        if listing is not None and state is not None:
+            states = dict(listing)
+            states[directory] = state
+            callback(states, None)
+            return
+        self._wait_for(directory, lambda states, result: callback(
+            states, None if result.succeeded else result.stderr.strip() or _("odrive syncstate failed")))
+
+    def _wait_for(self, directory, waiter):
+        waiters = self._waiting.setdefault(directory, [])
+        waiters.append(waiter)
+        if len(waiters) == 1 and directory not in self._running:
+            GLib.idle_add(self._resolve, directory)
+
+    def _resolve(self, directory):
+        if directory not in self._running:
+            self._running[directory] = self.engine.run(
+                ["syncstate", directory, "--textonly"],
+                lambda result: self._on_resolved(directory, result))
+        return False
+
+    def _on_resolved(self, directory, result):
+        del self._running[directory]
+        states = {}
+        if result.succeeded:
+            entries = _parse_odrive_syncstate_entries(result.stdout)
+            states = dict((os.path.join(directory, entry.name) if entry.name else directory, entry.state)
+                          for entry in entries)
+            sizes = dict((os.path.join(directory, entry.name), entry.size) for entry in entries
+                         if entry.name and entry.size is not None)
+            self.sizes.set_many(sizes)
+            self.directory_sizes.set(directory, sizes)
+            self.cache.set_many(states)
+            self.listings.set(directory, dict((path, state) for path, state in states.items()
+                                              if path != directory))
         else:
-            return {'name': '', 'filename': ''}
+            instrumentation.warning("odrive syncstate failed for {}: {}", directory, result.stderr)
+        for waiter in self._waiting.pop(directory, []):
+            waiter(states, result)
 
-    def set_emblem(self, item_path, emblem_name=''):
-        """Set emblem"""
-        # Restore
-        self.restore_emblem(item_path)
-        # Set
-        if emblem_name:
-            emblem = [emblem_name]
-            emblems = list(emblem)
-            emblems.append(None)  # Needs
-            item = Gio.File.new_for_path(item_path)
-            info = item.query_info('metadata::emblems', 0, None)
-            info.set_attribute_stringv('metadata::emblems', emblems)
-            item.set_attributes_from_info(info, 0, None)
-        # Refresh
-        self._refresh(item_path)
 
-    def restore_emblem(self, item_path):
-        """Restore emblem to default"""
-        item = Gio.File.new_for_path(item_path)
-        info = item.query_info('metadata::emblems', 0, None)
-        info.set_attribute('metadata::emblems', Gio.FileAttributeType.INVALID, 0)
-        item.set_attributes_from_info(info, 0, None)
-        self._refresh(item_path)
+class OdriveStateWatcher(object):
+    """Keeps the sync state cache up to date from filesystem events.
 
-    def _refresh(self, item_path):
-        """Reload the current file/directory icon"""
-        os.utime(item_path, None)
+    Placeholders show the odrive lifecycle on disk: syncing `x.cloud` removes
+    it and creates `x`, unsyncing does the opposite. Directories of the mounts
+    are watched with Gio.FileMonitor, events are coalesced for
+    WATCH_COALESCE_DELAY milliseconds and then applied to the cache in one go,
+    so menus and emblems follow changes without asking odrive.
+
+    At most `max_watches` directories are monitored. Mount trees are walked
+    breadth-first in idle time until that budget is used; past it, only the
+    directories Nautilus opens are watched, the least recently opened ones
+    being dropped first."""
+
+    def __init__(self, resolver, on_paths_changed=None, max_watches=MAX_DIRECTORY_WATCHES):
+        self.resolver = resolver
+        self.on_paths_changed = on_paths_changed
+        self.max_watches = max_watches
+        self.events = 0
+        self.flushes = 0
+        self._monitors = collections.OrderedDict()
+        self._lazy = False
+        self._walk_queue = collections.deque()
+        self._walk_source = 0
+        self._pending = {}
+        self._flush_source = 0
+
+    def watch_mounts(self, mounts):
+        """(Re)start watching the given mounts"""
+        self.stop()
+        self._lazy = False
+        self._walk_queue.extend(mounts)
+        self._walk_source = GLib.idle_add(self._walk_step, priority=GLib.PRIORITY_LOW)
+
+    def directory_opened(self, directory):
+        """Called for directories Nautilus shows, watched on demand once the budget is used"""
+        if directory in self._monitors:
+            self._monitors.move_to_end(directory)
+        elif self._lazy:
+            while len(self._monitors) >= self.max_watches:
+                _directory, monitor = self._monitors.popitem(last=False)
+                monitor.cancel()
+            self._watch(directory)
 
-def _execute_system_odrive_command(args):
-    """ Add multithreading capabilities, so not to lock Nautilus when doing long running operations.
-        check following examples:
-        - https://stackoverflow.com/a/24106419
-        - https://stackoverflow.com/a/14533789"""
-    print("odrive args: " + ",".join(args))
-    p = subprocess.run([odriveClientPath] + args, capture_output=True)
-    output = p.stdout.decode("utf-8")
-    return output
+    def stop(self):
+        if self._walk_source:
+            GLib.source_remove(self._walk_source)
+            self._walk_source = 0
+        self._walk_queue.clear()
+        for monitor in self._monitors.values():
+            monitor.cancel()
+        self._monitors.clear()
 
+    def _walk_step(self):
+        # A bounded slice of the walk per idle call keeps the main loop responsive
+        for _ in range(WATCH_WALK_BATCH):
+            if not self._walk_queue:
+                self._walk_source = 0
+                return False
+            if len(self._monitors) >= self.max_watches:
+                self._lazy = True
+                self._walk_queue.clear()
+                self._walk_source = 0
+                return False
+            directory = self._walk_queue.popleft()
+            if not self._watch(directory):
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            self._walk_queue.append(entry.path)
+            except OSError:
+                continue
+        return True
+
+    def _watch(self, directory):
+        try:
+            monitor = Gio.File.new_for_path(directory).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        except GLib.Error as error:
+            instrumentation.warning("Unable to watch {}: {}", directory, error.message)
+            return False
+        monitor.connect("changed", self._on_changed)
+        self._monitors[directory] = monitor
+        return True
+
+    def _on_changed(self, monitor, file, other_file, event_type):
+        self.events += 1
+        if event_type == Gio.FileMonitorEvent.RENAMED and other_file is not None:
+            self._pending[file.get_path()] = Gio.FileMonitorEvent.DELETED
+            self._pending[other_file.get_path()] = Gio.FileMonitorEvent.CREATED
+        elif event_type in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.MOVED_IN):
+            self._pending[file.get_path()] = Gio.FileMonitorEvent.CREATED
+        elif event_type in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+            self._pending[file.get_path()] = Gio.FileMonitorEvent.DELETED
+        else:
+            return
+        if not self._flush_source:
+            self._flush_source = GLib.timeout_add(WATCH_COALESCE_DELAY, self._flush)
+
+    def _flush(self):
+        self._flush_source = 0
+        pending, self._pending = self._pending, {}
+        self.flushes += 1
+        cache = self.resolver.cache
+        changed = set()
+        for path, event_type in pending.items():
+            self.resolver.listings.invalidate(os.path.dirname(path))
+            self.resolver.engine.forget(path)
+            changed.add(path)
+            if event_type == Gio.FileMonitorEvent.DELETED:
+                cache.invalidate(path)
+                if path in self._monitors:
+                    self._monitors.pop(path).cancel()
+                continue
+
+            state = OdriveSyncState.from_path(path)
+            if state is not None:
+                cache.set(path, state)
+                # The synced counterpart of a new placeholder is gone
+                cache.invalidate(os.path.splitext(path)[0])
+            elif pending.get(path + ".cloud") == Gio.FileMonitorEvent.DELETED or \
+                    pending.get(path + ".cloudf") == Gio.FileMonitorEvent.DELETED:
+                # The placeholder has been replaced by the real item
+                cache.set(path, OdriveSyncState.SYNCED)
+            else:
+                cache.invalidate(path)
+            if not self._lazy and len(self._monitors) < self.max_watches and os.path.isdir(path):
+                self._watch(path)
+        if self.on_paths_changed is not None:
+            self.on_paths_changed(changed)
+        return False
+
+
+class OdriveSelection(collections.namedtuple("OdriveSelection", ["directories", "files", "placeholders", "outside",
+                                                                 "mounts", "single_mount_root"])):
+    """Compact summary of a Nautilus selection, all the menu is built from"""
+
+    @property
+    def size(self):
+        """Number of selected items, folders included"""
+        return self.directories + self.files
 
-class OdriveMenu(GObject.GObject, Nautilus.MenuProvider):
+
+class OdriveMenuEntry(collections.namedtuple("OdriveMenuEntry", ["name", "label", "icon", "sensitive", "action",
+                                                                 "args"])):
+    """Item of a cached menu layout: `action(menu, items, *args)` is bound to the selection the menu is shown for"""
+
+
+class OdriveMenu(GObject.GObject, Nautilus.MenuProvider, Nautilus.InfoProvider, Nautilus.ColumnProvider):
 
     def __init__(self, *args, **kwargs):
-        print(sys.version)
         GObject.Object.__init__(self)
         super(OdriveMenu, self).__init__(*args, **kwargs)
         self.odrivestatus = OdriveStatus()
-        self.all_are_directories = True
-        self.all_are_files = True
-        self.windowReturnObject = types.SimpleNamespace()
-        self.localPath = ""
+        if HELPER_ENABLED:
+            backend = OdriveHelperClient()
+        else:
+            backend = OdriveAgentClient() if AGENT_CLIENT_ENABLED else None
+        self.engine = OdriveCommandEngine(agent_client=backend)
+        self.agent_health = OdriveAgentHealth(self.engine, on_change=self._on_agent_health_changed)
+        self.mount_table = OdriveMountTable(self.engine, on_change=self._on_mounts_changed)
+        self.job_queue = OdriveJobQueue(self.engine, on_change=self._on_jobs_changed)
+        self.state_store = OdriveStateStore()
+        self.state_cache = OdriveStateCache(store=self.state_store)
+        self.syncstate_resolver = OdriveSyncStateResolver(self.engine, self.state_cache,
+                                                          mount_index=self.mount_table.get_index)
+        self.autosync = OdriveAutoSync(self.job_queue, self.state_store, self.syncstate_resolver.remote_sizes,
+                                       callback=self._on_job_done)
+        self._info_updates = {}
+        self._info_update_ids = itertools.count()
+        self._menu_cache = collections.OrderedDict()
+        self.sync_plans = {}
+        self._dialogs = {}
+        self._rule_folder = None
+        self._progress_window = None
+        self._progress_source = 0
+        self.settings = OdriveSettings()
+        self.prefetcher = None
+        self.resource_monitor = None
+        self.menu_cache_hits = 0
+        self.menu_cache_misses = 0
+        self.watcher = OdriveStateWatcher(self.syncstate_resolver, on_paths_changed=self._on_paths_changed)
+        instrumentation.register("engine", self.engine.stats)
+        instrumentation.register("mount_table", self.mount_table.stats)
+        instrumentation.register("autosync", self.autosync.stats)
+        instrumentation.register("menu_cache", lambda: {"hits": self.menu_cache_hits,
+                                                        "misses": self.menu_cache_misses})
+        # Nothing else is done while Nautilus starts: client discovery and caches wait for an idle main loop
+        GLib.idle_add(self._warm_up, priority=GLib.PRIORITY_LOW)
+
+    def _warm_up(self):
+        _configure_instrumentation(self.settings)
+        instrumentation.debug("Python {}", sys.version)
+        if get_odrive_client_path():
+            # Serve the mounts of the previous session, then refresh them in background
+            stored_mounts = self.state_store.load_mounts()
+            if stored_mounts:
+                self.mount_table.seed(stored_mounts)
+                self.watcher.watch_mounts(stored_mounts)
+            self.mount_table.refresh_async()
+            self.agent_health.start()
+            for root, no_download in self.state_store.load_plans():
+                instrumentation.info("Resuming recursive sync of {}", root)
+                self._start_sync_plan(root, no_download)
+            self.autosync.start()
+            if self.settings.get_boolean("prefetch", "enabled"):
+                self._start_prefetcher()
+        return False
 
     def get_file_items(self, window, files):
-        if not odriveClientPath:
+        with instrumentation.span("menu.get_file_items"):
+            return self._get_file_items(files)
+
+    def _get_file_items(self, files):
+        if not get_odrive_client_path():
             odrive_menu = Nautilus.MenuItem(
                 name='Odrive::Check',
                 label=_("Odrive: No client found"),
@@ -310,267 +3571,681 @@ class OdriveMenu(GObject.GObject, Nautilus.MenuProvider):
             )
             return odrive_menu,
 
-        # Is agent running?
-        # Is activated?
-
-        if not self._check_generate_menu(files):
+        if not len(files):
             return
 
+        if self.agent_health.state == OdriveAgentHealth.OPEN:
+            # Answer at once: nothing can be done until the agent answers a probe again
+            odrive_menu = Nautilus.MenuItem(
+                name='Odrive::AgentDown',
+                label=_("Odrive: agent not responding"),
+                tip=_("The odrive agent does not answer, make sure it is running"),
+                sensitive=False
+            )
+            return odrive_menu,
+
+        if self.agent_health.activated is False:
+            odrive_menu = Nautilus.MenuItem(
+                name='Odrive::NotActivated',
+                label=_("Odrive: not activated"),
+                tip=_("Authenticate the odrive agent first (odrive authenticate)"),
+                sensitive=False
+            )
+            return odrive_menu,
+
+        if self._odrive_get_mounts() is None:
+            # Mounts are being fetched, Nautilus will ask again once they are known
+            odrive_menu = Nautilus.MenuItem(
+                name='Odrive::Loading',
+                label=_("Odrive: Loading..."),
+                tip=_("Waiting for the odrive agent"),
+                sensitive=False
+            )
+            return odrive_menu,
+
         return self._generate_menu(files)
 
-    def _selected_files_in_mounted(self, items):
-        all_selected_in_mounted_path = False
+    def _on_agent_health_changed(self):
+        instrumentation.info("odrive agent: {}{}", self.agent_health.state,
+                             ", not activated" if self.agent_health.activated is False else "")
+        if self.agent_health.state == OdriveAgentHealth.HEALTHY and self._odrive_get_mounts() is None:
+            self.mount_table.refresh_async()
+        self.emit_items_updated_signal()
 
-        odrive_mounts = self._odrive_get_mounts()
+    def _on_mounts_changed(self):
+        mounts = self._odrive_get_mounts() or []
+        self.state_store.save_mounts(mounts)
+        self.watcher.watch_mounts(mounts)
+        self.emit_items_updated_signal()
 
-        # only checking first item, since we may select multiple items but all in same folder
-        path = uri_to_path(items[0].get_uri())
-        for mount in odrive_mounts:
-            all_selected_in_mounted_path = mount in path
-            if all_selected_in_mounted_path:
-                break
+    def _on_paths_changed(self, paths):
+        """Ask Nautilus to query again the files whose state changed on disk"""
+        for path in paths:
+            file_info = Nautilus.FileInfo.lookup_for_uri(Gio.File.new_for_path(path).get_uri())
+            if file_info is not None:
+                file_info.invalidate_extension_info()
+        self.autosync.directories_changed(set(os.path.dirname(path) for path in paths))
+
+    def get_columns(self):
+        return (
+            Nautilus.Column(name="OdriveMenu::SyncStateColumn", attribute="odrive_sync_state",
+                            label=_("Sync state"), description=_("odrive sync state")),
+            Nautilus.Column(name="OdriveMenu::RemoteSizeColumn", attribute="odrive_remote_size",
+                            label=_("Remote size"), description=_("Size of the item in the cloud")),
+        )
+
+    def update_file_info_full(self, provider, handle, closure, file):
+        """Add the sync state emblem and columns, resolving states asynchronously"""
+        if not get_odrive_client_path() or file.get_uri_scheme() != 'file':
+            return Nautilus.OperationResult.COMPLETE
+
+        path = uri_to_path(file.get_uri())
+        if self._owning_mount(path) is None:
+            return Nautilus.OperationResult.COMPLETE
+        self.watcher.directory_opened(os.path.dirname(path))
+        if self.prefetcher is not None:
+            self.prefetcher.directory_opened(os.path.dirname(path))
 
-        return all_selected_in_mounted_path
+        directory = os.path.dirname(path)
+        state = self.syncstate_resolver.peek(path)
+        if state is not None and (state != OdriveSyncState.NOT_SYNCED or
+                                  self.syncstate_resolver.listings.get(directory) is not None):
+            self._add_file_info(file, path, state)
+            instrumentation.count("info.complete")
+            return Nautilus.OperationResult.COMPLETE
 
-    def _check_generate_menu(self, items):
+        instrumentation.count("info.in_progress")
+        update_id = next(self._info_update_ids)
+        self._info_updates[update_id] = (handle, closure, file)
+        if state is not None:
+            # Placeholder: its remote size comes with the listing of its folder, one odrive call for all of them
+            self.syncstate_resolver.children(directory, lambda _states: self._on_file_state(update_id, path, state))
+        else:
+            self.syncstate_resolver.lookup(path, lambda _path, state: self._on_file_state(update_id, path, state))
+        return Nautilus.OperationResult.IN_PROGRESS
+
+    def cancel_update(self, provider, handle):
+        for update_id, update in list(self._info_updates.items()):
+            if update[0] == handle:
+                del self._info_updates[update_id]
+
+    def _on_file_state(self, update_id, path, state):
+        update = self._info_updates.pop(update_id, None)
+        if update is None:
+            # Cancelled by Nautilus meanwhile
+            return
+        handle, closure, file = update
+        self._add_file_info(file, path, state)
+        Nautilus.info_provider_update_complete_invoke(closure, self, handle, Nautilus.OperationResult.COMPLETE)
+
+    def _add_file_info(self, file, path, state):
+        emblem = self.odrivestatus.STATE_EMBLEMS.get(state)
+        if emblem:
+            file.add_emblem(emblem)
+        file.add_string_attribute("odrive_sync_state", OdriveSyncState.LABELS[state])
+        size = self.syncstate_resolver.sizes.get(path)
+        if size is None and state == OdriveSyncState.SYNCED:
+            # Synced files are the same size here and in the cloud
+            try:
+                file_stat = os.lstat(path)
+                if stat.S_ISREG(file_stat.st_mode):
+                    size = file_stat.st_size
+            except OSError:
+                pass
+        file.add_string_attribute("odrive_remote_size", GLib.format_size(size) if size is not None else "")
+
+    def _owning_mount(self, path):
+        """Mount containing `path`, None if it is not in any (or mounts are not known yet)"""
+        index = self.mount_table.get_index()
+        if index is None:
+            return None
+        return index.owning_mount(path)
+
+    def _summarize_selection(self, items, index):
+        """Classify the selection in a single pass, None when odrive has nothing to offer for it"""
         if not len(items):
-            return False
+            return None
 
-        self.all_are_directories = True
-        self.all_are_files = True
+        directories = placeholders = outside = 0
+        mounts = set()
         for item in items:
+            uri = item.get_uri()
             # GNOME can only handle files
-            if item.get_uri_scheme() != 'file':
-                return False
-
+            if not uri.startswith("file://"):
+                return None
             if item.is_directory():
-                self.all_are_files = False
+                directories += 1
+            if uri.endswith(".cloud") or uri.endswith(".cloudf"):
+                placeholders += 1
+            mount = index.owning_mount(uri_to_path(uri))
+            if mount is None:
+                outside += 1
             else:
-                self.all_are_directories = False
+                mounts.add(mount)
 
-        return True
+        single_mount_root = len(items) == 1 and directories == 1 and index.is_mount(uri_to_path(items[0].get_uri()))
+        return OdriveSelection(directories, len(items) - directories, placeholders, outside,
+                               frozenset(mounts), single_mount_root)
 
     def _generate_menu(self, items):
+        index = self.mount_table.get_index()
+        with instrumentation.span("menu.summarize"):
+            summary = self._summarize_selection(items, index)
+        if summary is None:
+            return None
+
+        jobs = None
+        if self.job_queue.is_busy():
+            counts = self.job_queue.counts()
+            jobs = (counts[OdriveJob.QUEUED], counts[OdriveJob.RUNNING])
+
+        plans = tuple(_("Syncing {}: {} left, {:.1f} items/s").format(
+            os.path.basename(plan.directory), plan.remaining(), plan.rate()) for plan in self.sync_plans.values())
+
+        key = (summary, self.mount_table.version, jobs, plans, self.prefetcher is not None)
+        if key in self._menu_cache:
+            self._menu_cache.move_to_end(key)
+            self.menu_cache_hits += 1
+            layout = self._menu_cache[key]
+        else:
+            self.menu_cache_misses += 1
+            layout = self._menu_layout(summary, jobs, plans)
+            self._menu_cache[key] = layout
+            while len(self._menu_cache) > MENU_CACHE_SIZE:
+                self._menu_cache.popitem(last=False)
+        if layout is None:
+            return None
+        with instrumentation.span("menu.build"):
+            # Fresh items every time: a menu handed out keeps acting on the selection it was shown for
+            return self._build_menu(layout, list(items))
+
+    def _menu_layout(self, summary, jobs, plans):
+        """Entries of the Odrive menu for a selection summary, None when there is nothing to offer"""
         menu_items = []
 
+        def entry(name, label, action=None, *args, **kwargs):
+            return OdriveMenuEntry(name, label, kwargs.get("icon", "refresh"), kwargs.get("sensitive", True),
+                                   action, args)
+
+        def on_item(handler):
+            return lambda menu, items: handler(menu, items[0])
+
         # Is selected file(s) part of any odrive mounts?
-        if not self._selected_files_in_mounted(items):
+        if summary.outside:
             # If we selected only one item
-            if len(items) == 1:
-                if items[0].is_directory():
+            if summary.size == 1:
+                if summary.directories:
                     # Propose to mount folder
-                    item_mount = Nautilus.MenuItem(name='Odrive::Mount', label=_("Mount"), icon='refresh')
-                    item_mount.connect('activate', self._odrive_mount, items[0])
-                    menu_items.append(item_mount)
+                    menu_items.append(entry('Odrive::Mount', _("Mount"), on_item(self._odrive_mount)))
             else:
-                return False
-        else:
+                return None
+        elif summary.single_mount_root:
             # Propose to unmount
-            # If we selected only one item
-            if len(items) == 1:
-                if items[0].is_directory():
-                    item_unmount = Nautilus.MenuItem(name='Odrive::Unmount', label=_("Unmount"), icon='refresh')
-                    item_unmount.connect('activate', self._odrive_unmount, items[0])
-                    menu_items.append(item_unmount)
-
-        # If we selected only one item
-        can_sync = False
-        can_unsync = False
-        for item in items:
-            filename, file_extension = os.path.splitext(item.get_uri())
-            print("for loop item filename: " + filename)
-            if file_extension == ".cloudf" or file_extension == ".cloud":
-                if not can_sync:
-                    can_sync = True
-                continue
-            else:
-                if not can_unsync:
-                    can_unsync = True
-                continue
+            menu_items.append(entry('Odrive::Unmount', _("Unmount"), on_item(self._odrive_unmount)))
 
-        print("can_sync: " + str(can_sync))
-        print("can_unsync: " + str(can_unsync))
+        if summary.placeholders:
+            menu_items.append(entry('Odrive::Sync', _("Sync"), self._odrive_sync, False))
+            menu_items.append(entry('Odrive::Sync_With_Options', _("Sync..."), self._odrive_sync, True))
 
-        if can_sync:
-            item_sync = Nautilus.MenuItem(name='Odrive::Sync', label=_("Sync"), icon='refresh')
-            item_sync.connect('activate', self._odrive_sync, items, False)
-            menu_items.append(item_sync)
+        if summary.placeholders < summary.size:
+            menu_items.append(entry('Odrive::Unsync', _("Unsync"), self._odrive_unsync))
 
-            item_sync_options = Nautilus.MenuItem(name='Odrive::Sync_With_Options', label=_("Sync..."), icon='refresh')
-            item_sync_options.connect('activate', self._odrive_sync, items, True)
-            menu_items.append(item_sync_options)
+        if summary.size == 1 and summary.directories and not summary.placeholders and not summary.outside:
+            menu_items.append(entry('Odrive::FreeUpSpace', _("Free up space..."), on_item(self._odrive_free_up_space)))
+            menu_items.append(entry('Odrive::SyncRule', _("Auto-sync rule..."), on_item(self._odrive_sync_rule)))
 
-        if can_unsync:
-            item_unsync = Nautilus.MenuItem(name='Odrive::Unsync', label=_("Unsync"), icon='refresh')
-            item_unsync.connect('activate', self._odrive_unsync, items)
-            menu_items.append(item_unsync)
+        odrive_top_menu = entry('Odrive::Top', _('Odrive'), icon='folder_color_picker')
+        odrive_sub_menu = []
 
-        for item in items:
-            filename, file_extension = os.path.splitext(item.get_uri())
-            if item.is_directory():
-                print("item: dir, " + item.get_uri())
-            else:
-                print("item: " + item.get_uri_scheme() + ", " + item.get_uri() + ", ext: " + file_extension)
+        item_syncstate_selected = entry('Odrive::SyncState', _("Sync State (selected)"),
+                                        self._check_odrive_syncState, False)
+        item_syncstate_children = entry('Odrive::SyncStateChildren', _("Sync State (children)"),
+                                        self._check_odrive_syncState, True)
 
-        odrive_top_menu = Nautilus.MenuItem(name='Odrive::Top', label=_('Odrive'), icon='folder_color_picker')
+        if not summary.files:
+            odrive_sub_menu.append(item_syncstate_selected)
+            odrive_sub_menu.append(item_syncstate_children)
 
-        odrive_sub_menu = Nautilus.Menu()
-        odrive_top_menu.set_submenu(odrive_sub_menu)
+        if not summary.directories:
+            odrive_sub_menu.append(item_syncstate_selected)
 
-        item_syncstate_selected = Nautilus.MenuItem(name='Odrive::SyncState', label=_("Sync State (selected)"),
-                                                    icon='refresh')
-        item_syncstate_selected.connect('activate', self._check_odrive_syncState, items, False)
-        item_syncstate_children = Nautilus.MenuItem(name='Odrive::SyncState', label=_("Sync State (children)"),
-                                                    icon='refresh')
-        item_syncstate_children.connect('activate', self._check_odrive_syncState, items, True)
-        item_refresh = Nautilus.MenuItem(name='Odrive::Refresh', label=_("Refresh"), icon='refresh')
-        item_refresh.connect('activate', self._check_odrive_syncState, items)
+        if jobs is not None:
+            odrive_sub_menu.append(entry('Odrive::Jobs', _("{} queued / {} running").format(*jobs),
+                                         icon=None, sensitive=False))
 
-        if self.all_are_directories:
-            odrive_sub_menu.append_item(item_syncstate_selected)
-            odrive_sub_menu.append_item(item_syncstate_children)
+        odrive_sub_menu.append(entry(
+            'Odrive::Prefetch',
+            _("Stop downloading small files in background") if self.prefetcher is not None
+            else _("Download small files in background"),
+            lambda menu, _items: self._toggle_prefetch(menu), icon=None))
 
-        if self.all_are_files:
-            odrive_sub_menu.append_item(item_syncstate_selected)
+        for index, label in enumerate(plans):
+            odrive_sub_menu.append(entry('Odrive::Plan{}'.format(index), label, icon=None, sensitive=False))
 
         ''' This is another way to get window using glade external files
-        item_show_glade = Nautilus.MenuItem(name='Odrive::ShowGlade', label=_("Show Glade gtk window"), icon='refresh')
-        item_show_glade.connect('activate', self._show_glade_window)
-        odrive_sub_menu.append_item(item_show_glade)'''
-        for menu_item in menu_items:
-            odrive_sub_menu.append_item(menu_item)
+        odrive_sub_menu.append(entry('Odrive::ShowGlade', _("Show Glade gtk window"),
+                                     lambda menu, _items: self._show_glade_window(menu)))'''
+        return odrive_top_menu, tuple(odrive_sub_menu + menu_items)
 
-        return odrive_top_menu,
-
-    def _on_btn_confirm_released(self, widget, window):
-        print("btn_confirm released")
-        window.destroy()
-        Gtk.main_quit
+    @staticmethod
+    def _build_menu(layout, items):
+        """Nautilus menu of a layout from _menu_layout, its items acting on `items`"""
 
-    def _on_btn_cancel_released(self, widget, window):
-        print("btn_cancel released")
-        window.destroy()
-        Gtk.main_quit
+        def menu_item(entry):
+            properties = dict(name=entry.name, label=entry.label)
+            if entry.icon is not None:
+                properties["icon"] = entry.icon
+            if not entry.sensitive:
+                properties["sensitive"] = False
+            menu_item = Nautilus.MenuItem(**properties)
+            if entry.action is not None:
+                menu_item.connect('activate', lambda menu: entry.action(menu, items, *entry.args))
+            return menu_item
 
-    def _show_glade_window(self, menu):
-        builder = Gtk.Builder()
-        builder.add_from_file(os.path.join(abs_exec_path, 'confirmation.glade'))
-        window = builder.get_object('main_window')
-        window.connect('delete-event', Gtk.main_quit)
+        top_entry, entries = layout
+        odrive_top_menu = menu_item(top_entry)
+        odrive_sub_menu = Nautilus.Menu()
+        odrive_top_menu.set_submenu(odrive_sub_menu)
+        for entry in entries:
+            odrive_sub_menu.append_item(menu_item(entry))
+        return odrive_top_menu,
 
-        handlers = {
-            'on_btn_confirm_released': (self._on_btn_confirm_released, window),
-            'on_btn_cancel_released': (self._on_btn_cancel_released, window)
-        }
-        builder.connect_signals(handlers)
+    def _dialog(self, template, handlers=None):
+        """The OdriveDialog of `template`, created once per extension instance"""
+        dialog = self._dialogs.get(template)
+        if dialog is None:
+            dialog = self._dialogs[template] = OdriveDialog(template, handlers)
+        return dialog
 
-        window.show_all()
-        Gtk.main()
+    def _show_glade_window(self, menu):
+        self._dialog('confirmation.glade').show(lambda builder: instrumentation.debug("btn_confirm released"))
 
     def _odrive_mount(self, menu, item):
         item_path = unquote(item.get_uri()[7:])
-        self.localPath = item_path
 
-        remote_path_window = MountPathWindow(self)
-        remote_path_window.connect("destroy", Gtk.main_quit)
-        remote_path_window.show_all()
-        Gtk.main()
+        def prepare(builder):
+            builder.get_object('lbl_local_path').set_text(_("Selected local path:\n{}").format(item_path))
+            entry = builder.get_object('entry_remote_path')
+            entry.set_text("")
+            entry.grab_focus()
 
-        if self.windowReturnObject.action == "Confirm":
+        def on_confirm(builder):
             # Sanitize user input to ensure there's nothing wrong in the path.
-            user_input = self.windowReturnObject.value
+            remote_path = builder.get_object('entry_remote_path').get_text().strip()
+            if not remote_path:
+                instrumentation.debug("Canceled mount")
+                return
+            self.engine.run(["mount", item_path, remote_path], self._on_mount_changed)
 
-            output = _execute_system_odrive_command(["mount", item_path, user_input])
-            print("command output:\n{}".format(output))
-            # update icon to "syncing"
-            # detach process: while output is empty, wait. otherwise, update icon to "synced"
-        else:
-            print("Canceled mount")
+        self._dialog('mountpath.glade').show(on_confirm, prepare)
 
     def _odrive_unmount(self, menu, item):
         item_path = unquote(item.get_uri()[7:])
-        self.localPath = item_path
 
-        output = _execute_system_odrive_command(["unmount", "\"{}\"".format(item_path)])
-        print("command output:\n{}".format(output))
+        self.engine.run(["unmount", item_path], self._on_mount_changed)
         # reset icon to normal folder
 
-    def _odrive_sync(self, menu, items, prompt_options):
-
-        if prompt_options:
-            threshold_select_window = FolderSyncOptionsWindow(self)
-            threshold_select_window.connect("destroy", Gtk.main_quit)
-            threshold_select_window.show_all()
-            Gtk.main()
-
-            if self.windowReturnObject.action is not None and self.windowReturnObject.action == "Confirm":
-                recursive = eval(self.windowReturnObject.value.get("recursive"))
-                no_download = eval(self.windowReturnObject.value.get("nodownload"))
-                # detach process we we don't get nautilus stuck during sync
-                self.sync_files(items, recursive, no_download)
-                # detach process: while output is empty, wait. otherwise, update icon to "synced"
-                # update icon to "syncing"
-            else:
-                print("Canceled mount")
+    def _on_mount_changed(self, result):
+        instrumentation.debug("command output:\n{}", result.stdout)
+        if result.succeeded:
+            self.mount_table.invalidate()
         else:
+            instrumentation.warning("odrive {} failed ({}): {}", result.args[0], result.exit_code, result.stderr)
+
+    def _odrive_sync(self, menu, items, prompt_options):
+        # The menu selection changes with the next right-click
+        items = list(items)
+        if not prompt_options:
             # Do a single sync (default options)
             self.sync_files(items, False, False)
+            return
+
+        def prepare(builder):
+            builder.get_object('chk_recursive').set_active(False)
+            builder.get_object('chk_nodownload').set_active(False)
+
+        def on_confirm(builder):
+            # Queued: the jobs run in background while Nautilus goes on
+            self.sync_files(items, builder.get_object('chk_recursive').get_active(),
+                            builder.get_object('chk_nodownload').get_active())
+
+        self._dialog('foldersyncoptions.glade', {'on_chk_recursive_toggled': self._on_chk_recursive_toggled}).show(
+            on_confirm, prepare)
+
+    def _on_chk_recursive_toggled(self, button):
+        self._dialog('foldersyncoptions.glade').builder.get_object('chk_nodownload').set_sensitive(button.get_active())
+
+    def _odrive_sync_rule(self, menu, item):
+        folder = unquote(item.get_uri()[7:])
+        rule = self.autosync.rules.get(folder)
+
+        def prepare(builder):
+            self._rule_folder = folder
+            builder.get_object('chk_expand').set_active(rule is not None and rule.expand)
+            infinite = rule is not None and rule.threshold is None
+            builder.get_object('chk_infinite').set_active(infinite)
+            builder.get_object('scale_threshold').set_sensitive(not infinite)
+            threshold = rule.threshold if rule is not None and rule.threshold is not None else 10 * 1000 ** 2
+            builder.get_object('threshold').set_value(threshold / 1000 ** 2)
+            builder.get_object('btn_remove').set_sensitive(rule is not None)
+
+        def on_confirm(builder):
+            threshold = None
+            if not builder.get_object('chk_infinite').get_active():
+                threshold = int(builder.get_object('threshold').get_value()) * 1000 ** 2
+            self.autosync.set_rule(OdriveSyncRule(folder, threshold, builder.get_object('chk_expand').get_active()))
+
+        self._dialog('foldersyncrule.glade', {'on_chk_infinite_toggled': self._on_chk_infinite_toggled,
+                                              'on_btn_remove_released': self._on_btn_remove_rule_released}).show(
+            on_confirm, prepare)
+
+    def _on_chk_infinite_toggled(self, button):
+        self._dialog('foldersyncrule.glade').builder.get_object('scale_threshold').set_sensitive(
+            not button.get_active())
+
+    def _on_btn_remove_rule_released(self, button):
+        self.autosync.remove_rule(self._rule_folder)
+        self._dialog('foldersyncrule.glade').close()
 
     def sync_files(self, items, recursive, no_download):
+        placeholders = []
         for item in items:
             item_path = unquote(item.get_uri()[7:])
             filename, file_extension = os.path.splitext(item.get_uri())
-            if file_extension == ".cloudf" or file_extension == ".cloud":
-                command_arguments = ["sync", "\"{}\"".format(item_path)]
-                if recursive:
-                    command_arguments.append("--recursive")
-                if no_download:
-                    command_arguments.append("--nodownload")
-                output = _execute_system_odrive_command(command_arguments)
-                print(output)
+            if recursive and (file_extension == ".cloudf" or item.is_directory()):
+                self._start_sync_plan(item_path, no_download)
+            elif file_extension == ".cloudf" or file_extension == ".cloud":
+                placeholders.append(item_path)
+        if len(placeholders) < 2:
+            # Nothing to order
+            self.job_queue.submit([(["sync", path], _job_size(path)) for path in placeholders], self._on_job_done)
+            return
+
+        # Smallest first, by the remote sizes listed with their folders (usually known since they are shown)
+        directories = set(os.path.dirname(path) for path in placeholders)
+        sizes = {}
+        answered = []
+
+        def on_sizes(directory_sizes):
+            sizes.update(directory_sizes)
+            answered.append(True)
+            if len(answered) == len(directories):
+                self.job_queue.submit([(["sync", path], _job_size(path, sizes.get(path))) for path in placeholders],
+                                      self._on_job_done)
+
+        for directory in directories:
+            self.syncstate_resolver.remote_sizes(directory, on_sizes)
+
+    def _start_sync_plan(self, root, no_download):
+        if root in self.sync_plans:
+            return self.sync_plans[root]
+        plan = OdriveSyncPlan(root, no_download, self.job_queue, self.syncstate_resolver.remote_sizes,
+                              on_progress=self._on_sync_plan_progress, on_finished=self._on_sync_plan_finished)
+        self.sync_plans[root] = plan
+        self.state_store.save_plan(root, no_download)
+        return plan.start()
+
+    def _on_sync_plan_progress(self, plan):
+        self.state_cache.invalidate(plan.directory)
+
+    def _on_sync_plan_finished(self, plan):
+        self.sync_plans.pop(plan.root, None)
+        self.state_store.remove_plan(plan.root)
+        instrumentation.info("Recursive sync of {} finished: {} synced, {} failed in {:.1f}s",
+                             plan.root, plan.done, plan.failed, time.monotonic() - plan.started_at)
+        self._on_jobs_changed()
+
+    def _start_prefetcher(self):
+        if self.resource_monitor is None:
+            self.resource_monitor = OdriveResourceMonitor(on_change=self._on_resources_changed)
+        megabyte = 1000 ** 2
+        self.prefetcher = OdrivePrefetcher(self.job_queue, self.resource_monitor,
+                                           self.syncstate_resolver.remote_sizes,
+                                           threshold=self.settings.get_int("prefetch", "threshold_mb") * megabyte,
+                                           max_total=self.settings.get_int("prefetch", "max_total_mb") * megabyte,
+                                           max_concurrent=self.settings.get_int("prefetch", "max_concurrent"),
+                                           callback=self._on_job_done)
+
+    def _on_resources_changed(self):
+        if self.prefetcher is not None:
+            self.prefetcher.resume()
+
+    def _toggle_prefetch(self, menu):
+        enabled = self.prefetcher is None
+        self.settings.set("prefetch", "enabled", enabled)
+        if enabled:
+            self._start_prefetcher()
+        else:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def _on_jobs_changed(self):
+        if self.job_queue.is_busy() or self.sync_plans:
+            if self._progress_window is None and not self._progress_source:
+                # Quick operations are over before the window would show up
+                self._progress_source = GLib.timeout_add_seconds(PROGRESS_WINDOW_DELAY, self._show_progress)
+        elif self._progress_window is not None or self._progress_source:
+            self._hide_progress()
+
+    def _show_progress(self):
+        _load_windows()
+        self._progress_window = ProgressWindow(self._cancel_operations)
+        # Closing the window leaves the operations running in background
+        self._progress_window.connect("delete-event", lambda window, event: window.hide_on_delete())
+        self._progress_window.show_all()
+        self._refresh_progress()
+        self._progress_source = GLib.timeout_add(PROGRESS_WINDOW_REFRESH, self._refresh_progress)
+        return False
+
+    def _refresh_progress(self):
+        jobs = list(self.job_queue.jobs.values())
+        running = [job for job in jobs if job.state == OdriveJob.RUNNING]
+        queued = sum(1 for job in jobs if job.state == OdriveJob.QUEUED)
+        finished = len(jobs) - len(running) - queued
+        bytes_done = sum(job.progress.bytes_done for job in jobs)
+
+        title = _("odrive: {} running, {} queued").format(len(running), queued)
+        for plan in self.sync_plans.values():
+            title += "\n" + _("Syncing {}: {} left").format(os.path.basename(plan.directory), plan.remaining())
+        details = _("{} of {} done").format(finished, len(jobs))
+        if bytes_done:
+            details += " ({})".format(GLib.format_size(bytes_done))
+        current_path = None
+        if running:
+            current_path = running[0].progress.current_path or running[0].args[-1]
+        # A lone command gives no measure of its progress
+        fraction = finished / len(jobs) if len(jobs) > 1 else None
+        self._progress_window.update(title, fraction, details, current_path)
+        return True
+
+    def _hide_progress(self):
+        if self._progress_source:
+            GLib.source_remove(self._progress_source)
+            self._progress_source = 0
+        if self._progress_window is not None:
+            self._progress_window.destroy()
+            self._progress_window = None
+
+    def _cancel_operations(self):
+        """Stop every recursive sync and odrive job, queued or running"""
+        instrumentation.info("Cancelling odrive operations")
+        if self._progress_window is not None:
+            self._progress_window.btn_cancel.set_sensitive(False)
+        for plan in list(self.sync_plans.values()):
+            plan.cancel()
+        self.job_queue.cancel_all()
 
     def _odrive_unsync(self, menu, items):
+        jobs = []
         for item in items:
             item_path = unquote(item.get_uri()[7:])
             filename, file_extension = os.path.splitext(item.get_uri())
-            if file_extension != ".cloudf" or file_extension != ".cloud":
-                output = _execute_system_odrive_command(["unsync", "\"{}\"".format(item_path)])
-                print(output)
+            if file_extension not in (".cloudf", ".cloud"):
+                jobs.append((["unsync", item_path], _job_size(item_path)))
                 # update icon to "un-syncing"
-                # detach process: while output is empty, wait. otherwise, update icon to "unsynced"
+        self.job_queue.submit(jobs, self._on_job_done)
 
-    def _odrive_get_mounts(self):
-        output = _execute_system_odrive_command(["status", "--mounts"])
-        regex = r"^(.+\/\w+).*"
-        mounts = []
-        for line in output.splitlines():
-            result = re.search(regex, line)
-            if result is not None and result.group(1) is not None:
-                mounts.append(result.group(1))
+    def _odrive_free_up_space(self, menu, item):
+        folder = uri_to_path(item.get_uri())
+
+        def on_options(target, excludes):
+            instrumentation.info("Looking for {} to free up in {}", GLib.format_size(target), folder)
+            OdriveReclaimPlan(folder, target, excludes, on_planned=self._on_reclaim_planned).start()
+
+        self._ask_reclaim_options(folder, on_options)
+
+    def _ask_reclaim_options(self, folder, on_options):
+        """Ask how much space to free and what to leave alone, then call `on_options(target, excludes)`"""
+        # Proposed target: what brings the disk back under RECLAIM_TARGET_USAGE
+        target = 10 ** 9
+        try:
+            fs = os.statvfs(folder)
+            excess = (fs.f_blocks - fs.f_bfree - RECLAIM_TARGET_USAGE * fs.f_blocks) * fs.f_frsize
+            if excess > 0:
+                target = int(excess)
+        except OSError:
+            pass
+
+        dialog = Gtk.Dialog(title=_("Free up space"), flags=0)
+        dialog.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL, _("Preview"), Gtk.ResponseType.OK)
+        grid = Gtk.Grid(row_spacing=6, column_spacing=6, border_width=12)
+        grid.attach(Gtk.Label(label=_("Unsync files not used for {} days in:\n{}").format(RECLAIM_MIN_IDLE_DAYS,
+                                                                                           folder), xalign=0),
+                    0, 0, 2, 1)
+        entry_target = Gtk.Entry(text=GLib.format_size(target), activates_default=True)
+        grid.attach(Gtk.Label(label=_("Space to free:"), xalign=0), 0, 1, 1, 1)
+        grid.attach(entry_target, 1, 1, 1, 1)
+        entry_excludes = Gtk.Entry(text=", ".join(RECLAIM_EXCLUDES), hexpand=True)
+        grid.attach(Gtk.Label(label=_("Never unsync:"), xalign=0), 0, 2, 1, 1)
+        grid.attach(entry_excludes, 1, 2, 1, 1)
+        dialog.get_content_area().pack_start(grid, True, True, 0)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+
+        def on_response(dialog, response):
+            if response == Gtk.ResponseType.OK:
+                target = _parse_size(entry_target.get_text())
+                if not target:
+                    # Left open until the size is understood
+                    entry_target.grab_focus()
+                    return
+                dialog.destroy()
+                on_options(target, [pattern.strip() for pattern in entry_excludes.get_text().split(",")
+                                    if pattern.strip()])
             else:
-                continue
-        return mounts
+                dialog.destroy()
+
+        dialog.connect("response", on_response)
+        dialog.show_all()
+
+    def _on_reclaim_planned(self, plan):
+        selected = plan.selected
+        title = _("Free up {} in {}").format(GLib.format_size(plan.target), plan.root)
+        if not selected:
+            self._show_report_dialog(title, _("No file unused for {} days was found.").format(RECLAIM_MIN_IDLE_DAYS),
+                                     [])
+            return
+        now = time.time()
+        lines = ["{} ({}, {})".format(os.path.relpath(path, plan.root), GLib.format_size(size),
+                                      _("last used {} days ago").format(int((now - atime) // (24 * 3600))))
+                 for path, size, atime in selected[:RECLAIM_REPORT_LINES]]
+        if len(selected) > RECLAIM_REPORT_LINES:
+            lines.append(_("... and {} more").format(len(selected) - RECLAIM_REPORT_LINES))
+        summary = _("Unsyncing {} files frees {}.").format(len(selected), GLib.format_size(plan.selected_size))
+        if plan.selected_size < plan.target:
+            summary += " " + _("Not enough unused files to reach the target.")
+        self._show_report_dialog(title, summary, lines, _("Free up space"), lambda: plan.execute(
+            self.job_queue, self._on_job_done, self._on_reclaim_finished))
+
+    def _on_reclaim_finished(self, plan):
+        instrumentation.info("Freed {} in {}: {} files unsynced, {} failed", GLib.format_size(plan.freed), plan.root,
+                             plan.unsynced, plan.failed)
+
+    def _show_report_dialog(self, title, summary, lines, confirm_label=None, on_confirm=None):
+        """Show a dry-run report; with `confirm_label`, `on_confirm()` is called if the user confirms it"""
+        dialog = Gtk.MessageDialog(
+            transient_for=None,
+            flags=0,
+            message_type=Gtk.MessageType.QUESTION if confirm_label else Gtk.MessageType.INFO,
+            buttons=Gtk.ButtonsType.NONE if confirm_label else Gtk.ButtonsType.OK,
+            text=title,
+            secondary_text=summary,
+        )
+        if confirm_label:
+            dialog.add_buttons(_("Cancel"), Gtk.ResponseType.CANCEL, confirm_label, Gtk.ResponseType.OK)
+        if lines:
+            text_view = Gtk.TextView(editable=False, cursor_visible=False)
+            text_view.get_buffer().set_text("\n".join(lines))
+            scrolled = Gtk.ScrolledWindow(min_content_height=min(400, 20 * (len(lines) + 1)))
+            scrolled.add(text_view)
+            dialog.get_message_area().pack_start(scrolled, True, True, 0)
+
+        def on_response(dialog, response):
+            dialog.destroy()
+            if response == Gtk.ResponseType.OK and on_confirm is not None:
+                on_confirm()
+
+        dialog.connect("response", on_response)
+        dialog.show_all()
+
+    def _on_job_done(self, job):
+        self.state_cache.invalidate(job.args[1])
+        if job.result is None:
+            return
+        instrumentation.debug("odrive {} output:\n{}", " ".join(job.args), job.result.stdout)
+        if not job.result.succeeded:
+            instrumentation.warning("odrive {} failed ({}): {}", job.args[0], job.result.exit_code,
+                                    job.result.stderr)
+
+    def _odrive_get_mounts(self):
+        return self.mount_table.get_mounts()
 
     def _check_odrive_syncState(self, menu, items, check_children):
-        item_path = unquote(items[0].get_uri()[7:])
+        paths = [uri_to_path(item.get_uri()) for item in items]
+        title = "Sync status of [{}]{}".format(paths[0] if len(paths) == 1 else _("{} items").format(len(paths)),
+                                               ("", " children")[check_children])
+        # Selected items are read from the listing of their folder (of themselves for a mount root)
+        sources = [path if check_children else self.syncstate_resolver.listed_in(path) for path in paths]
+        listings = {}
 
+        def on_listing(source, states, error):
+            listings[source] = (states, error)
+            if len(listings) < len(set(sources)):
+                return
+            lines = []
+            for path, source in zip(paths, sources):
+                states = listings[source][0]
+                if check_children:
+                    lines.extend(sorted((child, state) for child, state in states.items() if child != path))
+                else:
+                    lines.append((path, states.get(path) or OdriveSyncState.from_path(path) or
+                                  OdriveSyncState.UNKNOWN))
+            errors = [error for error in collections.OrderedDict.fromkeys(
+                listings[source][1] for source in sources) if error]
+            self._show_syncstate_dialog(title, lines, errors)
+
+        for source in collections.OrderedDict.fromkeys(sources):
+            self.syncstate_resolver.listing(source, lambda states, error, source=source: on_listing(
+                source, states, error))
+
+    def _show_syncstate_dialog(self, title, states, errors=()):
         dialog = Gtk.MessageDialog(
             transient_for=None,
             flags=0,
-            message_type=Gtk.MessageType.INFO,
+            message_type=Gtk.MessageType.WARNING if errors else Gtk.MessageType.INFO,
             buttons=Gtk.ButtonsType.OK,
-            text="Sync status of [{}]{}".format(item_path, ("", " children")[check_children]),
+            text=title,
         )
+        if errors:
+            dialog.format_secondary_text("\n".join(errors))
 
-        output = _execute_system_odrive_command(["syncstate", "\"{}\"".format(item_path), "--textonly"])
-        filtered_output = ""
-        if check_children:
-            filtered_output = output.split('\n', 1)[1]
-        else:
-            filtered_output = output.split('\n', 1)[0]
-        dialog.format_secondary_text(filtered_output)
-        dialog.run()
-        dialog.destroy()
+        text_view = Gtk.TextView(editable=False, cursor_visible=False)
+        text_view.get_buffer().set_text("\n".join("{}: {}".format(os.path.basename(path), OdriveSyncState.LABELS[state])
+                                                 for path, state in states))
+        scrolled = Gtk.ScrolledWindow(min_content_height=min(400, 20 * (len(states) + 1)))
+        scrolled.add(text_view)
+        dialog.get_message_area().pack_start(scrolled, True, True, 0)
+        dialog.connect("response", lambda dialog, _response: dialog.destroy())
+        dialog.show_all()
 
     def _check_generate_restore(self, items):
         """Menu: Show restore?"""
@@ -595,27 +4270,50 @@ class OdriveMenu(GObject.GObject, Nautilus.MenuProvider):
 
     def _menu_activate_restore_all(self, menu, items):
         """Menu: Clicked restore"""
-        for each_item in items:
-            if each_item.is_gone():
-                continue
-
-            item_path = unquote(each_item.get_uri()[7:])
-            self.odrivestatus.restore_emblem(item_path)
+        self.odrivestatus.set_emblems((unquote(each_item.get_uri()[7:]), '')
+                                      for each_item in items if not each_item.is_gone())
 
     def _menu_activate_restore_emblem(self, menu, items):
         """Menu: Clicked restore"""
-        for each_item in items:
-            if each_item.is_gone():
-                continue
-
-            item_path = unquote(each_item.get_uri()[7:])
-            self.odrivestatus.restore_emblem(item_path)
+        self.odrivestatus.set_emblems((unquote(each_item.get_uri()[7:]), '')
+                                      for each_item in items if not each_item.is_gone())
 
     def _menu_activate_emblem(self, menu, emblem, items):
         """Menu: Clicked emblem"""
-        for each_item in items:
-            if each_item.is_gone():
-                continue
+        self.odrivestatus.set_emblems((unquote(each_item.get_uri()[7:]), emblem)
+                                      for each_item in items if not each_item.is_gone())
+
+
+def helper_main(argv=None):
+    """Entry point of the session helper: `python3 odrive_menu.py --helper`"""
+    import argparse
+    parser = argparse.ArgumentParser(description="odrive Nautilus integration session helper")
+    parser.add_argument("--helper", action="store_true", help="run the session helper (the only mode)")
+    parser.add_argument("--socket", default=_helper_socket_path())
+    parser.add_argument("--idle-exit", type=int, default=HELPER_IDLE_EXIT, help="seconds idle before exiting")
+    parser.add_argument("--log-level", help="off, error, warning, info or debug (default: from the settings)")
+    parser.add_argument("--metrics", help="file the metrics are written to, {pid} being the process id")
+    options = parser.parse_args(argv)
+
+    _configure_instrumentation(OdriveSettings(), options.log_level, options.metrics)
+    loop = GLib.MainLoop()
+    engine = OdriveCommandEngine(agent_client=OdriveAgentClient() if AGENT_CLIENT_ENABLED else None)
+    instrumentation.register("engine", engine.stats)
+    helper = OdriveHelper(options.socket, engine, options.idle_exit, on_exit=loop.quit)
+    if not helper.start():
+        print("odrive helper already running on {}, or its folder is not private".format(options.socket))
+        return 0
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal_number, loop.quit)
+    print("odrive helper listening on {}".format(options.socket), flush=True)
+    try:
+        loop.run()
+    finally:
+        helper.stop()
+        engine.cancel_all()
+        instrumentation.export()
+    return 0
+
 
-            item_path = unquote(each_item.get_uri()[7:])
-            self.odrivestatus.set_emblem(item_path, emblem)
+if __name__ == "__main__":
+    sys.exit(helper_main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Import-time budget check for the extension module.
+
+Nautilus imports odrive_menu.py in every session on every desktop, so loading
+it must stay cheap. Each run imports the module in a fresh interpreter where
+the modules Nautilus has already loaded (gi, Nautilus, GObject, Gio, GLib,
+gettext) are imported beforehand, and measures what the module adds.
+
+Exits with status 1 when the median import time goes over the budget or when
+a module meant to be loaded lazily is imported.
+
+Usage:
+    tools/bench_import.py [--runs N] [--budget-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only needed once the user interacts with the extension
+LAZY_MODULES = ["gi.repository.Gtk", "sqlite3", "concurrent.futures", "configparser", "json", "logging", "socket",
+                "urllib.request", "subprocess"]
+
+PROBE = """
+import json, sys, time
+import gi
+gi.require_version('Nautilus', '3.0')
+from gi.repository import Nautilus, GObject, Gio, GLib
+import gettext
+preloaded = set(sys.modules)
+start = time.perf_counter()
+import odrive_menu
+elapsed = time.perf_counter() - start
+loaded = sorted(name for name in set(sys.modules) - preloaded)
+sys.stdout.write(json.dumps({"elapsed": elapsed, "loaded": loaded}))
+"""
+
+
+def measure():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    # Nautilus imports the module from its cached bytecode
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    output = subprocess.run([sys.executable, "-c", PROBE], env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=25.0)
+    options = parser.parse_args()
+
+    # The first import compiles the module to bytecode, as Nautilus does once
+    measure()
+    runs = [measure() for _ in range(options.runs)]
+    timings = sorted(run["elapsed"] * 1000 for run in runs)
+    median = statistics.median(timings)
+    eager = sorted(set(LAZY_MODULES) & set(runs[-1]["loaded"]))
+
+    print("import odrive_menu: median {:.2f} ms, min {:.2f} ms, max {:.2f} ms (budget {:.2f} ms)".format(
+        median, timings[0], timings[-1], options.budget_ms))
+    print("modules loaded by the import: {}".format(", ".join(runs[-1]["loaded"])))
+
+    failed = False
+    if median > options.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    if eager:
+        print("FAIL: lazily loaded modules imported at startup: {}".format(", ".join(eager)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of mount membership lookups.
+
+Compares OdriveMountIndex (path-component trie) with a linear scan over the
+mount list for thousands of mounts and selected paths.
+
+Usage:
+    tools/bench_mount_index.py [--mounts N] [--paths N] [--depth N]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import odrive_menu  # noqa: E402
+
+
+def linear_owning_mount(mounts, path):
+    owner = None
+    for mount in mounts:
+        if (path == mount or path.startswith(mount + os.sep)) and (owner is None or len(mount) > len(owner)):
+            owner = mount
+    return owner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mounts", type=int, default=5000)
+    parser.add_argument("--paths", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=6, help="components below a mount in selected paths")
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    rng = random.Random(0)
+    mounts = ["/home/user{}/odrive/{}".format(index % 50, index) for index in range(options.mounts)]
+    paths = []
+    for _ in range(options.paths):
+        base = rng.choice(mounts) if rng.random() < 0.8 else "/home/user{}/other".format(rng.randrange(50))
+        paths.append(os.path.join(base, *["dir{}".format(rng.randrange(100)) for _ in range(options.depth)]))
+
+    build = min(timeit.repeat(lambda: odrive_menu.OdriveMountIndex(mounts), number=1, repeat=options.repeat))
+    index = odrive_menu.OdriveMountIndex(mounts)
+    for path in paths[:200]:
+        assert index.owning_mount(path) == linear_owning_mount(mounts, path), path
+
+    trie = min(timeit.repeat(lambda: index.classify(paths), number=1, repeat=options.repeat))
+    linear = min(timeit.repeat(lambda: [linear_owning_mount(mounts, path) for path in paths[:1000]],
+                               number=1, repeat=options.repeat)) * len(paths) / min(1000, len(paths))
+
+    print("mounts={} paths={} depth={}".format(options.mounts, options.paths, options.depth))
+    print("index build:     {:10.3f} ms".format(build * 1000))
+    print("trie classify:   {:10.3f} ms ({:.2f} us/path)".format(trie * 1000, trie * 1e6 / len(paths)))
+    print("linear scan:     {:10.3f} ms ({:.2f} us/path, extrapolated)".format(linear * 1000,
+                                                                               linear * 1e6 / len(paths)))
+
+
+if __name__ == "__main__":
+    main()
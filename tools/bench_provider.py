@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""Reproducible benchmark of the menu provider against the fake odrive client.
+
+A throw-away directory gets a `bin/odrive` pointing at fake_odrive.py, first
+in $PATH, and is used as $HOME and XDG directories so that neither a real
+odrive nor the user's caches are involved. The fake client knows of
+`--mounts` mounts. OdriveMenu is created in this process, outside Nautilus,
+and fed synthetic selections (objects with the few Nautilus.FileInfo methods
+the extension calls) spread over those mounts:
+- get_file_items/<n>: right-click on n items, the menu being cached;
+- _generate_menu/<n>: the same with an empty menu cache;
+- sync_files/<n>: sync of n placeholders until the job queue drains,
+  latencies being those of each job from the click;
+- _check_odrive_syncState/<n> and .../children: sync state of n files, then
+  the children of n folders, until the dialog would show up.
+
+Each result gets p50/p99 latency, throughput and the odrive spawns it cost
+(counted by the fake client), and everything is written as JSON to
+`--output`. `--compare` prints the differences with an earlier result file
+and exits with status 1 when a p50 latency grew by more than
+`--max-regression` percent.
+
+Runs headless: it needs PyGObject (GLib and Gio), but neither a display nor
+the Nautilus and Gtk typelibs, which are replaced by stand-ins. The session helper and the agent client are off, so
+that every odrive call is a process spawn, and the progress window is never
+shown.
+
+Usage:
+    tools/bench_provider.py [--sizes 1,100,10000] [--latency SECONDS] [--failure-rate P]
+                            [--output-lines N] [--output FILE] [--compare FILE]
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def stub_typelibs():
+    """Stand-ins for the Nautilus and Gtk typelibs, put in place of them
+
+    The typelibs are only there on desktops, and loading them is not what is
+    measured: the stand-ins are used even where they are installed, so that
+    results compare across machines. Nautilus gets the few classes the
+    extension uses. Gtk gets nothing, since no window is shown while
+    measuring, so any use of it fails loudly.
+    """
+    import gi
+
+    class MenuItem(object):
+        def __init__(self, **properties):
+            self.properties = properties
+            self.submenu = None
+            self.handlers = []
+
+        def connect(self, signal, handler, *args):
+            self.handlers.append((signal, handler, args))
+            return len(self.handlers)
+
+        def set_submenu(self, menu):
+            self.submenu = menu
+
+    class Menu(object):
+        def __init__(self):
+            self.items = []
+
+        def append_item(self, item):
+            self.items.append(item)
+
+    class Column(object):
+        def __init__(self, **properties):
+            self.properties = properties
+
+    class FileInfo(object):
+        @staticmethod
+        def lookup_for_uri(_uri):
+            # No file is shown in a window
+            return None
+
+    class OperationResult(object):
+        COMPLETE = 0
+        FAILED = 1
+        IN_PROGRESS = 2
+
+    nautilus = types.ModuleType("gi.repository.Nautilus")
+    # Distinct classes, the extension deriving from all three
+    nautilus.MenuProvider = type("MenuProvider", (object,), {"emit_items_updated_signal": lambda self: None})
+    nautilus.InfoProvider = type("InfoProvider", (object,), {})
+    nautilus.ColumnProvider = type("ColumnProvider", (object,), {})
+    nautilus.MenuItem = MenuItem
+    nautilus.Menu = Menu
+    nautilus.Column = Column
+    nautilus.FileInfo = FileInfo
+    nautilus.OperationResult = OperationResult
+    nautilus.info_provider_update_complete_invoke = lambda *_args: None
+
+    gtk = types.ModuleType("gi.repository.Gtk")
+
+    require_version = gi.require_version
+
+    def require_version_but_stubbed(namespace, version):
+        if namespace not in ("Nautilus", "Gtk"):
+            require_version(namespace, version)
+
+    gi.require_version = require_version_but_stubbed
+    import gi.repository
+    for name, module in (("Nautilus", nautilus), ("Gtk", gtk)):
+        sys.modules["gi.repository." + name] = module
+        setattr(gi.repository, name, module)
+
+
+stub_typelibs()
+
+import odrive_menu  # noqa: E402
+from odrive_menu import GLib  # noqa: E402
+
+RESULTS_VERSION = 1
+
+
+class FakeFileInfo(object):
+    """The part of Nautilus.FileInfo used by the extension"""
+
+    def __init__(self, path, directory=False):
+        self.uri = "file://" + quote(path)
+        self.directory = directory
+
+    def get_uri(self):
+        return self.uri
+
+    def get_uri_scheme(self):
+        return "file"
+
+    def is_directory(self):
+        return self.directory
+
+    def is_gone(self):
+        return False
+
+
+def percentile(timings, percent):
+    """Nearest-rank percentile of a sorted list"""
+    return timings[max(0, min(len(timings) - 1, int(math.ceil(percent / 100.0 * len(timings))) - 1))]
+
+
+def summarize(timings, items, spawns, engine, failures=0, duration=None):
+    timings = sorted(timings)
+    if duration is None:
+        duration = sum(timings)
+    return {
+        "items": items,
+        "runs": len(timings),
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "max_ms": timings[-1] * 1000,
+        "throughput_items_s": items * len(timings) / duration if duration else None,
+        "spawns": spawns,
+        "engine": engine,
+        "failures": failures,
+    }
+
+
+class Bench(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.directory = tempfile.mkdtemp(prefix="odrive-bench-")
+        self.log_path = os.path.join(self.directory, "spawns.log")
+        self.mounts = [os.path.join(self.directory, "mounts", "mount{}".format(index))
+                       for index in range(options.mounts)]
+        self.menu = None
+        self.results = {}
+
+    def setup(self):
+        os.makedirs(os.path.join(self.directory, "bin"))
+        os.symlink(os.path.join(ROOT, "tools", "fake_odrive.py"), os.path.join(self.directory, "bin", "odrive"))
+        for mount in self.mounts:
+            os.makedirs(mount)
+        with open(os.path.join(self.directory, "state.json"), "w", encoding="utf-8") as state:
+            json.dump(dict((mount, "/") for mount in self.mounts), state)
+
+        os.environ.update({
+            "PATH": os.pathsep.join([os.path.join(self.directory, "bin"), os.environ.get("PATH", "")]),
+            "HOME": self.directory,
+            "XDG_CACHE_HOME": os.path.join(self.directory, "cache"),
+            "XDG_CONFIG_HOME": os.path.join(self.directory, "config"),
+            "FAKE_ODRIVE_LOG": self.log_path,
+            "FAKE_ODRIVE_STATE": os.path.join(self.directory, "state.json"),
+            "FAKE_ODRIVE_LATENCY": str(self.options.latency),
+            "FAKE_ODRIVE_FAILURE_RATE": "0",
+            "FAKE_ODRIVE_OUTPUT_LINES": str(self.options.output_lines),
+        })
+        os.environ.pop("ODRIVE_AGENT_PORT", None)
+        odrive_menu.HELPER_ENABLED = False
+        odrive_menu.AGENT_CLIENT_ENABLED = False
+        # The progress window needs a display
+        odrive_menu.PROGRESS_WINDOW_DELAY = 24 * 3600
+
+        self.menu = odrive_menu.OdriveMenu()
+        self.wait(lambda: self.menu.mount_table.get_mounts() is not None
+                  and self.menu.agent_health.state == odrive_menu.OdriveAgentHealth.HEALTHY, "the fake odrive")
+        if len(self.menu.mount_table.get_mounts()) != len(self.mounts):
+            raise RuntimeError("the extension sees {} mounts instead of {}".format(
+                len(self.menu.mount_table.get_mounts()), len(self.mounts)))
+        # Periodic probes and mount refreshes would show up in whichever benchmark runs at the time
+        self.menu.agent_health.stop()
+        self.menu.mount_table.ttl = float("inf")
+        # Failures are only injected once the extension is up
+        os.environ["FAKE_ODRIVE_FAILURE_RATE"] = str(self.options.failure_rate)
+
+    def teardown(self):
+        if self.menu is not None:
+            self.menu.agent_health.stop()
+            self.menu.engine.cancel_all()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def wait(self, condition, what, timeout=None):
+        """Run the main loop until `condition()` holds"""
+        if timeout is None:
+            timeout = 60 + 100 * self.options.latency
+        deadline = time.monotonic() + timeout
+        # Wakes the loop up regularly even when nothing else is pending
+        tick = GLib.timeout_add(20, lambda: True)
+        context = GLib.MainContext.default()
+        try:
+            while not condition():
+                if time.monotonic() > deadline:
+                    raise RuntimeError("timed out waiting for {}".format(what))
+                context.iteration(True)
+        finally:
+            GLib.source_remove(tick)
+
+    def spawned(self):
+        if not os.path.exists(self.log_path):
+            return 0
+        with open(self.log_path, encoding="utf-8") as log:
+            return sum(1 for _line in log)
+
+    def recover(self):
+        """Close the breaker if time-outs of an earlier benchmark opened it.
+
+        The periodic probes are off, so nothing else would close it, and every
+        later benchmark would only measure refused commands."""
+        health = self.menu.agent_health
+        if health.state != odrive_menu.OdriveAgentHealth.HEALTHY:
+            health.probe()
+            self.wait(lambda: health.state == odrive_menu.OdriveAgentHealth.HEALTHY, "the breaker to close")
+            health.stop()
+
+    @contextlib.contextmanager
+    def measure(self):
+        """Spawns and engine counters of the block, in the dictionary yielded"""
+        self.recover()
+        counters = {}
+        spawns = self.spawned()
+        engine_stats = self.menu.engine.stats()
+        yield counters
+        counters["spawns"] = self.spawned() - spawns
+        counters["engine"] = dict((name, value - engine_stats[name])
+                                  for name, value in self.menu.engine.stats().items() if name != "running")
+
+    def runs_for(self, size):
+        # Big selections are measured fewer times
+        return max(3, min(self.options.runs, self.options.item_budget // size))
+
+    def selection(self, size):
+        """`size` paths spread over the mounts, some outside of them, some placeholders and folders"""
+        items = []
+        for index in range(size):
+            if self.rng.random() < 0.9:
+                parent = os.path.join(self.rng.choice(self.mounts), "dir{}".format(self.rng.randrange(50)))
+            else:
+                parent = os.path.join(self.directory, "elsewhere")
+            kind = self.rng.random()
+            if kind < 0.1:
+                items.append(FakeFileInfo(os.path.join(parent, "folder{}".format(index)), directory=True))
+            elif kind < 0.2:
+                items.append(FakeFileInfo(os.path.join(parent, "folder{}.cloudf".format(index)), directory=True))
+            elif kind < 0.5:
+                items.append(FakeFileInfo(os.path.join(parent, "file{}.txt.cloud".format(index))))
+            else:
+                items.append(FakeFileInfo(os.path.join(parent, "file{}.txt".format(index))))
+        return items
+
+    def bench_menu(self, size):
+        items = self.selection(size)
+        runs = self.runs_for(size)
+
+        cold = []
+        with self.measure() as counters:
+            for _run in range(runs):
+                self.menu._menu_cache.clear()
+                started = time.perf_counter()
+                self.menu._generate_menu(items)
+                cold.append(time.perf_counter() - started)
+        self.results["_generate_menu/{}".format(size)] = summarize(cold, size, **counters)
+
+        warm = []
+        self.menu.get_file_items(None, items)
+        with self.measure() as counters:
+            for _run in range(runs):
+                started = time.perf_counter()
+                self.menu.get_file_items(None, items)
+                warm.append(time.perf_counter() - started)
+        self.results["get_file_items/{}".format(size)] = summarize(warm, size, **counters)
+
+    def placeholders(self, size):
+        """`size` placeholder files spread over the mounts, created on disk"""
+        items = []
+        for index in range(size):
+            mount = self.mounts[index % len(self.mounts)]
+            path = os.path.join(mount, "sync", "file{}.bin.cloud".format(index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Synced by a previous run: back to a placeholder
+            if os.path.exists(path[:-len(".cloud")]):
+                os.remove(path[:-len(".cloud")])
+            open(path, "w", encoding="utf-8").close()
+            items.append(FakeFileInfo(path))
+        return items
+
+    def sync_once(self, items, latencies, failures):
+        """Sync `items` until every job is over, adding to `latencies` and `failures`; returns the time taken"""
+        on_job_done = self.menu._on_job_done
+        started = time.perf_counter()
+        done = []
+
+        def on_done(job):
+            latencies.append(time.perf_counter() - started)
+            done.append(job)
+            if job.state != odrive_menu.OdriveJob.DONE:
+                failures.append(job)
+            on_job_done(job)
+
+        self.menu._on_job_done = on_done
+        try:
+            self.menu.sync_files(items, False, False)
+            # Jobs are only queued once the remote sizes are known: wait for each of them
+            self.wait(lambda: len(done) == len(items), "the sync jobs")
+        finally:
+            del self.menu._on_job_done
+        return time.perf_counter() - started
+
+    def bench_sync(self, size):
+        latencies = []
+        failures = []
+        duration = 0.0
+        with self.measure() as counters:
+            for _run in range(self.options.sync_runs):
+                duration += self.sync_once(self.placeholders(size), latencies, failures)
+        self.results["sync_files/{}".format(size)] = summarize(latencies, size, failures=len(failures),
+                                                               duration=duration, **counters)
+
+    def folders(self, size):
+        """`size` folders of the mounts with a few synced files and placeholders each"""
+        folders = []
+        for index in range(size):
+            folder = os.path.join(self.mounts[index % len(self.mounts)], "state", "folder{}".format(index))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+                for child in range(self.options.folder_files):
+                    name = "file{}.txt{}".format(child, ".cloud" if child % 2 else "")
+                    open(os.path.join(folder, name), "w", encoding="utf-8").close()
+            folders.append(folder)
+        return folders
+
+    def bench_syncstate(self, size, check_children):
+        folders = self.folders(size if check_children else max(1, size // self.options.folder_files))
+        if check_children:
+            items = [FakeFileInfo(folder, directory=True) for folder in folders]
+        else:
+            paths = [os.path.join(folder, name) for folder in folders for name in sorted(os.listdir(folder))
+                     if not name.endswith(".cloud")]
+            items = [FakeFileInfo(path) for path in paths[:size]]
+
+        shown = []
+        self.menu._show_syncstate_dialog = lambda title, states, errors=(): shown.append(states)
+        # Every run asks odrive: no state served from memory or from the on-disk store
+        store, self.menu.state_cache.store = self.menu.state_cache.store, None
+        timings = []
+        try:
+            with self.measure() as counters:
+                for _run in range(self.runs_for(len(items))):
+                    self.menu.state_cache.clear()
+                    self.menu.syncstate_resolver.listings.clear()
+                    self.menu.syncstate_resolver.sizes.clear()
+                    self.menu.engine._memo.clear()
+                    del shown[:]
+                    started = time.perf_counter()
+                    self.menu._check_odrive_syncState(None, items, check_children)
+                    self.wait(lambda: shown, "the sync states")
+                    timings.append(time.perf_counter() - started)
+        finally:
+            del self.menu._show_syncstate_dialog
+            self.menu.state_cache.store = store
+        name = "_check_odrive_syncState/{}{}".format(len(items), "/children" if check_children else "")
+        self.results[name] = summarize(timings, len(items), **counters)
+
+    def run(self):
+        sizes = [int(size) for size in self.options.sizes.split(",")]
+        try:
+            self.setup()
+            for size in sizes:
+                self.bench_menu(size)
+            for size in sizes:
+                if size <= self.options.max_sync_items:
+                    self.bench_sync(size)
+                    self.bench_syncstate(size, False)
+                    self.bench_syncstate(size, True)
+        finally:
+            self.teardown()
+        return {
+            "version": RESULTS_VERSION,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": vars(self.options),
+            "results": self.results,
+        }
+
+
+def print_results(results):
+    print("{:<42} {:>8} {:>6} {:>11} {:>11} {:>13} {:>7}".format(
+        "benchmark", "items", "runs", "p50 ms", "p99 ms", "items/s", "spawns"))
+    for name, result in results["results"].items():
+        print("{:<42} {:>8} {:>6} {:>11.3f} {:>11.3f} {:>13.0f} {:>7}".format(
+            name, result["items"], result["runs"], result["p50_ms"], result["p99_ms"],
+            result["throughput_items_s"] or 0, result["spawns"]))
+
+
+def compare(results, baseline, max_regression):
+    """Print the p50/p99/spawn changes since `baseline`; returns the names of regressed benchmarks"""
+    if baseline.get("version") != results["version"]:
+        print("baseline has result format {}, expected {}".format(baseline.get("version"), results["version"]))
+        return []
+    regressed = []
+    print("{:<42} {:>10} {:>10} {:>14}".format("compared to baseline", "p50", "p99", "spawns"))
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        p50 = (result["p50_ms"] / before["p50_ms"] - 1) * 100 if before["p50_ms"] else 0.0
+        p99 = (result["p99_ms"] / before["p99_ms"] - 1) * 100 if before["p99_ms"] else 0.0
+        print("{:<42} {:>+9.1f}% {:>+9.1f}% {:>6} -> {:<6}".format(name, p50, p99, before["spawns"],
+                                                                    result["spawns"]))
+        if p50 > max_regression:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,10,100,1000,10000,100000", help="comma separated selection sizes")
+    parser.add_argument("--mounts", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20, help="runs per benchmark (fewer for big selections)")
+    parser.add_argument("--item-budget", type=int, default=1000000, help="items handled per benchmark at most")
+    parser.add_argument("--sync-runs", type=int, default=3)
+    parser.add_argument("--max-sync-items", type=int, default=1000,
+                        help="largest selection synced and checked (each item costs odrive runs)")
+    parser.add_argument("--folder-files", type=int, default=10, help="files created in each checked folder")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds each fake odrive run takes")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of a fake odrive run failing")
+    parser.add_argument("--output-lines", type=int, default=100,
+                        help="extra output lines of each fake odrive run (virtual folder children, progress)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--compare", metavar="FILE", help="earlier --output file to compare with")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="p50 growth tolerated, in percent")
+    options = parser.parse_args()
+
+    results = Bench(options).run()
+    with open(options.output, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print_results(results)
+    print("results written to {}".format(options.output))
+
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as baseline:
+            regressed = compare(results, json.load(baseline), options.max_regression)
+        if regressed:
+            print("FAIL: p50 latency grew by more than {:.0f}%: {}".format(options.max_regression,
+                                                                           ", ".join(regressed)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
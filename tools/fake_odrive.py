@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Stand-in for the odrive CLI, acting on the local filesystem like fake_odrive_agent.py.
+
+Link it as `odrive` in a directory put first in $PATH. Its behaviour is
+scripted through the environment:
+    FAKE_ODRIVE_LATENCY       seconds slept before answering (default 0)
+    FAKE_ODRIVE_FAILURE_RATE  probability of failing with exit status 1 (default 0)
+    FAKE_ODRIVE_OUTPUT_LINES  extra lines printed on success: virtual children listed by
+                              `syncstate` for folders, progress lines for other commands (default 0)
+    FAKE_ODRIVE_STATE         JSON file keeping the mounts between runs (default: none kept)
+    FAKE_ODRIVE_LOG           file getting one line per invocation, to count spawns
+
+Usage:
+    ln -s $PWD/tools/fake_odrive.py /tmp/fake-bin/odrive
+    PATH=/tmp/fake-bin:$PATH odrive sync /path/to/file.cloud
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from fake_odrive_agent import FakeOdriveAgent  # noqa: E402
+
+# Agent protocol parameter names of the positional arguments of each command
+COMMAND_PARAMETERS = {
+    "status": (),
+    "mount": ("localPath", "remotePath"),
+    "unmount": ("localPath",),
+    "sync": ("placeholderPath",),
+    "unsync": ("path",),
+    "syncstate": ("path",),
+}
+
+
+def parse_arguments(args):
+    """Translate odrive CLI arguments into (command, parameters)"""
+    command = args[0]
+    positional = [arg for arg in args[1:] if not arg.startswith("--")]
+    parameters = dict(zip(COMMAND_PARAMETERS.get(command, ()), positional))
+    parameters.update((flag[2:], True) for flag in args[1:] if flag.startswith("--"))
+    return command, parameters
+
+
+def padding(command, parameters, count):
+    """Extra output making a run as verbose as `count` lines of a big folder or transfer"""
+    if command == "syncstate":
+        if not os.path.isdir(parameters.get("path", "")):
+            return []
+        return [("Status", "remote-file{}.bin: Not synced ({} KB)".format(index, index % 1000))
+                for index in range(count)]
+    if command in ("status", "mount", "unmount"):
+        # Would be read as more mounts
+        return []
+    target = parameters.get("placeholderPath") or parameters.get("path") or command
+    return [("Status", "Downloading '{}' {} KB".format(target, index)) for index in range(count)]
+
+
+def main(args):
+    if os.environ.get("FAKE_ODRIVE_LOG"):
+        with open(os.environ["FAKE_ODRIVE_LOG"], "a", encoding="utf-8") as log:
+            log.write(" ".join(args) + "\n")
+    if not args:
+        sys.stderr.write("usage: odrive <command> [arguments]\n")
+        return 2
+
+    latency = float(os.environ.get("FAKE_ODRIVE_LATENCY", "0"))
+    if latency:
+        time.sleep(latency)
+    if random.random() < float(os.environ.get("FAKE_ODRIVE_FAILURE_RATE", "0")):
+        sys.stderr.write("Unable to complete the request (simulated failure)\n")
+        return 1
+
+    agent = FakeOdriveAgent()
+    state_path = os.environ.get("FAKE_ODRIVE_STATE")
+    if state_path and os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as state:
+            agent.mounts = json.load(state)
+
+    command, parameters = parse_arguments(args)
+    replies = agent.handle(command, parameters)
+    failed = False
+    if not any(message_type == "Error" for message_type, _message in replies):
+        extra = padding(command, parameters, int(os.environ.get("FAKE_ODRIVE_OUTPUT_LINES", "0")))
+        # Folder children come after the folder, transfer progress before the result
+        replies = replies + extra if command == "syncstate" else extra + replies
+    for message_type, message in replies:
+        if message_type == "Error":
+            sys.stderr.write(message + "\n")
+            failed = True
+        else:
+            sys.stdout.write(message + "\n")
+
+    if state_path:
+        # Runs overlap: others must read either the old or the new state, never a half-written one
+        temporary_path = "{}.{}".format(state_path, os.getpid())
+        with open(temporary_path, "w", encoding="utf-8") as state:
+            json.dump(agent.mounts, state)
+        os.replace(temporary_path, state_path)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
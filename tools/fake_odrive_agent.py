@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Local stand-in for the odrive agent protocol server.
+
+It speaks the same line-delimited JSON protocol as OdriveAgentClient and acts
+on the local filesystem the way odrive does: syncing `x.cloud` replaces the
+placeholder with an (empty) file `x`, syncing `x.cloudf` with a folder `x`,
+and unsyncing does the opposite. Connections are kept open between requests.
+
+Usage:
+    tools/fake_odrive_agent.py [--port PORT] [--latency SECONDS]
+    ODRIVE_AGENT_PORT=<printed port> nautilus
+"""
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+
+
+class FakeOdriveAgent(object):
+    """In-memory agent state shared by every connection"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.mounts = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handle(self, command, parameters):
+        """Return a list of (messageType, message) for one request"""
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, "do_" + command, None)
+        if handler is None:
+            return [("Error", "Unknown command: {}".format(command))]
+        try:
+            return handler(**parameters)
+        except (OSError, TypeError, KeyError) as error:
+            return [("Error", str(error))]
+
+    def do_status(self, mounts=False):
+        with self.lock:
+            lines = ["{}  {}  Active".format(local, remote) for local, remote in sorted(self.mounts.items())]
+        if mounts:
+            return [("Status", line) for line in lines]
+        return [("Status", "isActivated: True"), ("Status", "Mounts: {}".format(len(lines)))]
+
+    def do_mount(self, localPath, remotePath):
+        if not os.path.isdir(localPath):
+            return [("Error", "Local path does not exist: {}".format(localPath))]
+        with self.lock:
+            self.mounts[os.path.normpath(localPath)] = remotePath
+        return [("Status", "Mounted {} to {}".format(localPath, remotePath))]
+
+    def do_unmount(self, localPath):
+        with self.lock:
+            if self.mounts.pop(os.path.normpath(localPath), None) is None:
+                return [("Error", "Not a mount: {}".format(localPath))]
+        return [("Status", "Unmounted {}".format(localPath))]
+
+    def do_sync(self, placeholderPath, recursive=False, nodownload=False):
+        path = self._materialize(placeholderPath)
+        if recursive and os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for index, name in enumerate(dirs):
+                    if name.endswith(".cloudf"):
+                        dirs[index] = os.path.basename(self._materialize(os.path.join(root, name)))
+                for name in files:
+                    if name.endswith(".cloud") and not nodownload:
+                        self._materialize(os.path.join(root, name))
+        return [("Status", "Synced {}".format(path))]
+
+    def do_unsync(self, path):
+        if path.endswith((".cloud", ".cloudf")):
+            return [("Error", "Already a placeholder: {}".format(path))]
+        if os.path.isdir(path):
+            if any(not name.endswith((".cloud", ".cloudf")) for name in os.listdir(path)):
+                return [("Error", "Folder has synced content: {}".format(path))]
+            os.rename(path, path + ".cloudf")
+        else:
+            os.remove(path)
+            open(path + ".cloud", "w", encoding="utf-8").close()
+        return [("Status", "Unsynced {}".format(path))]
+
+    def do_syncstate(self, path, textonly=False):
+        path = os.path.normpath(path)
+        messages = [("Status", "{}: {}".format(os.path.basename(path), _state(path)))]
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                messages.append(("Status", "{}: {}".format(name, _state(os.path.join(path, name)))))
+        return messages
+
+    @staticmethod
+    def _materialize(placeholder):
+        if placeholder.endswith(".cloudf"):
+            path = placeholder[:-len(".cloudf")]
+            os.rename(placeholder, path)
+        elif placeholder.endswith(".cloud"):
+            path = placeholder[:-len(".cloud")]
+            os.remove(placeholder)
+            open(path, "w", encoding="utf-8").close()
+        else:
+            raise OSError("Not a placeholder: {}".format(placeholder))
+        return path
+
+
+def _state(path):
+    if path.endswith((".cloud", ".cloudf")):
+        return "Not synced"
+    return "Synced"
+
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line.decode("utf-8"))
+            replies = self.server.agent.handle(request.get("command"), request.get("parameters") or {})
+            for message_type, message in replies + [("Done", "")]:
+                self.wfile.write((json.dumps({"messageType": message_type, "message": message}) + "\n")
+                                 .encode("utf-8"))
+            self.wfile.flush()
+
+
+class FakeOdriveAgentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", port), _AgentRequestHandler)
+        self.agent = FakeOdriveAgent(latency)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    options = parser.parse_args()
+    server = FakeOdriveAgentServer(options.port, options.latency)
+    print("ODRIVE_AGENT_PORT={}".format(server.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
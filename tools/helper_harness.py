@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Runs the session helper against the fake odrive client and checks what it shares.
+
+A throw-away directory gets a mount with placeholders and a `bin/odrive`
+pointing at fake_odrive.py, then `odrive_menu.py --helper` is started on a
+private socket with that directory first in $PATH (and as $HOME, so no real
+odrive agent is found). The checks talk to the helper like the extension
+does, with the agent protocol over its Unix socket:
+- identical queries sent at the same time by several clients run odrive once;
+- a sync keeps running after the client that asked for it disconnected;
+- mutating commands on one path run one after the other;
+- the helper exits on its own once idle.
+
+Needs PyGObject and the Nautilus typelib, like the extension. Exits with
+status 1 when a check fails.
+
+Usage:
+    tools/helper_harness.py [--latency SECONDS] [--clients N]
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def request(socket_path, command, parameters=None, disconnect=False):
+    """Send one request; returns (exit_code, stdout lines, stderr lines)"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    connection.sendall((json.dumps({"command": command, "parameters": parameters or {}}) + "\n").encode("utf-8"))
+    if disconnect:
+        connection.close()
+        return None
+    stdout, stderr = [], []
+    with connection, connection.makefile("rb") as reader:
+        for line in reader:
+            message = json.loads(line.decode("utf-8"))
+            if message["messageType"] == "Done":
+                return message.get("exitCode"), stdout, stderr
+            (stderr if message["messageType"] == "Error" else stdout).append(message["message"])
+    raise RuntimeError("helper closed the connection")
+
+
+def spawned(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, encoding="utf-8") as log:
+        return log.read().splitlines()
+
+
+class Harness(object):
+
+    def __init__(self, latency, clients):
+        self.latency = latency
+        self.clients = clients
+        self.directory = tempfile.mkdtemp(prefix="odrive-helper-")
+        self.mount = os.path.join(self.directory, "odrive")
+        self.socket_path = os.path.join(self.directory, "helper.sock")
+        self.log_path = os.path.join(self.directory, "spawns.log")
+        self.failures = 0
+        self.process = None
+
+    def setup(self):
+        os.makedirs(os.path.join(self.directory, "bin"))
+        os.symlink(os.path.join(ROOT, "tools", "fake_odrive.py"), os.path.join(self.directory, "bin", "odrive"))
+        os.makedirs(os.path.join(self.mount, "folder.cloudf"))
+        for index in range(5):
+            open(os.path.join(self.mount, "file{}.txt.cloud".format(index)), "w", encoding="utf-8").close()
+
+        env = dict(os.environ)
+        env.update({
+            "PATH": os.pathsep.join([os.path.join(self.directory, "bin"), env.get("PATH", "")]),
+            "HOME": self.directory,
+            "FAKE_ODRIVE_LATENCY": str(self.latency),
+            "FAKE_ODRIVE_LOG": self.log_path,
+            "FAKE_ODRIVE_STATE": os.path.join(self.directory, "state.json"),
+        })
+        env.pop("ODRIVE_AGENT_PORT", None)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "odrive_menu.py"), "--helper", "--socket", self.socket_path,
+             "--idle-exit", "1"], env=env, stdout=subprocess.PIPE, universal_newlines=True)
+        for line in self.process.stdout:
+            if "listening" in line:
+                break
+        threading.Thread(target=self.process.stdout.read, daemon=True).start()
+
+    def teardown(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(10)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def check(self, name, condition, details=""):
+        print("{}: {}{}".format("PASS" if condition else "FAIL", name, " ({})".format(details) if details else ""))
+        if not condition:
+            self.failures += 1
+
+    def check_coalescing(self):
+        before = len(spawned(self.log_path))
+        results = [None] * self.clients
+
+        def query(index):
+            results[index] = request(self.socket_path, "run", {"args": ["syncstate", self.mount, "--textonly"]})
+
+        threads = [threading.Thread(target=query, args=(index,)) for index in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        runs = len(spawned(self.log_path)) - before
+        self.check("{} identical queries share one odrive run".format(self.clients), runs == 1,
+                   "{} runs".format(runs))
+        self.check("every client gets the full answer", all(result == results[0] for result in results)
+                   and len(results[0][1]) == 7, results[0])
+
+    def check_detached_job(self):
+        placeholder = os.path.join(self.mount, "file0.txt.cloud")
+        request(self.socket_path, "run", {"args": ["sync", placeholder]}, disconnect=True)
+        deadline = time.monotonic() + 10 + self.latency
+        while os.path.exists(placeholder) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.check("a sync survives its client", os.path.exists(placeholder[:-len(".cloud")]))
+
+    def check_serialized(self):
+        path = os.path.join(self.mount, "file1.txt.cloud")
+        results = {}
+
+        def run(args):
+            results[args[0]] = request(self.socket_path, "run", {"args": args})
+
+        sync = threading.Thread(target=run, args=(["sync", path],))
+        sync.start()
+        time.sleep(self.latency / 4)
+        run(["sync", path])
+        sync.join()
+        runs = [line for line in spawned(self.log_path) if line == "sync " + path]
+        self.check("a repeated sync of one path runs once", len(runs) == 1, "{} runs".format(len(runs)))
+
+        synced = path[:-len(".cloud")]
+        started = time.monotonic()
+        threads = [threading.Thread(target=run, args=(args,)) for args in (["unsync", synced], ["sync", path])]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        self.check("mutating commands on one path run one after the other",
+                   results["unsync"][0] == 0 and results["sync"][0] == 0 and elapsed >= 2 * self.latency,
+                   "{:.2f}s".format(elapsed))
+
+    def check_stats(self):
+        _exit_code, stdout, _stderr = request(self.socket_path, "stats")
+        stats = json.loads(stdout[0])
+        self.check("stats report avoided spawns", stats["coalesced"] >= self.clients - 1, stats)
+
+    def check_idle_exit(self):
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            pass
+        self.check("the helper exits once idle", self.process.poll() is not None)
+        self.check("the socket is removed on exit", not os.path.exists(self.socket_path))
+
+    def run(self):
+        try:
+            self.setup()
+            self.check_coalescing()
+            self.check_detached_job()
+            self.check_serialized()
+            self.check_stats()
+            self.check_idle_exit()
+        finally:
+            self.teardown()
+        return 1 if self.failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds each fake odrive run takes")
+    parser.add_argument("--clients", type=int, default=8)
+    options = parser.parse_args()
+    return Harness(options.latency, options.clients).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())